@@ -0,0 +1,213 @@
+# End-to-end benchmark which crawls threads from a local synthetic vBulletin server (see
+# vbulletin_server.py) with SiteDownloader and VBulletinForumProcessor, and reports
+# pages/s, files/s, MB/s, peak RSS and the time spent in each stage of the crawl (as
+# timed by g_metrics, in total over all worker threads and parse processes).
+# Nothing goes over the network, so results can be compared between runs and machines.
+#
+# Usage: python benchmarks/crawl_benchmark.py [options] [--output results.json] [--compare old.json]
+#
+# Run with --help for the options, which set the shape of the threads, the latency and
+# errors the server adds, and how SiteDownloader is set up. --output saves the results
+# as JSON, and --compare prints how they changed from a previous run's JSON.
+
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import sqlite3
+
+try:
+    import resource
+except ImportError:   # Windows
+    resource = None
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from site_downloader import SiteDownloader, ArchiveOutput, SetupLogger, CreateFrontier, g_metrics
+from plugins.vbulletin_forum import VBulletinForumProcessor
+from vbulletin_server import ServerSettings, StartServer
+
+
+# Return {stage: {'count', 'seconds', 'mean_ms'}} for the stages that g_metrics timed,
+# over all hosts.
+def GetStageResults():
+    return dict((stage, {'count': count, 'seconds': seconds, 'mean_ms': seconds * 1000 / count})
+                for stage, (count, seconds) in g_metrics.GetStageTotals().items() if count > 0)
+
+# Return peak RSS in MB, of this process and of the largest of its finished children.
+def GetPeakRss():
+    if resource is None:
+        return None, None
+
+    # ru_maxrss is in KB, except on macOS, where it's in bytes.
+    unit = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / float(unit),
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / float(unit))
+
+# Return (pageNum, fileNum, byteNum, diskFileNum) for what the crawl saved under
+# rootDir, where diskFileNum is the number of files it took on disk. With archive output,
+# the pages and files are counted from the archive index.
+def CountSavedFiles(rootDir, outputBackend):
+    pageNum = 0
+    fileNum = 0
+    byteNum = 0
+    diskFileNum = 0
+    for dirPath, dirNames, fileNames in os.walk(rootDir):
+        for fileName in fileNames:
+            diskFileNum += 1
+            if outputBackend != 'directory' or fileName.endswith('.sqlite'):
+                continue
+            byteNum += os.path.getsize(os.path.join(dirPath, fileName))
+            if fileName.endswith('.html'):
+                pageNum += 1
+            else:
+                fileNum += 1
+
+    if outputBackend != 'directory':
+        connection = sqlite3.connect(os.path.join(rootDir, ArchiveOutput.INDEX_FILENAME))
+        for savePath, size in connection.execute('SELECT savePath, size FROM records'):
+            byteNum += size
+            if savePath.endswith('.html'):
+                pageNum += 1
+            else:
+                fileNum += 1
+        connection.close()
+    return pageNum, fileNum, byteNum, diskFileNum
+
+def RunCrawl(args, port, rootDir):
+    urlList = ['http://127.0.0.1:{}/showthread.php?{}-thread-{}'.format(port, 1000 + i, i) for i in range(args.threads)]
+
+    dl = SiteDownloader(rootDir=rootDir, frontier=CreateFrontier(args.crawl_order), workerThreadNum=args.worker_threads)
+    if args.parse_processes > 0:
+        dl.EnableParseProcesses(args.parse_processes)
+    dl.SetSeenSetBackend(args.seen_set)
+    dl.SetOutputBackend(args.output_backend, bCompress=args.compress)
+    if args.metrics is not None:
+        dl.EnableMetricsDump(args.metrics)
+    dl.AddPlugin(VBulletinForumProcessor())
+    dl.AddUrls(urlList)
+
+    startTime = time.perf_counter()
+    dl.RunMainThread()
+    seconds = time.perf_counter() - startTime
+
+    return seconds, len(dl.failedUrls), len(dl.failedImages)
+
+def GetResults(args, seconds, failedUrlNum, failedFileNum, rootDir):
+    pageNum, fileNum, byteNum, diskFileNum = CountSavedFiles(rootDir, args.output_backend)
+    peakRss, peakChildRss = GetPeakRss()
+    megabytes = byteNum / (1024.0 * 1024.0)
+
+    return {
+        'seconds': seconds,
+        'pages': pageNum,
+        'files': fileNum,
+        'disk_files': diskFileNum,
+        'megabytes': megabytes,
+        'pages_per_second': pageNum / seconds,
+        'files_per_second': fileNum / seconds,
+        'megabytes_per_second': megabytes / seconds,
+        'peak_rss_mb': peakRss,
+        'peak_child_rss_mb': peakChildRss,
+        'failed_urls': failedUrlNum,
+        'failed_files': failedFileNum,
+        'stages': GetStageResults(),
+    }
+
+def PrintResults(results):
+    print('{:<24} {:>12.2f}'.format('seconds', results['seconds']))
+    print('{:<24} {:>12}'.format('pages', results['pages']))
+    print('{:<24} {:>12}'.format('files', results['files']))
+    print('{:<24} {:>12}'.format('files on disk', results['disk_files']))
+    print('{:<24} {:>12.2f}'.format('megabytes', results['megabytes']))
+    print('{:<24} {:>12.2f}'.format('pages/s', results['pages_per_second']))
+    print('{:<24} {:>12.2f}'.format('files/s', results['files_per_second']))
+    print('{:<24} {:>12.2f}'.format('MB/s', results['megabytes_per_second']))
+    if results['peak_rss_mb'] is not None:
+        print('{:<24} {:>12.1f}'.format('peak RSS (MB)', results['peak_rss_mb']))
+        print('{:<24} {:>12.1f}'.format('peak child RSS (MB)', results['peak_child_rss_mb']))
+    print('{:<24} {:>12}'.format('failed URLs', results['failed_urls']))
+    print('{:<24} {:>12}'.format('failed files', results['failed_files']))
+
+    print()
+    print('{:<24} {:>8} {:>12} {:>12}'.format('stage', 'calls', 'total (s)', 'mean (ms)'))
+    for stageName, stage in sorted(results['stages'].items()):
+        print('{:<24} {:>8} {:>12.3f} {:>12.3f}'.format(stageName, stage['count'], stage['seconds'], stage['mean_ms']))
+
+# Return {name: value} for the numbers in results, with the stage times as
+# "stage:<name>" entries.
+def FlattenResults(results):
+    values = dict((key, value) for key, value in results.items() if isinstance(value, (int, float)))
+    for stageName, stage in results.get('stages', {}).items():
+        values['stage:' + stageName] = stage['mean_ms']
+    return values
+
+def PrintComparison(oldResults, newResults):
+    oldValues = FlattenResults(oldResults)
+    newValues = FlattenResults(newResults)
+
+    print('{:<24} {:>12} {:>12} {:>10}'.format('', 'old', 'new', 'change'))
+    for key in sorted(set(oldValues) & set(newValues)):
+        oldValue = oldValues[key]
+        newValue = newValues[key]
+        change = '{:+.1f}%'.format((newValue - oldValue) * 100.0 / oldValue) if oldValue else ''
+        print('{:<24} {:>12.2f} {:>12.2f} {:>10}'.format(key, oldValue, newValue, change))
+
+def main():
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--threads', type=int, default=4, help='Number of threads to crawl')
+    ServerSettings.AddArguments(argParser)
+    argParser.add_argument('--worker-threads', type=int, default=SiteDownloader.MAX_WORKER_THREADS)
+    argParser.add_argument('--parse-processes', type=int, default=0)
+    argParser.add_argument('--crawl-order', default='depth_first')
+    argParser.add_argument('--seen-set', default='memory', help='Seen set backend: memory, bloom or disk')
+    argParser.add_argument('--output-backend', default='directory', help='Output backend: directory, warc or tar')
+    argParser.add_argument('--compress', action='store_true', help='Compress WARC records')
+    argParser.add_argument('--output', help='Save the results to this JSON file')
+    argParser.add_argument('--compare', help='Compare the results with those in this JSON file')
+    argParser.add_argument('--metrics', help='Save SiteDownloader\'s metrics, per host, to this file (JSON or Prometheus text)')
+    argParser.add_argument('--keep', action='store_true', help='Keep the downloaded files')
+    argParser.add_argument('--verbose', action='store_true', help='Show SiteDownloader\'s log output')
+    args = argParser.parse_args()
+
+    SetupLogger(level='debug' if args.verbose else 'warning')
+
+    serverProcess, port = StartServer(ServerSettings.FromArguments(args))
+    rootDir = tempfile.mkdtemp(prefix='crawl_benchmark_')
+    try:
+        seconds, failedUrlNum, failedFileNum = RunCrawl(args, port, rootDir)
+        serverProcess.terminate()
+        serverProcess.join()
+        results = GetResults(args, seconds, failedUrlNum, failedFileNum, rootDir)
+    finally:
+        if serverProcess.is_alive():
+            serverProcess.terminate()
+        if args.keep:
+            print('Files are in', rootDir)
+        else:
+            shutil.rmtree(rootDir, ignore_errors=True)
+
+    PrintResults(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as outFile:
+            json.dump({
+                'settings': dict((key, value) for key, value in vars(args).items() if key not in ['output', 'compare', 'metrics', 'keep', 'verbose']),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'results': results,
+            }, outFile, indent=2, sort_keys=True)
+
+    if args.compare is not None:
+        with open(args.compare, 'r') as compareFile:
+            oldResults = json.load(compareFile)['results']
+        print()
+        PrintComparison(oldResults, results)
+
+if __name__ == '__main__':
+    main()
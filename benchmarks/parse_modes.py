@@ -0,0 +1,78 @@
+# Benchmark for the ways plugins can parse a page: a full BeautifulSoup tree with each
+# available parser, a strained parse of just the page navigation tags, and reading tags
+# with SiteDownloaderPlugin.IterTags(). Each mode finds a thread page's page range, the
+# way VBulletinForumProcessor does for user-added URLs, and we report the time it takes
+# and the peak memory it uses.
+#
+# Usage: python benchmarks/parse_modes.py [--runs N] [page.html ...]
+#
+# Pass saved vBulletin thread pages to benchmark with them; otherwise a synthetic page
+# from vbulletin_pages is used.
+
+from __future__ import print_function
+import os
+import sys
+import io
+import time
+import tracemalloc
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import site_downloader
+from site_downloader import BeautifulSoup, IterLxmlTags, IterTokenizerTags, lxml
+from plugins.vbulletin_forum import VBulletinForumProcessor
+from vbulletin_pages import MakeThreadPage
+
+
+def GetModes(plugin):
+    modes = []
+    for parser in ['lxml', 'html.parser']:
+        if parser == 'lxml' and site_downloader.g_soupParser != 'lxml':
+            continue
+        modes.append(('soup ' + parser, lambda html, parser=parser: plugin.FindPageRange(BeautifulSoup(html, features=parser))))
+
+    modes.append(('strained soup ' + site_downloader.g_soupParser, lambda html: plugin.FindPageRange(plugin.GetSoup(html, plugin.PAGE_RANGE_STRAINER))))
+
+    if lxml is not None:
+        modes.append(('tags lxml', lambda html: plugin.FindPageRangeInTags(IterLxmlTags(html, ['a']))))
+    modes.append(('tags html.parser', lambda html: plugin.FindPageRangeInTags(IterTokenizerTags(html, ['a']))))
+    return modes
+
+# Returns (seconds, peakBytes, result) for the best of the runs of the mode.
+def RunMode(mode, html, runNum):
+    times = []
+    for i in range(runNum):
+        startTime = time.perf_counter()
+        result = mode(html)
+        times.append(time.perf_counter() - startTime)
+
+    tracemalloc.start()
+    mode(html)
+    peakBytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return min(times), peakBytes, result
+
+def main():
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--runs', type=int, default=20, help='Number of timed runs of each mode')
+    argParser.add_argument('pages', nargs='*', help='HTML files of vBulletin thread pages')
+    args = argParser.parse_args()
+
+    pages = []
+    for pagePath in args.pages:
+        with io.open(pagePath, 'r', encoding='utf-8', errors='replace') as pageFile:
+            pages.append((os.path.basename(pagePath), pageFile.read()))
+    if len(pages) == 0:
+        pages.append(('synthetic', MakeThreadPage(page=3, lastPage=12)))
+
+    plugin = VBulletinForumProcessor()
+    for pageName, html in pages:
+        print('{} ({} KB)'.format(pageName, len(html) // 1024))
+        print('  {:<28} {:>10} {:>12}  {}'.format('mode', 'time (ms)', 'peak (KB)', 'page range'))
+        for modeName, mode in GetModes(plugin):
+            seconds, peakBytes, result = RunMode(mode, html, args.runs)
+            print('  {:<28} {:>10.2f} {:>12}  {}'.format(modeName, seconds * 1000, peakBytes // 1024, result))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+# Benchmark of finding the plugin for user-added URLs, with many site plugins loaded:
+# calling every plugin's GetPageRelevance() for each URL, as DownloadThread used to,
+# against looking the URL up in a PluginDispatchIndex built from the plugins'
+# urlPatterns. Checks that both pick the same plugins.
+#
+# Usage: python benchmarks/plugin_dispatch.py [--plugins N] [--urls N]
+
+from __future__ import print_function
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from site_downloader import SiteDownloaderPlugin, PluginDispatchIndex
+
+
+# Stands in for a typical site plugin, which handles thread URLs on one forum host.
+class SitePlugin(SiteDownloaderPlugin):
+    def __init__(self, host):
+        self.host = host
+        self.urlRegex = re.compile(r'https?://(www\.)?' + re.escape(host) + r'/.*showthread\.php\?')
+        self.urlPatterns = [(host, r'.*showthread\.php\?', 100)]
+
+    def GetPageRelevance(self, url):
+        return 100 if self.urlRegex.match(url) else 0
+
+# Stands in for a generic plugin that handles some of any host's URLs.
+class GenericPlugin(SiteDownloaderPlugin):
+    urlPatterns = [('*', '/gallery/', 10)]
+
+    def GetPageRelevance(self, url):
+        return 10 if url.find('/gallery/', url.find('//') + 2) != -1 else 0
+
+# Return the plugin that handles a URL, the way DownloadThread used to find it.
+def FindPluginByPolling(plugins, url):
+    usePlugin = None
+    highestRelevance = 0
+    for plugin in plugins:
+        relevance = plugin.GetPageRelevance(url)
+        if relevance > highestRelevance:
+            highestRelevance = relevance
+            usePlugin = plugin
+    return usePlugin
+
+def main():
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--plugins', type=int, default=50, help='Number of site plugins')
+    argParser.add_argument('--urls', type=int, default=200000, help='Number of URLs to look up')
+    args = argParser.parse_args()
+
+    hosts = ['forum{}.example.com'.format(i) for i in range(args.plugins)]
+    plugins = [SitePlugin(host) for host in hosts] + [GenericPlugin()]
+
+    random.seed(1)
+    urlTemplates = ['http://{}/forum/showthread.php?{}-thread', 'http://www.{}/showthread.php?{}-thread',
+                    'http://{}/gallery/{}.html', 'http://{}/member.php?{}', 'http://other{}.example.org/page{}']
+    urls = [random.choice(urlTemplates).format(random.choice(hosts), i) for i in range(args.urls)]
+
+    startTime = time.perf_counter()
+    pollingResults = [FindPluginByPolling(plugins, url) for url in urls]
+    pollingSeconds = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    pluginIndex = PluginDispatchIndex(plugins)
+    buildSeconds = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    indexResults = [pluginIndex.FindPlugin(url) for url in urls]
+    indexSeconds = time.perf_counter() - startTime
+
+    mismatchNum = sum(1 for pollingResult, indexResult in zip(pollingResults, indexResults) if pollingResult is not indexResult)
+
+    print('{:<24} {:>12} {:>12}'.format('', 'total (s)', 'per URL (us)'))
+    print('{:<24} {:>12.3f} {:>12.2f}'.format('polling', pollingSeconds, pollingSeconds * 1e6 / len(urls)))
+    print('{:<24} {:>12.3f} {:>12.2f}'.format('index', indexSeconds, indexSeconds * 1e6 / len(urls)))
+    print('{:<24} {:>12.3f}'.format('index build', buildSeconds))
+    print('{:<24} {:>12}'.format('mismatches', mismatchNum))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+# Benchmark for the seen set backends that SiteDownloader can keep URLs in (see
+# CreateSeenUrlSet()). For each backend, we add a number of synthetic forum file URLs,
+# look up as many URLs again (half of them seen, half not), and report the memory used
+# per million URLs, the file size, and the time per add and lookup. Each backend runs in
+# its own process, so that its memory use can be measured from the process's RSS.
+#
+# Usage: python benchmarks/seen_set_memory.py [--urls N] [--backends memory,bloom,disk]
+
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import multiprocessing
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from site_downloader import CreateSeenUrlSet
+
+
+# Return the current RSS of this process in bytes, or None if we can't tell.
+def GetRss():
+    try:
+        with open('/proc/self/statm', 'r') as statmFile:
+            return int(statmFile.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+def MakeUrl(i):
+    return 'forum.example.com/attachment.php?attachmentid={}&d=1425467421'.format(i)
+
+def RunBackend(backend, urlNum, resultQueue):
+    tempDir = tempfile.mkdtemp(prefix='seen_set_')
+    try:
+        path = os.path.join(tempDir, 'seen.sqlite')
+        startRss = GetRss()
+
+        seenUrls = CreateSeenUrlSet(backend, path, urlNum)
+        startTime = time.perf_counter()
+        for i in range(urlNum):
+            seenUrls.Add(MakeUrl(i), 'D')
+        addTime = time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        foundNum = 0
+        for i in range(urlNum // 2, urlNum + urlNum // 2):
+            if MakeUrl(i) in seenUrls:
+                foundNum += 1
+        lookupTime = time.perf_counter() - startTime
+
+        endRss = GetRss()
+        fileSize = os.path.getsize(path) if os.path.exists(path) else 0
+        seenUrls.Close()
+
+        if foundNum != urlNum - urlNum // 2:
+            raise Exception('Wrong number of URLs found: ' + str(foundNum))
+
+        resultQueue.put({
+            'memory': (endRss - startRss) if startRss is not None and endRss is not None else None,
+            'fileSize': fileSize,
+            'addTime': addTime,
+            'lookupTime': lookupTime,
+        })
+    finally:
+        shutil.rmtree(tempDir, ignore_errors=True)
+
+def main():
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--urls', type=int, default=1000000, help='Number of URLs to add')
+    argParser.add_argument('--backends', default='memory,bloom,disk')
+    args = argParser.parse_args()
+
+    millions = args.urls / 1000000.0
+    print('{} URLs'.format(args.urls))
+    print('{:<10} {:>16} {:>16} {:>12} {:>14}'.format('backend', 'RSS (MB/M URLs)', 'file (MB/M URLs)', 'add (us)', 'lookup (us)'))
+    for backend in args.backends.split(','):
+        resultQueue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=RunBackend, args=(backend, args.urls, resultQueue))
+        process.start()
+        result = resultQueue.get()
+        process.join()
+
+        memory = '{:.1f}'.format(result['memory'] / (1024.0 * 1024.0) / millions) if result['memory'] is not None else '?'
+        print('{:<10} {:>16} {:>16.1f} {:>12.2f} {:>14.2f}'.format(backend, memory, result['fileSize'] / (1024.0 * 1024.0) / millions,
+                                                                 result['addTime'] * 1000000 / args.urls, result['lookupTime'] * 1000000 / args.urls))
+
+if __name__ == '__main__':
+    main()
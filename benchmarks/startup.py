@@ -0,0 +1,98 @@
+# Benchmark of how long it takes SiteDownloader to start up: importing site_downloader
+# and setting up the plugins in the plugins directory, timed with python -X importtime
+# in a fresh process each run. "eager" imports everything that startup used to import
+# (bs4, requests and lxml along with site_downloader, and every plugin module, as
+# main.py did); "lazy" is what main.py does now, which reads the plugin manifest and
+# leaves the rest to be imported when it's first used. Reports the median time spent
+# importing and the median run time of each, and the slowest imports that Python
+# doesn't already make at startup.
+#
+# Usage: python benchmarks/startup.py [--runs N] [--top N]
+
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+import subprocess
+import collections
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modes are run in this order. "python" starts Python and does nothing else, which
+# shows how much of the time is Python's own startup.
+STARTUP_CODE = collections.OrderedDict([
+    ('python', 'pass'),
+    ('eager', '\n'.join([
+        'import os, importlib',
+        'import site_downloader, bs4, requests, lxml.etree',
+        'for fileName in sorted(os.listdir("plugins")):',
+        '    moduleName, fileExt = os.path.splitext(fileName)',
+        '    if fileExt == ".py" and moduleName != "__init__":',
+        '        importlib.import_module("plugins." + moduleName).PluginClass()',
+    ])),
+    ('lazy', '\n'.join([
+        'import site_downloader',
+        'site_downloader.PluginManifest("plugins", "plugins").LoadPlugins()',
+    ])),
+])
+
+# Run the startup code for a mode in a new process, and return (run seconds, import
+# seconds, {module: cumulative import seconds}).
+def RunStartup(mode):
+    # Bytecode is written on the warm-up run, so that later runs don't compile anything.
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    startTime = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', STARTUP_CODE[mode]], cwd=ROOT_DIR, env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    runSeconds = time.perf_counter() - startTime
+
+    # Lines look like "import time:  self [us] | cumulative | <indent>module", where
+    # modules that are imported by other modules are indented.
+    importSeconds = 0.0
+    moduleTimes = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or line.endswith('package'):
+            continue
+        selfTime, cumulativeTime, moduleName = line[len('import time:'):].split('|')
+        seconds = int(cumulativeTime) / 1e6
+        moduleTimes[moduleName.strip()] = seconds
+        if not moduleName[1:].startswith(' '):
+            importSeconds += seconds
+    return runSeconds, importSeconds, moduleTimes
+
+def Median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main():
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--runs', type=int, default=10, help='Number of runs of each mode')
+    argParser.add_argument('--top', type=int, default=8, help='Number of the slowest imports to show')
+    args = argParser.parse_args()
+
+    results = collections.OrderedDict()
+    for mode in STARTUP_CODE:
+        RunStartup(mode)
+        results[mode] = [RunStartup(mode) for i in range(args.runs)]
+
+    print('{:<24} {:>12} {:>12}'.format('', 'imports (ms)', 'run (ms)'))
+    for mode, runs in results.items():
+        print('{:<24} {:>12.1f} {:>12.1f}'.format(mode, Median([run[1] for run in runs]) * 1000, Median([run[0] for run in runs]) * 1000))
+
+    pythonModuleNames = set(moduleName for run in results['python'] for moduleName in run[2])
+    for mode, runs in results.items():
+        moduleNames = set(moduleName for run in runs for moduleName in run[2]) - pythonModuleNames
+        if len(moduleNames) == 0:
+            continue
+        moduleTimes = dict((moduleName, Median([run[2].get(moduleName, 0.0) for run in runs])) for moduleName in moduleNames)
+
+        print()
+        print('{:<24} {:>12}'.format('slowest imports: ' + mode, 'total (ms)'))
+        for moduleName in sorted(moduleTimes, key=moduleTimes.get, reverse=True)[:args.top]:
+            print('{:<24} {:>12.1f}'.format(moduleName, moduleTimes[moduleName] * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# Benchmark of the memory that queued URL items take. Makes the items that a crawl of
+# many thread pages would find (a page item for each page, and an item for each image on
+# it, made the way VBulletinForumProcessor makes them), both with UrlInfo and with the
+# way UrlInfo used to be (a plain object with its own copy of every field), and reports
+# the bytes per item, as traced by tracemalloc. Also reports the bytes per item for
+# making UrlInfo items and queueing them in a SiteDownloader, which keeps an index
+# entry for each.
+#
+# Usage: python benchmarks/url_info_memory.py [--pages N] [--files-per-page N]
+
+from __future__ import print_function
+import os
+import sys
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from site_downloader import SiteDownloader, SiteDownloaderPlugin, UrlInfo, SetupLogger
+
+
+# The way UrlInfo used to be.
+class LegacyUrlInfo(object):
+    def __init__(self, plugin, category, displayName, url, fileSavePath, bFile, bKeepExisting=False, bReplaceExisting=False):
+        self.plugin = plugin
+        self.category = category
+        self.displayName = displayName
+        self.url = url
+        self.fileSavePath = fileSavePath
+        self.bFile = bFile
+        self.bKeepExisting = bKeepExisting
+        self.bReplaceExisting = bReplaceExisting
+
+def MakeUrlItems(urlInfoClass, plugin, pageNum, filesPerPage):
+    urlItems = []
+    for pageIndex in range(pageNum):
+        pageName = '{}-thread-{}'.format(1000 + pageIndex // 10, pageIndex % 10 + 1)
+        category = 'Forum {}'.format(pageIndex // 100)
+        urlItems.append(urlInfoClass(plugin=plugin, category=category, displayName=pageName,
+                                     url='http://forum.example.com/showthread.php?' + pageName, fileSavePath=pageName, bFile=False))
+
+        saveDirName = pageName + '_files'
+        for fileIndex in range(filesPerPage):
+            filename = 'image{}.jpg'.format(pageIndex * filesPerPage + fileIndex)
+            urlItems.append(urlInfoClass(plugin=plugin, category=category, displayName=filename,
+                                         url='http://forum.example.com/attachments/' + filename,
+                                         fileSavePath=os.path.join(saveDirName, filename), bFile=True))
+    return urlItems
+
+# Return the bytes per item for making the items.
+def MeasureMadeItems(urlInfoClass, plugin, pageNum, filesPerPage):
+    tracemalloc.start()
+    urlItems = MakeUrlItems(urlInfoClass, plugin, pageNum, filesPerPage)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / float(len(urlItems))
+
+# Return the bytes per item for making UrlInfo items and queueing them.
+def MeasureQueuedItems(plugin, pageNum, filesPerPage):
+    rootDir = tempfile.mkdtemp(prefix='url_info_memory_')
+    try:
+        dl = SiteDownloader(rootDir=rootDir)
+        tracemalloc.start()
+        dl.QueueUrlItems(MakeUrlItems(UrlInfo, plugin, pageNum, filesPerPage), False)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return size / float(len(dl.urlIndex))
+    finally:
+        shutil.rmtree(rootDir, ignore_errors=True)
+
+def main():
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--pages', type=int, default=2000, help='Number of thread pages')
+    argParser.add_argument('--files-per-page', type=int, default=50, help='Number of images on each page')
+    args = argParser.parse_args()
+
+    SetupLogger(level='warning')
+    plugin = SiteDownloaderPlugin()
+
+    print('{} items'.format(args.pages * (args.files_per_page + 1)))
+    print('{:<24} {:>12}'.format('', 'bytes/item'))
+    print('{:<24} {:>12.1f}'.format('legacy', MeasureMadeItems(LegacyUrlInfo, plugin, args.pages, args.files_per_page)))
+    print('{:<24} {:>12.1f}'.format('UrlInfo', MeasureMadeItems(UrlInfo, plugin, args.pages, args.files_per_page)))
+    print('{:<24} {:>12.1f}'.format('UrlInfo, queued', MeasureQueuedItems(plugin, args.pages, args.files_per_page)))
+
+if __name__ == '__main__':
+    main()
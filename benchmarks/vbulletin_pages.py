@@ -0,0 +1,107 @@
+# Synthetic vBulletin 4 thread pages, for benchmarks. The markup follows the structure
+# of real vBulletin thread pages (page navigation, post list, avatars, quotes, smilies,
+# signatures, inline background images and stylesheets), with enough posts to be about
+# the size of a real page.
+
+POST_TEMPLATE = '''
+<li class="postbitlegacy postbitim postcontainer old" id="post_{postId}">
+  <div class="posthead">
+    <span class="postdate old"><span class="date">01-02-2015,&nbsp;<span class="time">10:{minute:02d} AM</span></span></span>
+    <span class="nodecontrols"><a name="post{postId}" href="showthread.php?{threadId}-{threadName}&amp;p={postId}#post{postId}" class="postcounter">#{postNum}</a></span>
+  </div>
+  <div class="postdetails">
+    <div class="userinfo">
+      <div class="username_container"><a class="username offline popupctrl" href="member.php?{userId}-user{userId}"><strong>user{userId}</strong></a></div>
+      <span class="usertitle">Senior Member</span>
+      <a class="postuseravatar" href="member.php?{userId}-user{userId}"><img src="customavatars/avatar{userId}_3.gif" alt="user{userId}'s Avatar" title="user{userId}'s Avatar" /></a>
+      <dl class="userinfo_extra"><dt>Join Date</dt><dd>Mar 2011</dd><dt>Posts</dt><dd>1,{postNum:03d}</dd></dl>
+    </div>
+    <div class="postbody">
+      <div class="postrow has_after_content">
+        <h2 class="title icon">Re: Thread {threadId}</h2>
+        <div class="content"><div id="post_message_{postId}"><blockquote class="postcontent restore">
+          {quote}Post {postNum} of the thread, with some <b>bold</b> and <i>italic</i> text and a smilie
+          <img src="images/smilies/smile.png" border="0" alt="" title="Smile" class="inlineimg" />.
+          Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor incididunt ut labore
+          et dolore magna aliqua. Ut enim ad minim veniam, quis nostrud exercitation ullamco laboris.
+          {attachments}{styledDiv}
+        </blockquote></div></div>
+      </div>
+      <div class="after_content"><blockquote class="signature restore"><div class="signaturecontainer">
+        Signature of user{userId} <img src="{externalUrl}sigs/sig{userId}.png" border="0" alt="" />
+        <a href="http://www.example.com/" target="_blank">my site</a>
+      </div></blockquote></div>
+    </div>
+  </div>
+</li>'''
+
+QUOTE_TEMPLATE = '''<div class="bbcode_container"><div class="bbcode_quote"><div class="quote_container">
+          <div class="bbcode_quote_container"></div><div class="bbcode_postedby"><img src="images/misc/quote_icon.png" alt="Quote" />
+          Originally Posted by <strong>user{userId}</strong></div>
+          <div class="message">Quoted text <img src="{externalUrl}pics/{postId}.jpg" border="0" alt="" /></div>
+          </div></div></div>
+          '''
+
+PAGE_TEMPLATE = '''<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" dir="ltr" lang="en" id="vbulletin_html">
+<head>
+  <meta http-equiv="Content-Type" content="text/html; charset=UTF-8" />
+  <base href="{baseUrl}" /><!--[if IE]></base><![endif]-->
+{cssLinks}  <link rel="shortcut icon" href="favicon.ico" />
+  <script type="text/javascript" src="clientscript/vbulletin_global.js?v=425"></script>
+  <title>Thread {threadId} - Page {page}</title>
+</head>
+<body>
+<div class="above_body"><div id="header" class="floatcontainer doc_header">
+  <div><a name="top" href="forum.php" class="logo-image"><img src="images/misc/vbulletin4_logo.png" alt="Forum" /></a></div>
+</div></div>
+<div class="body_wrapper">
+  <div id="pagetitle"><h1>Thread: <span class="threadtitle"><a href="showthread.php?{threadId}-{threadName}">Thread {threadId}</a></span></h1></div>
+  <div id="above_postlist" class="above_postlist">
+    <div id="pagination_top" class="pagination_top">
+      <form action="showthread.php" method="get" class="pagination popupmenu nohovermenu">
+        <span><a href="javascript://" class="popupctrl">Page {page} of {lastPage}</a></span>
+        <span class="selected"><a href="javascript://" title="Results 1 to {postNum} of {totalPostNum}">{page}</a></span>
+      </form>
+    </div>
+  </div>
+  <div id="postlist" class="postlist restrain">
+    <ol id="posts" class="posts" start="1">{posts}
+    </ol>
+  </div>
+</div>
+</body>
+</html>
+'''
+
+CSS_LINKS = [
+    'clientscript/vbulletin_css/style00001l/main-rollup.css?d=1425467421',
+    'css.php?styleid=1&amp;langid=1&amp;d=1425467421&amp;td=ltr&amp;sheet=showthread.css,postbit.css',
+]
+
+# Return the HTML for a page of a thread. Besides the avatar, smilie, quote and signature
+# images that each post has, posts can have imagesPerPost attachments, and styleNum of
+# them have inline background images (unless bStyles isn't set). The page links to
+# cssLinkNum stylesheets. Signature and quoted images come from externalUrl, as they
+# would from image hosts.
+def MakeThreadPage(page=1, lastPage=1, postNum=40, threadId=12345, threadName='test-thread', baseUrl='http://forum.example.com/', bStyles=True,
+                   imagesPerPost=0, styleNum=8, cssLinkNum=2, externalUrl='http://imgs.example.com/'):
+    posts = []
+    for i in range(postNum):
+        postId = threadId * 1000 + (page - 1) * postNum + i
+        userId = i % 17
+        quote = QUOTE_TEMPLATE.format(userId=(i + 3) % 17, postId=postId, externalUrl=externalUrl) if i % 3 == 0 else ''
+        attachments = ''.join('<img src="attachment.php?attachmentid={}{}&amp;d=1425467421" border="0" alt="" />'.format(postId, k)
+                              for k in range(imagesPerPost))
+        styledDiv = '<div style="background-image:url(\'images/backgrounds/bg{}.gif\')">styled</div>'.format(i % 4) if bStyles and i < styleNum else ''
+        posts.append(POST_TEMPLATE.format(postId=postId, postNum=(page - 1) * postNum + i + 1, threadId=threadId, threadName=threadName,
+                                          userId=userId, minute=i % 60, quote=quote, attachments=attachments, styledDiv=styledDiv,
+                                          externalUrl=externalUrl))
+
+    cssLinks = []
+    for i in range(cssLinkNum):
+        href = CSS_LINKS[i] if i < len(CSS_LINKS) else 'css.php?styleid=1&amp;sheet=extra{}.css'.format(i)
+        cssLinks.append('  <link rel="stylesheet" type="text/css" href="{}" />\n'.format(href))
+
+    return PAGE_TEMPLATE.format(baseUrl=baseUrl, threadId=threadId, threadName=threadName, page=page, lastPage=lastPage,
+                                postNum=postNum, totalPostNum=lastPage * postNum, posts=''.join(posts), cssLinks=''.join(cssLinks))
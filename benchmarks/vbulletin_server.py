@@ -0,0 +1,149 @@
+# Local HTTP server which stands in for a vBulletin forum, for benchmarks. It serves
+# thread pages from vbulletin_pages for any "showthread.php?<id>-<name>[/page<n>]" URL,
+# and made-up files of a fixed size for any other URL, and can add latency and errors to
+# its responses.
+#
+# Usage: python benchmarks/vbulletin_server.py [--port N] [options]
+#
+# Benchmarks normally start it in a separate process with StartServer().
+
+from __future__ import print_function
+import re
+import time
+import random
+import hashlib
+import argparse
+import multiprocessing
+
+try:   # Python 3
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:   # Python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+from vbulletin_pages import MakeThreadPage
+
+
+class ServerSettings(object):
+    def __init__(self, pageNum=10, postNum=40, imagesPerPost=0, styleNum=8, cssLinkNum=2, fileSize=16 * 1024,
+                 latency=0.0, latencyJitter=0.0, errorRate=0.0, errorStatus=503):
+        self.pageNum = pageNum
+        self.postNum = postNum
+        self.imagesPerPost = imagesPerPost
+        self.styleNum = styleNum
+        self.cssLinkNum = cssLinkNum
+        self.fileSize = fileSize
+        # Seconds to wait before each response, plus a random amount up to latencyJitter.
+        self.latency = latency
+        self.latencyJitter = latencyJitter
+        # Fraction of requests that fail, with errorStatus, or by dropping the connection
+        # if errorStatus is 0.
+        self.errorRate = errorRate
+        self.errorStatus = errorStatus
+
+    def AddArguments(argParser):
+        argParser.add_argument('--pages', type=int, default=10, help='Pages per thread')
+        argParser.add_argument('--posts', type=int, default=40, help='Posts per page')
+        argParser.add_argument('--images-per-post', type=int, default=0, help='Attached images per post, besides avatars etc.')
+        argParser.add_argument('--styles', type=int, default=8, help='Posts per page with inline background images')
+        argParser.add_argument('--css-links', type=int, default=2, help='Stylesheets per page')
+        argParser.add_argument('--file-size', type=int, default=16 * 1024, help='Size in bytes of images and other files')
+        argParser.add_argument('--latency', type=float, default=0.0, help='Milliseconds to wait before each response')
+        argParser.add_argument('--latency-jitter', type=float, default=0.0, help='Up to this many extra milliseconds of latency')
+        argParser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests that fail')
+        argParser.add_argument('--error-status', type=int, default=503, help='Status of failed requests, or 0 to drop the connection')
+    AddArguments = staticmethod(AddArguments)
+
+    def FromArguments(args):
+        return ServerSettings(pageNum=args.pages, postNum=args.posts, imagesPerPost=args.images_per_post, styleNum=args.styles,
+                              cssLinkNum=args.css_links, fileSize=args.file_size, latency=args.latency / 1000.0,
+                              latencyJitter=args.latency_jitter / 1000.0, errorRate=args.error_rate, errorStatus=args.error_status)
+    FromArguments = staticmethod(FromArguments)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class VBulletinRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    # Set by StartServer().
+    settings = None
+    # URL that thread pages use for signature and quoted images. A different host name
+    # for the same server, so that they count as a separate host.
+    externalUrl = None
+
+    THREAD_REGEX = re.compile(r'/showthread\.php\?(\d+)-([^/]*)(/page(\d+))?')
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        settings = self.settings
+
+        if settings.latency > 0 or settings.latencyJitter > 0:
+            time.sleep(settings.latency + random.uniform(0, settings.latencyJitter))
+
+        if settings.errorRate > 0 and random.random() < settings.errorRate:
+            if settings.errorStatus == 0:
+                self.close_connection = True
+                return
+            self.SendResponse(b'', 'text/plain', settings.errorStatus)
+            return
+
+        match = self.THREAD_REGEX.match(self.path)
+        if match:
+            page = int(match.group(4)) if match.group(4) is not None else 1
+            baseUrl = 'http://{}/'.format(self.headers.get('Host'))
+            html = MakeThreadPage(page=page, lastPage=settings.pageNum, postNum=settings.postNum, threadId=int(match.group(1)),
+                                  threadName=match.group(2), baseUrl=baseUrl, imagesPerPost=settings.imagesPerPost,
+                                  styleNum=settings.styleNum, cssLinkNum=settings.cssLinkNum, externalUrl=self.externalUrl)
+            self.SendResponse(html.encode('utf-8'), 'text/html; charset=UTF-8')
+        else:
+            # Different files get different contents.
+            digest = hashlib.sha256(self.path.encode('utf-8')).digest()
+            body = (digest * (settings.fileSize // len(digest) + 1))[:settings.fileSize]
+            self.SendResponse(body, 'application/octet-stream')
+
+    def SendResponse(self, body, contentType, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def RunServer(settings, port, portQueue=None):
+    server = ThreadingHTTPServer(('127.0.0.1', port), VBulletinRequestHandler)
+    port = server.server_address[1]
+
+    VBulletinRequestHandler.settings = settings
+    VBulletinRequestHandler.externalUrl = 'http://localhost:{}/'.format(port)
+
+    if portQueue is not None:
+        portQueue.put(port)
+    server.serve_forever()
+
+# Start the server in a separate process, so that it doesn't compete with the code
+# being benchmarked for the GIL. Returns (process, port).
+def StartServer(settings, port=0):
+    portQueue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=RunServer, args=(settings, port, portQueue))
+    process.daemon = True
+    process.start()
+    return process, portQueue.get()
+
+def main():
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--port', type=int, default=8080)
+    ServerSettings.AddArguments(argParser)
+    args = argParser.parse_args()
+
+    print('Serving on port', args.port)
+    RunServer(ServerSettings.FromArguments(args), args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+# Benchmark of the CPU cost of getting downloaded files and saved pages onto disk. Files
+# are downloaded from a local synthetic vBulletin server (see vbulletin_server.py), both
+# with DownloadThread.DownloadFile() and with the way it used to write them (reading the
+# response in 1 KB chunks, checking the directory on every file, and getting the size
+# of the finished file from the filesystem). Pages are saved both with SavePage() and
+# by serializing the whole page to a string first, as it used to. Reports CPU seconds
+# per MB written, and for pages, the peak memory used while saving.
+#
+# Usage: python benchmarks/write_path.py [--files N] [--file-size BYTES] [--pages N] [--posts N]
+
+from __future__ import print_function
+import os
+import io
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import tracemalloc
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from site_downloader import DownloadThread, DirectoryOutput, UrlInfo, SavePage, SetupLogger, ToStr, g_sessionPool, g_soupParser
+from bs4 import BeautifulSoup
+from vbulletin_server import ServerSettings, StartServer
+from vbulletin_pages import MakeThreadPage
+
+
+# The way DownloadFile() wrote files before.
+def LegacyDownloadFile(fileUrl, savePath):
+    r = g_sessionPool.GetSession(fileUrl).get(fileUrl, stream=True)
+    try:
+        fileSize = int(r.headers['Content-Length'])
+        dirPath = os.path.dirname(savePath)
+        try:
+            os.makedirs(dirPath)
+        except OSError:
+            if not os.path.isdir(dirPath):
+                raise
+
+        partPath = savePath + '.part'
+        with open(partPath, 'wb') as outFile:
+            for chunk in r.iter_content(chunk_size=1024):
+                if chunk:
+                    outFile.write(chunk)
+
+        if os.path.getsize(partPath) != fileSize:
+            raise Exception('File size mismatch')
+        os.rename(partPath, savePath)
+    finally:
+        r.close()
+
+def NewDownloadFile(fileUrl, savePath):
+    DownloadThread(fileUrl, None, DirectoryOutput(os.path.dirname(savePath))).DownloadFile(fileUrl, os.path.basename(savePath))
+
+# Download the files with downloadFunc, and return the CPU seconds it took.
+def TimeDownloads(downloadFunc, port, fileNum, rootDir, name):
+    startTime = time.process_time()
+    for i in range(fileNum):
+        fileUrl = 'http://127.0.0.1:{}/{}/file{}.bin'.format(port, name, i)
+        downloadFunc(fileUrl, os.path.join(rootDir, name, 'files', 'file{}.bin'.format(i)))
+    return time.process_time() - startTime
+
+# The way SavePage() wrote pages before.
+def LegacySavePage(output, urlInfo, soup, pageFilePath):
+    pageSavePath = os.path.join(output.rootDir, pageFilePath)
+    html = ToStr(soup)
+    with io.open(pageSavePath, 'w', encoding='utf-8') as outFile:
+        outFile.write(html)
+
+# Save the pages with saveFunc, and return (CPU seconds, peak bytes allocated). Memory
+# is traced in a separate pass, since tracing slows everything down.
+def TimePageSaves(saveFunc, soups, rootDir, name):
+    os.makedirs(os.path.join(rootDir, name))
+    output = DirectoryOutput(rootDir)
+    urlInfo = UrlInfo(None, None, None, 'http://forum.example.com/', None, False, bReplaceExisting=True)
+
+    startTime = time.process_time()
+    for i, soup in enumerate(soups):
+        saveFunc(output, urlInfo, soup, os.path.join(name, 'page{}.html'.format(i)))
+    cpuTime = time.process_time() - startTime
+
+    peakSize = 0
+    for i, soup in enumerate(soups):
+        tracemalloc.start()
+        saveFunc(output, urlInfo, soup, os.path.join(name, 'page{}.html'.format(i)))
+        peakSize = max(peakSize, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return cpuTime, peakSize
+
+def GetDirSize(dirPath):
+    return sum(os.path.getsize(os.path.join(path, fileName)) for path, dirNames, fileNames in os.walk(dirPath) for fileName in fileNames)
+
+def main():
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument('--files', type=int, default=20, help='Number of files to download')
+    argParser.add_argument('--file-size', type=int, default=8 * 1024 * 1024, help='Size in bytes of each file')
+    argParser.add_argument('--pages', type=int, default=20, help='Number of pages to save')
+    argParser.add_argument('--posts', type=int, default=200, help='Posts per page')
+    args = argParser.parse_args()
+
+    SetupLogger(level='warning')
+
+    rootDir = tempfile.mkdtemp(prefix='write_path_')
+    serverProcess, port = StartServer(ServerSettings(fileSize=args.file_size))
+    try:
+        print('{:<24} {:>12} {:>12}'.format('files', 'CPU s', 'CPU ms/MB'))
+        for name, downloadFunc in [('legacy', LegacyDownloadFile), ('new', NewDownloadFile)]:
+            cpuTime = TimeDownloads(downloadFunc, port, args.files, rootDir, name)
+            megabytes = GetDirSize(os.path.join(rootDir, name)) / (1024.0 * 1024.0)
+            print('{:<24} {:>12.3f} {:>12.3f}'.format(name, cpuTime, cpuTime * 1000 / megabytes))
+    finally:
+        serverProcess.terminate()
+        serverProcess.join()
+
+    try:
+        soups = [BeautifulSoup(MakeThreadPage(page=i + 1, lastPage=args.pages, postNum=args.posts), g_soupParser)
+                 for i in range(args.pages)]
+
+        print()
+        print('{:<24} {:>12} {:>12} {:>12}'.format('pages', 'CPU s', 'CPU ms/MB', 'peak MB'))
+        for name, saveFunc in [('legacy', LegacySavePage), ('new', SavePage)]:
+            cpuTime, peakSize = TimePageSaves(saveFunc, soups, rootDir, 'pages_' + name)
+            megabytes = GetDirSize(os.path.join(rootDir, 'pages_' + name)) / (1024.0 * 1024.0)
+            print('{:<24} {:>12.3f} {:>12.3f} {:>12.2f}'.format(name, cpuTime, cpuTime * 1000 / megabytes, peakSize / (1024.0 * 1024.0)))
+    finally:
+        shutil.rmtree(rootDir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
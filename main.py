@@ -43,14 +43,111 @@ import sys
 import datetime
 import argparse
 import configparser
-from site_downloader import SiteDownloader, LogDebug, LogError, PageDetailsError, SetupError, HTTPConnectError, HTTPRequestError, PROGRAM_NAME, SetUserAgent
+from site_downloader import SiteDownloader, SetupLogger, LogDebug, LogInfo, LogError, PageDetailsError, SetupError, HTTPConnectError, HTTPRequestError, PROGRAM_NAME, SetUserAgent, CreateFrontier, GetPluginId, PluginManifest, g_sessionPool, g_parallelDownloadHandler, g_responseCache
 
 PLUGIN_DIR = 'plugins'
+HOST_SECTION_PREFIX = 'host:'
+PLUGIN_SECTION_PREFIX = 'plugin:'
 
-def main(bSpeedTest=False):
+# Return the value of a setting from the program's section of settings.ini.
+def GetSetting(config, key, default=None):
+    try:
+        return config[PROGRAM_NAME][key]
+    except KeyError:
+        return default
+
+def GetBoolSetting(config, key, default=False):
+    value = GetSetting(config, key)
+    if value is None:
+        return default
+    return value.lower() in ['1', 'yes', 'true', 'on']
+
+# Return a dict of {domain: section} for the per-host sections of settings.ini, which
+# look like "[host:forum.example.com]". The domain should be given in the same form that
+# GetDomain() returns, i.e. without any "www." prefix.
+def GetHostSettings(config):
+    hostSettings = {}
+    for sectionName in config.sections():
+        if sectionName.startswith(HOST_SECTION_PREFIX):
+            hostSettings[sectionName[len(HOST_SECTION_PREFIX):]] = config[sectionName]
+    return hostSettings
+
+def GetIntSetting(config, key, default=None):
+    value = GetSetting(config, key)
+    if value is None:
+        return default
+
+    try:
+        return int(value)
+    except ValueError:
+        raise SetupError('Invalid ' + key + ' setting')
+
+def GetFloatSetting(config, key, default=None):
+    value = GetSetting(config, key)
+    if value is None:
+        return default
+
+    try:
+        return float(value)
+    except ValueError:
+        raise SetupError('Invalid ' + key + ' setting')
+
+# Set the per-host limits on how many items we work on at once and how often we make
+# requests.
+def ApplySchedulerSettings(config, scheduler):
+    scheduler.SetLimits(maxConnections=GetIntSetting(config, 'host_max_connections'),
+                        requestsPerSecond=GetFloatSetting(config, 'host_requests_per_second'))
+
+    for domain, section in GetHostSettings(config).items():
+        try:
+            maxConnections = int(section['max_connections']) if 'max_connections' in section else None
+            requestsPerSecond = float(section['requests_per_second']) if 'requests_per_second' in section else None
+        except ValueError:
+            raise SetupError('Invalid setting for host ' + domain)
+
+        if maxConnections is not None or requestsPerSecond is not None:
+            scheduler.SetHostLimits(domain, maxConnections=maxConnections, requestsPerSecond=requestsPerSecond)
+
+def ApplyConnectionSettings(config):
+    poolSize = GetIntSetting(config, 'pool_size')
+    if poolSize is not None:
+        g_sessionPool.SetDefaultPoolSize(poolSize)
+
+    g_parallelDownloadHandler.SetLimits(sizeThreshold=GetIntSetting(config, 'parallel_download_threshold'),
+                                        connectionsPerFile=GetIntSetting(config, 'parallel_download_connections'),
+                                        connectionsPerHost=GetIntSetting(config, 'max_range_connections'))
+
+    for domain, section in GetHostSettings(config).items():
+        try:
+            if 'pool_size' in section:
+                g_sessionPool.SetHostPoolSize(domain, int(section['pool_size']))
+            if 'max_range_connections' in section:
+                g_parallelDownloadHandler.SetHostConnectionLimit(domain, int(section['max_range_connections']))
+        except ValueError:
+            raise SetupError('Invalid setting for host ' + domain)
+
+# Yield the URLs in a URL list file, one per line, skipping blank lines and comments
+# (lines starting with #).
+def ReadUrlList(inFile):
+    for line in inFile:
+        url = line.strip()
+        if len(url) > 0 and not url.startswith('#'):
+            yield url
+
+def ApplyLogSettings(config):
+    logFilePath = GetSetting(config, 'log_file', 'output.log')
+    SetupLogger(level=GetSetting(config, 'log_level', 'info'), logFilePath=logFilePath if len(logFilePath) > 0 else None,
+                bConsole=GetBoolSetting(config, 'log_console', True))
+
+def ApplyCacheSettings(config):
+    g_responseCache.SetLimits(maxBytes=GetIntSetting(config, 'response_cache_size'),
+                              maxAge=GetFloatSetting(config, 'response_cache_max_age'),
+                              bCacheSoups=GetBoolSetting(config, 'cache_parsed_pages', g_responseCache.bCacheSoups))
+
+def main(config, bSpeedTest=False):
     argParser = argparse.ArgumentParser()
     argParser.add_argument('root', help='Root directory to store downloaded files')
-    argParser.add_argument('file_with_urls', help='Text file containing URLs to download')
+    argParser.add_argument('file_with_urls', help='Text file containing URLs to download, or - to read them from stdin')
     args = argParser.parse_args()
 
     rootDir = args.root
@@ -58,53 +155,81 @@ def main(bSpeedTest=False):
             raise SetupError('Invalid root dir: "' + rootDir + '"')
 
     inFilePath = args.file_with_urls
-    if not os.path.isfile(inFilePath):
+    if inFilePath != '-' and not os.path.isfile(inFilePath):
         raise SetupError('URL list file doesn\'t exist: "' + inFilePath + '"')
 
-    dl = SiteDownloader(rootDir=rootDir, bSingleThread=False)
+    ApplyConnectionSettings(config)
+    ApplyCacheSettings(config)
+
+    frontier = CreateFrontier(GetSetting(config, 'crawl_order', 'depth_first'))
+
+    dl = SiteDownloader(rootDir=rootDir, bSingleThread=False, frontier=frontier,
+                        workerThreadNum=GetIntSetting(config, 'worker_threads', SiteDownloader.MAX_WORKER_THREADS))
+    ApplySchedulerSettings(config, dl.scheduler)
+
+    parseProcessNum = GetIntSetting(config, 'parse_processes', 0)
+    if parseProcessNum > 0:
+        dl.EnableParseProcesses(parseProcessNum)
 
     if not os.path.isdir(PLUGIN_DIR):
         raise SetupError("Couldn't find '" + PLUGIN_DIR + "' directory")
 
-    for fileName in os.listdir(PLUGIN_DIR):
-        moduleName, fileExt = os.path.splitext(fileName)
-        if fileExt == '.py' and moduleName != '__init__':
-            try:
-                moduleFullName = PLUGIN_DIR + '.' + moduleName
-                __import__(moduleFullName)
-                module = sys.modules[moduleFullName]
-                dl.plugins.append(module.PluginClass())
-            except (ImportError, KeyError, AttributeError):
-                raise SetupError('Unable to import plugin module: ' + moduleName)
+    # Plugin modules are only imported once they're needed, going by the plugin
+    # manifest, which is updated here if any of them have changed.
+    for plugin in PluginManifest(PLUGIN_DIR, PLUGIN_DIR).LoadPlugins():
+        dl.AddPlugin(plugin)
 
     if len(dl.plugins) == 0:
         raise SetupError("Couldn't find any plugins to load")
 
-    LogDebug('Processing URL list')
+    # Plugin settings go in sections like "[plugin:vBulletin]".
+    for plugin in dl.plugins:
+        sectionName = PLUGIN_SECTION_PREFIX + GetPluginId(plugin)
+        if config.has_section(sectionName):
+            plugin.ApplySettings(config[sectionName])
 
-    urlList = []
+    seenSetBackend = GetSetting(config, 'seen_set')
+    if seenSetBackend is not None:
+        dl.SetSeenSetBackend(seenSetBackend, GetIntSetting(config, 'seen_set_expected_urls'))
 
-    with open(inFilePath, 'r') as inFile:
-        for line in inFile:
-            url = line.rstrip()
-            urlList.append(url)
+    outputBackend = GetSetting(config, 'output')
+    if outputBackend is not None:
+        dl.SetOutputBackend(outputBackend, maxArchiveSize=GetIntSetting(config, 'warc_max_size'),
+                            bCompress=GetBoolSetting(config, 'warc_compress'))
 
-    dl.AddUrls(urlList)
+    if GetBoolSetting(config, 'asset_store'):
+        dl.EnableAssetStore()
 
-    dl.RunMainThread()
+    if GetBoolSetting(config, 'journal'):
+        dl.OpenJournal()
+
+    metricsPath = GetSetting(config, 'metrics_file')
+    if metricsPath is not None:
+        dl.EnableMetricsDump(metricsPath, GetFloatSetting(config, 'metrics_interval', 60))
+
+    LogDebug('Processing URL list')
+
+    # The URLs are read as they're needed, so the list can be as long as we like.
+    if inFilePath == '-':
+        dl.AddUrlSource(ReadUrlList(sys.stdin))
+        dl.RunMainThread()
+    else:
+        with open(inFilePath, 'r') as inFile:
+            dl.AddUrlSource(ReadUrlList(inFile))
+            dl.RunMainThread()
 
 if __name__ == '__main__':
     try:
         config = configparser.ConfigParser()
         config.read('settings.ini')
-        try:
-            SetUserAgent(config[PROGRAM_NAME]['user_agent'])
-        except (configparser.MissingSectionHeaderError, KeyError):
-            pass
+        ApplyLogSettings(config)
+        userAgent = GetSetting(config, 'user_agent')
+        if userAgent is not None:
+            SetUserAgent(userAgent)
 
         bSpeedTest = '--test' in sys.argv
         startTime = datetime.datetime.now()
-        main(bSpeedTest=bSpeedTest)
+        main(config, bSpeedTest=bSpeedTest)
         endTime = datetime.datetime.now()
 
         if bSpeedTest:
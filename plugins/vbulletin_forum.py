@@ -2,20 +2,42 @@
 
 import os
 import sys
-import datetime
+import time
 import re
+import hashlib
+import itertools
+from bs4 import Tag
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from site_downloader import SiteDownloader, SiteDownloaderPlugin, SPEED_TEST, LogDebug, LogError, PageDetailsError, HTTPError, urljoin, UrlInfo
+from site_downloader import SiteDownloader, SiteDownloaderPlugin, LogDebug, LogInfo, LogWarning, LogError, PageDetailsError, HTTPError, HTTPRequestError, urljoin, UrlInfo, CanonicalUrl, SoupStrainer, g_metrics, g_responseCache
 
 class VBulletinForumProcessor(SiteDownloaderPlugin):
-    def __init__(self, bDownloadFiles=True, bChangeFilePaths=True):
+    bSplitProcessing = True
+    urlPatterns = [('*', r'.*/showthread\.php\?', 100)]
+
+    PAGE_RANGE_REGEX = re.compile(r'Page (\d+) of (\d+)')
+    # Parses just the page navigation tags, for when we only need the page range.
+    PAGE_RANGE_STRAINER = SoupStrainer('a', {'class': re.compile(r'(^|\s)popupctrl(\s|$)')})
+    BACKGROUND_IMAGE_REGEX = re.compile(r'background-image\w*:url\([\'"]?([^\'"]*)[\'"]?\)')
+    # Matches the save paths of thread pages and their files, with the part that's the
+    # same for every page of a thread.
+    THREAD_SAVE_PATH_REGEX = re.compile(r'^(\d+-.*)-\d+(\.html|_files[\\/].*)?$')
+
+    # In incremental mode, for threads we've downloaded before, we only download the
+    # pages that have appeared since, along with the previous last page (which may have
+    # gained posts since).
+    def __init__(self, bDownloadFiles=True, bChangeFilePaths=True, bIncremental=False):
         self.bDownloadFiles = bDownloadFiles
         self.bChangeFilePaths = bChangeFilePaths
+        self.bIncremental = bIncremental
 
     def ProcessorName(self):
         return 'vBulletin'
 
+    def ApplySettings(self, settings):
+        if 'incremental' in settings:
+            self.bIncremental = settings['incremental'].lower() in ['1', 'yes', 'true', 'on']
+
     def GetPageRelevance(self, url):
         return (100 if url.find('/showthread.php?') != -1 else 0)
 
@@ -26,6 +48,94 @@ class VBulletinForumProcessor(SiteDownloaderPlugin):
     def GetPageCategory(self, url, soup):
         return ''
 
+    # Return the key under which we store what we know about the thread that a page URL
+    # belongs to, or None if the URL isn't a thread URL.
+    def GetThreadStateKey(self, url):
+        match = re.search(r'(.*/showthread.php\?)(\d+)', url)
+        if not match:
+            return None
+        return 'thread:' + CanonicalUrl(match.group(1) + match.group(2))
+
+    # Each thread gets its own archive.
+    def GetArchiveName(self, savePath):
+        match = self.THREAD_SAVE_PATH_REGEX.match(savePath)
+        return match.group(1) if match else None
+
+    def GetPageFilename(self, usableMainName, category, page):
+        if category is not None and len(category) > 0:
+            return '{}-{}-{}'.format(usableMainName, category, page)
+        else:
+            return '{}-{}'.format(usableMainName, page)
+
+    # Return (page, lastPage) from the page navigation tag in a thread page's soup, or
+    # None if the tag isn't there. This tag format only exists on desktop browsers, but
+    # that's fine, this will never be run in mobile.
+    def FindPageRange(self, soup):
+        for pageRangeTag in soup.findAll('a', {'class': 'popupctrl'}):
+            pageRange = self.ParsePageRangeTag(pageRangeTag)
+            if pageRange is not None:
+                return pageRange
+        return None
+
+    # Like FindPageRange(), but for (tagName, attrs, text) tags from IterTags().
+    def FindPageRangeInTags(self, tags):
+        for tagName, attrs, text in tags:
+            if tagName == 'a' and 'popupctrl' in attrs.get('class', '').split() and text is not None:
+                match = self.PAGE_RANGE_REGEX.match(text)
+                if match:
+                    return int(match.group(1)), int(match.group(2))
+        return None
+
+    # Return (page, lastPage) from a page navigation tag, or None if it doesn't have them.
+    def ParsePageRangeTag(self, pageRangeTag):
+        if pageRangeTag.string is None:
+            return None
+
+        match = self.PAGE_RANGE_REGEX.match(pageRangeTag.string)
+        if match:
+            return int(match.group(1)), int(match.group(2))
+        return None
+
+    # Remember how far a thread goes, and how to tell if its last page has changed.
+    def SaveThreadState(self, url, lastPage, r):
+        threadStateKey = self.GetThreadStateKey(url)
+        if threadStateKey is None:
+            return
+
+        self.SetState(threadStateKey, {
+            'lastPage': lastPage,
+            'etag': r.headers.get('ETag'),
+            'lastModified': r.headers.get('Last-Modified'),
+            'contentHash': hashlib.sha1(r.content).hexdigest(),
+        })
+
+    # For a thread we've downloaded before, check whether its last page has changed
+    # since, using a conditional GET where the server supports it. Returns
+    # (firstPage, lastPage) for the range of pages we need to download again, or None if
+    # the thread hasn't changed.
+    def GetChangedPageRange(self, threadState, lastPageUrl):
+        headers = {}
+        if threadState.get('etag') is not None:
+            headers['If-None-Match'] = threadState['etag']
+        if threadState.get('lastModified') is not None:
+            headers['If-Modified-Since'] = threadState['lastModified']
+
+        r = self.GetPage(lastPageUrl, headers=headers, bConditional=True)
+        if r.status_code == 304 or hashlib.sha1(r.content).hexdigest() == threadState.get('contentHash'):
+            return None
+
+        # The page gets queued with this URL, so processing it will use this response
+        # rather than downloading the page again.
+        g_responseCache.AddResponse(lastPageUrl, r)
+
+        prevLastPage = threadState['lastPage']
+        pageRange = self.FindPageRange(self.GetSoup(r.text, self.PAGE_RANGE_STRAINER))
+        if pageRange is None:
+            LogWarning('Warning: For URL: ' + lastPageUrl + "\nCouldn't find last page tag")
+            return (prevLastPage, prevLastPage)
+
+        return (prevLastPage, max(prevLastPage, pageRange[1]))
+
     def ProcessUserAddedUrl(self, url):
         newUrlItems = []
 
@@ -53,52 +163,89 @@ class VBulletinForumProcessor(SiteDownloaderPlugin):
         if len(mainName) == 0 or usableMainName != mainName:
             raise PageDetailsError('Failed to parse main page name')
 
-        startTime = datetime.datetime.now()
-        soup = self.GetSoup(self.GetPage(url).text)
-        endTime = datetime.datetime.now()
-
-        if SPEED_TEST:
-            LogDebug('Soup initial', (endTime - startTime).total_seconds(), 'seconds')
-
-        category = self.GetPageCategory(url, soup)
-
-        # Find out the range of pages that exist for this forum thread.
-
-        bFoundLastPageTag = False
-
-        # This tag format only exists on desktop browsers, but that's fine, this will
-        # never be run in mobile.
-        for lastPageTag in soup.findAll('a', {'class': 'popupctrl'}):
-            if lastPageTag.string is None:
-                continue
-
-            match = re.match('Page 1 of (\d+)', lastPageTag.string)
-            if match:
-                lastPage = int(match.group(1))
-                bFoundLastPageTag = True
-                break
+        def GetPageUrl(page):
+            return '{}{}{}/page{}'.format(urlIntro, preMainName, mainName, page)
+
+        # Note that GetPageCategory() doesn't currently use the soup, so incremental
+        # downloads don't need to parse the first page to get the category.
+        category = None
+        firstPage = 1
+        lastPage = None
+        # Pages from this one on will already have been saved, and are replaced.
+        firstReplacedPage = None
+
+        threadState = self.GetState(self.GetThreadStateKey(url)) if self.bIncremental else None
+        if threadState is not None:
+            firstReplacedPage = threadState['lastPage']
+            try:
+                pageRange = self.GetChangedPageRange(threadState, GetPageUrl(threadState['lastPage']))
+            except HTTPRequestError:
+                LogWarning('Warning: For URL: ' + url + "\nCouldn't get previous last page, downloading whole thread")
+                pageRange = (1, None)
+                firstReplacedPage = 1
+
+            if pageRange is None:
+                LogInfo('Thread unchanged since last download:', url)
+                return []
+
+            firstPage, lastPage = pageRange
+            category = self.GetPageCategory(url, None)
+
+        if lastPage is None:
+            # Note that we get the page with the same URL that we queue it with, so that
+            # processing it later gets the response from the response cache.
+            page = int(pageInfo[len('/page'):]) if len(pageInfo) > 0 else 1
+            soup = self.GetPageSoup(GetPageUrl(page), self.PAGE_RANGE_STRAINER, bWillChange=False)[1]
+
+            category = self.GetPageCategory(url, soup)
+
+            # Find out the range of pages that exist for this forum thread.
+
+            pageRange = self.FindPageRange(soup)
+            if pageRange is not None:
+                lastPage = pageRange[1]
+            else:
+                LogWarning('Warning: For URL: ' + url + "\nCouldn't find last page tag")
+                lastPage = 1
 
-        if not bFoundLastPageTag:
-            LogWarning('Warning: For URL: ' + url + "\nCouldn't find last page tag")
-            lastPage = 1
+        # Pages that are only downloaded, as files, don't go through FetchUrlInfo(), so
+        # we remember the thread's last page here. This costs a request, unless the page
+        # is already in the response cache.
+        if self.bIncremental and not self.bDownloadFiles:
+            self.SaveThreadState(url, lastPage, self.GetPage(GetPageUrl(lastPage)))
 
         # Add the pages to the processing queue.
 
-        for page in range(1, lastPage + 1):
-            pageUrl = '{}{}{}/page{}'.format(urlIntro, preMainName, mainName, page)
+        for page in range(firstPage, lastPage + 1):
+            pageUrl = GetPageUrl(page)
+            pageFilename = self.GetPageFilename(usableMainName, category, page)
 
-            if category is not None and len(category) > 0:
-                pageFilename = '{}-{}-{}{}'.format(usableMainName, category, page)
-            else:
-                pageFilename = '{}-{}'.format(usableMainName, page)
+            bReplaceExisting = firstReplacedPage is not None and page >= firstReplacedPage
 
             bDownloadPageOnly = not self.bDownloadFiles
-            newUrlItems.append(UrlInfo(plugin=self, category=category, displayName=pageFilename, url=pageUrl, fileSavePath=pageFilename, bFile=bDownloadPageOnly))
+            newUrlItems.append(UrlInfo(plugin=self, category=category, displayName=pageFilename, url=pageUrl, fileSavePath=pageFilename,
+                                       bFile=bDownloadPageOnly, bReplaceExisting=bReplaceExisting))
 
         LogDebug('---------------------------')
         return newUrlItems
 
-    def ProcessUrlInfo(self, urlInfo):
+    def FetchUrlInfo(self, urlInfo):
+        fetchedPage = SiteDownloaderPlugin.FetchUrlInfo(self, urlInfo)
+
+        # If this is the thread's last page, remember it for incremental downloads. Note
+        # that threads with only one page have no page navigation tag.
+        if self.bIncremental:
+            pageRange = self.FindPageRangeInTags(self.IterTags(fetchedPage.text, ['a']))
+            if pageRange is not None and pageRange[0] == pageRange[1]:
+                self.SaveThreadState(urlInfo.url, pageRange[1], fetchedPage.r)
+            elif pageRange is None and urlInfo.url.endswith('/page1'):
+                self.SaveThreadState(urlInfo.url, 1, fetchedPage.r)
+
+        return fetchedPage
+
+    # Note that this may be run in a parse process, so it mustn't use the network or the
+    # plugin's state.
+    def ParseUrlInfo(self, urlInfo, fetchedPage):
         newUrls = set()
         newUrlItems = []
 
@@ -106,99 +253,72 @@ class VBulletinForumProcessor(SiteDownloaderPlugin):
 
         saveDirName = os.path.basename(urlInfo.fileSavePath) + '_files'
 
-        startTime = datetime.datetime.now()
-        soup = self.GetSoup(self.GetPage(url).text)
-        endTime = datetime.datetime.now()
-        if SPEED_TEST:
-            LogDebug('--page soup', (endTime - startTime).total_seconds(), 'seconds')
+        soup = fetchedPage.soup if fetchedPage.soup is not None else self.GetSoup(fetchedPage.text)
 
-        startTime = datetime.datetime.now()
+        startTime = time.perf_counter()
 
-        if self.bChangeFilePaths:
-            # We need to overwrite the base tag, or all relative paths will use it.
-            baseTag = soup.find('base')
-            if baseTag is not None:
-                if 'href' in baseTag.attrs:
-                    baseTag.attrs['href'] = '.'
+        # We find the files that the page uses, and change their paths to where we'll
+        # save them, in a single pass over the page's tags. The files are queued in the
+        # order we'd get from scanning images, then inline styles, then stylesheets.
+        # If we're downloading the page again, most of its files will already have been
+        # saved, so they're queued with bKeepExisting, which keeps the ones that exist.
+        imageItems = []
+        styleItems = []
+        linkItems = []
+        bFoundBaseTag = False
 
-        sectionStartTime = datetime.datetime.now()
+        for tag in soup.descendants:
+            if not isinstance(tag, Tag):
+                continue
 
-        for imageTag in soup.findAll('img'):
-            imageUrl = urljoin(url, imageTag['src'])
-            filename = self.UsableFilename(imageTag['src'].split('/')[-1])
-            imageSavePath = os.path.join(saveDirName, filename)
+            attrs = tag.attrs
 
-            if imageUrl not in newUrls:
-                newUrlInfo = UrlInfo(plugin=urlInfo.plugin, category=urlInfo.category, displayName=filename, url=imageUrl, fileSavePath=imageSavePath, bFile=True)
-                newUrlItems.append(newUrlInfo)
-                newUrls.add(imageUrl)
+            if tag.name == 'base' and not bFoundBaseTag:
+                bFoundBaseTag = True
+                if self.bChangeFilePaths:
+                    # We need to overwrite the base tag, or all relative paths will use it.
+                    if 'href' in attrs:
+                        attrs['href'] = '.'
 
-            if self.bChangeFilePaths:
-                if 'src' in imageTag.attrs:
-                    imageSaveRelPath = imageSavePath
-                    imageTag.attrs['src'] = imageSaveRelPath
+            elif tag.name == 'img' and 'src' in attrs:
+                imageUrl = urljoin(url, attrs['src'])
+                filename = self.UsableFilename(attrs['src'].split('/')[-1])
+                imageSavePath = os.path.join(saveDirName, filename)
+                imageItems.append(UrlInfo(plugin=urlInfo.plugin, category=urlInfo.category, displayName=filename, url=imageUrl, fileSavePath=imageSavePath, bFile=True, bKeepExisting=urlInfo.bReplaceExisting))
 
-        if SPEED_TEST:
-            LogDebug('---scanned images', (datetime.datetime.now() - sectionStartTime).total_seconds())
-        sectionStartTime = datetime.datetime.now()
+                if self.bChangeFilePaths:
+                    attrs['src'] = imageSavePath
 
-        for divTag in soup.findAll(style=True):
-            if divTag['style'].find('background-image') != -1:
-                style = divTag['style']
-                pattern = 'background-image\w*:url\([\'"]?([^\'"]*)[\'"]?\)'
+            elif tag.name == 'link' and attrs.get('type') == 'text/css' and 'href' in attrs:
+                linkUrl = urljoin(url, attrs['href'])
+                linkUrl = linkUrl.replace('&amp;', '&')
 
-                match = re.search(pattern, style)
+                filename = self.UsableFilename(attrs['href'].split('/')[-1])
+                linkSavePath = os.path.join(saveDirName, filename)
+                linkItems.append(UrlInfo(plugin=urlInfo.plugin, category=urlInfo.category, displayName=filename, url=linkUrl, fileSavePath=linkSavePath, bFile=True, bKeepExisting=urlInfo.bReplaceExisting))
+
+                if self.bChangeFilePaths:
+                    attrs['href'] = linkSavePath
+
+            style = attrs.get('style')
+            if style is not None and style.find('background-image') != -1:
+                match = self.BACKGROUND_IMAGE_REGEX.search(style)
                 if match:
-                    divUrl = match.group(1)
-                    divUrl = urljoin(url, divUrl)
+                    divUrl = urljoin(url, match.group(1))
                     filename = self.UsableFilename(divUrl.split('/')[-1])
                     divSavePath = os.path.join(saveDirName, filename)
-
-                    newUrls.append(UrlInfo(plugin=urlInfo.plugin, category=urlInfo.category, displayName=filename, url=divUrl, fileSavePath=divSavePath, bFile=True))
-
-                    if self.bChangeFilePaths:
-                        divSaveRelPath = os.path.join(saveDirName, filename)
-                        divSaveRelPath = divSaveRelPath.replace('\\', '\\\\')
-                        divTag['style'] = style[:match.start(1)] + divSaveRelPath + style[match.end(1):]
-
-        if SPEED_TEST:
-            LogDebug('---scanned divs', (datetime.datetime.now() - sectionStartTime).total_seconds())
-        sectionStartTime = datetime.datetime.now()
-
-        for linkTag in soup.findAll('link'):
-            bIsCSS = False
-            if 'type' in linkTag.attrs:
-                if linkTag.attrs['type'] == 'text/css':
-                    bIsCSS = True
-
-            if bIsCSS:
-                if 'href' in linkTag.attrs:
-                    linkUrl = urljoin(url, linkTag.attrs['href'])
-                    linkUrl = linkUrl.replace('&amp;', '&')
-
-                    filename = self.UsableFilename(linkTag.attrs['href'].split('/')[-1])
-                    linkSavePath = os.path.join(saveDirName, filename)
-
-                    if linkUrl not in newUrls:
-                        newUrlInfo = UrlInfo(plugin=urlInfo.plugin, category=urlInfo.category, displayName=filename, url=linkUrl, fileSavePath=linkSavePath, bFile=True)
-                        newUrlItems.append(newUrlInfo)
-                        newUrls.add(linkUrl)
+                    styleItems.append(UrlInfo(plugin=urlInfo.plugin, category=urlInfo.category, displayName=filename, url=divUrl, fileSavePath=divSavePath, bFile=True, bKeepExisting=urlInfo.bReplaceExisting))
 
                     if self.bChangeFilePaths:
-                        linkSaveRelPath = os.path.join(saveDirName, filename)
-                        linkTag.attrs['href'] = linkSaveRelPath
+                        divSaveRelPath = divSavePath.replace('\\', '\\\\')
+                        attrs['style'] = style[:match.start(1)] + divSaveRelPath + style[match.end(1):]
 
-        if SPEED_TEST:
-            LogDebug('---scanned links', (datetime.datetime.now() - sectionStartTime).total_seconds())
-        sectionStartTime = datetime.datetime.now()
-
-        if SPEED_TEST:
-            LogDebug('---outputting file', (datetime.datetime.now() - sectionStartTime).total_seconds())
+        for newUrlInfo in itertools.chain(imageItems, styleItems, linkItems):
+            if newUrlInfo.url not in newUrls:
+                newUrlItems.append(newUrlInfo)
+                newUrls.add(newUrlInfo.url)
 
-        endTime = datetime.datetime.now()
-        if SPEED_TEST:
-            pageScanTime = (endTime - startTime).total_seconds()
-            LogDebug('Page scan {:.3}'.format(pageScanTime), 'seconds')
+        g_metrics.Observe('rewrite', time.perf_counter() - startTime)
 
         return newUrlItems, soup, urlInfo.fileSavePath + '.html'
 
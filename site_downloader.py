@@ -5,27 +5,88 @@ import re
 import io
 import collections
 import datetime
-import bs4
-from bs4 import BeautifulSoup, SoupStrainer
-import requests
-from threading import Thread
+import json
+from threading import Thread, Lock, BoundedSemaphore, local
 import copy
+import shutil
+import hashlib
+import heapq
+import math
+import itertools
+import bisect
 import time
+import random
 import logging
+import logging.handlers
+import atexit
 import traceback
+import tempfile
+import zlib
+import importlib
+import importlib.util
+import weakref
+
+try:   # Python 3
+    import queue
+except ImportError:   # Python 2
+    import Queue as queue
+
+try:   # Python 3
+    from html.parser import HTMLParser
+except ImportError:   # Python 2
+    from HTMLParser import HTMLParser
 
 try:   # Python 3
-    from urllib.request import urlopen
     from urllib.parse import urljoin
     from urllib.error import HTTPError
 except ImportError:   # Python 2
-    from urllib import urlopen
     from urlparse import urljoin
 
     # Create dummy class to make exception handling easier.
     class HTTPError(Exception):
         pass
 
+# Stands in for a module that takes a while to import, and imports it (and the given
+# submodules) the first time one of its attributes is used. This way, a small crawl
+# only waits on the imports it ends up needing, and importing site_downloader (in
+# main.py, or in a parse process) is quick.
+class LazyModule(object):
+    def __init__(self, moduleName, submoduleNames=()):
+        self.moduleName = moduleName
+        self.submoduleNames = submoduleNames
+        self.module = None
+
+    def __getattr__(self, name):
+        return getattr(self.GetModule(), name)
+
+    def GetModule(self):
+        if self.module is None:
+            for submoduleName in self.submoduleNames:
+                importlib.import_module(submoduleName)
+            self.module = importlib.import_module(self.moduleName)
+        return self.module
+
+bs4 = LazyModule('bs4')
+requests = LazyModule('requests', ['requests.adapters'])
+concurrent = LazyModule('concurrent', ['concurrent.futures'])
+multiprocessing = LazyModule('multiprocessing')
+sqlite3 = LazyModule('sqlite3')
+tarfile = LazyModule('tarfile')
+uuid = LazyModule('uuid')
+
+# lxml is optional, so this is None if it isn't installed.
+if importlib.util.find_spec('lxml') is not None:
+    lxml = LazyModule('lxml', ['lxml.etree'])
+else:
+    lxml = None
+
+# BeautifulSoup and SoupStrainer can still be imported from here, as plugins do; they're
+# looked up in bs4 when they're first imported.
+def __getattr__(name):
+    if name in ['BeautifulSoup', 'SoupStrainer']:
+        return getattr(bs4, name)
+    raise AttributeError('module ' + repr(__name__) + ' has no attribute ' + repr(name))
+
 # Root exception class, not thrown directly.
 class SiteDownloaderError(Exception):
     pass
@@ -36,6 +97,9 @@ class SetupError(SiteDownloaderError):
     pass
 class HTTPConnectError(SiteDownloaderError):
     pass
+# We aren't making requests to a host for now, since too many of them failed.
+class HostUnavailableError(HTTPConnectError):
+    pass
 class HTTPRequestError(SiteDownloaderError):
     pass
 class PageDetailsError(SiteDownloaderError):
@@ -48,7 +112,6 @@ class WindowsDelayedWriteError(SiteDownloaderError):
     pass
 
 
-g_logger = None
 g_userAgent = 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/51.0.2704.103 Safari/537.36'
 
 PROGRAM_NAME = 'SiteDownloader'
@@ -56,35 +119,108 @@ SPEED_TEST = False
 SPEED_TEST_MAKES_FILES = True
 
 
-def SetupLogger():
-    global g_logger
-    g_logger = logging.getLogger(PROGRAM_NAME)
-    g_logger.setLevel(logging.DEBUG)
-
-    handler = logging.FileHandler('output.log')
-    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
-    g_logger.addHandler(handler)
-
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
-    g_logger.addHandler(handler)
+# Logging goes through a queue to a background thread (g_logListener), which does the
+# actual writing, so that threads which log never wait on the log file, a slow terminal,
+# or each other. The message for a LogInfo() etc. call is only put together from its
+# arguments in that thread, and only if the call's level is turned on. Until
+# SetupLogger() is called, only warnings and errors are shown, on stderr.
+g_logger = logging.getLogger(PROGRAM_NAME)
+g_logListener = None
+
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL,
+}
+
+# The arguments of a LogInfo() etc. call, which are joined into the message when it's
+# written. Note that this means arguments shouldn't be changed after they're logged.
+class LogMessage(object):
+    __slots__ = ['args']
+
+    def __init__(self, args):
+        self.args = args
+
+    def __str__(self):
+        return ' '.join([ToStr(arg) for arg in self.args])
+
+# Puts log records on the queue as they are, for g_logListener to format. The queue
+# doesn't leave the process, so unlike with QueueHandler, the records don't need to be
+# made picklable first.
+class LogQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+# Log messages at the given level (a logging level, or a name from LOG_LEVELS) and
+# above, to logFilePath if it's given, and to stdout if bConsole is set. This can be
+# called again to change how we log.
+def SetupLogger(level=logging.INFO, logFilePath=None, bConsole=True):
+    global g_logListener
+
+    if IsStr(level):
+        try:
+            level = LOG_LEVELS[level.lower()]
+        except KeyError:
+            raise SetupError('Invalid log level: ' + level)
+
+    handlers = []
+    if logFilePath is not None:
+        handler = logging.FileHandler(logFilePath)
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+        handlers.append(handler)
+
+    if bConsole:
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        handlers.append(handler)
+
+    logQueue = queue.Queue()
+    oldListener = g_logListener
+    g_logListener = logging.handlers.QueueListener(logQueue, *handlers)
+    g_logListener.start()
+
+    for handler in list(g_logger.handlers):
+        g_logger.removeHandler(handler)
+    g_logger.addHandler(LogQueueHandler(logQueue))
+    g_logger.setLevel(level)
+    g_logger.propagate = False
+
+    if oldListener is not None:
+        StopLogListener(oldListener)
+
+def StopLogListener(listener):
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
+
+# Write out the log messages that are still queued, and stop logging. This is done
+# automatically at exit.
+def StopLogger():
+    global g_logListener
+    if g_logListener is not None:
+        for handler in list(g_logger.handlers):
+            g_logger.removeHandler(handler)
+        StopLogListener(g_logListener)
+        g_logListener = None
+
+atexit.register(StopLogger)
 
 def LogDebug(*args):
-    g_logger.debug(' '.join([ToStr(arg) for arg in args]))
+    g_logger.debug(LogMessage(args))
 
 def LogInfo(*args):
-    g_logger.info(' '.join([ToStr(arg) for arg in args]))
+    g_logger.info(LogMessage(args))
 
 def LogWarning(*args):
-    g_logger.warning(' '.join([ToStr(arg) for arg in args]))
+    g_logger.warning(LogMessage(args))
 
 def LogError(*args):
-    g_logger.error(' '.join([ToStr(arg) for arg in args]))
+    g_logger.error(LogMessage(args))
 
 def LogCritical(*args):
-    g_logger.critical(' '.join([ToStr(arg) for arg in args]))
-
-SetupLogger()
+    g_logger.critical(LogMessage(args))
 
 def GetUserAgent():
     return g_userAgent
@@ -93,15 +229,147 @@ def SetUserAgent(userAgent):
     global g_userAgent
     g_userAgent = userAgent
 
-
-class UrlInfo(object):
-    def __init__(self, plugin, category, displayName, url, fileSavePath, bFile):
+# The parser that BeautifulSoup uses. lxml is much faster than Python's built-in parser,
+# so we use it if it's installed.
+if lxml is not None:
+    g_soupParser = 'lxml'
+else:
+    g_soupParser = 'html.parser'
+
+
+# Return (saveDir, fileName) for a save path, where saveDir is the part up to and
+# including the last path separator (or '' if there isn't one), or (None, None) if the
+# path is None.
+def SplitSavePath(fileSavePath):
+    if fileSavePath is None:
+        return None, None
+    splitPos = max(fileSavePath.rfind('/'), fileSavePath.rfind('\\')) + 1
+    return fileSavePath[:splitPos], fileSavePath[splitPos:]
+
+# The fields that the URL items from a page usually have in common: the plugin, the
+# category, the directory they're saved in (the part of fileSavePath up to and
+# including its last path separator), bFile, bKeepExisting and bReplaceExisting.
+# UrlInfo objects share these, through GetUrlInfoGroup(), rather than each holding its
+# own, which matters when millions of items are queued.
+class UrlInfoGroup(object):
+    __slots__ = ['plugin', 'category', 'saveDir', 'bFile', 'bKeepExisting', 'bReplaceExisting', '__weakref__']
+
+    def __init__(self, plugin, category, saveDir, bFile, bKeepExisting, bReplaceExisting):
         self.plugin = plugin
         self.category = category
-        self.displayName = displayName
-        self.url = url
-        self.fileSavePath = fileSavePath
+        self.saveDir = saveDir
         self.bFile = bFile
+        self.bKeepExisting = bKeepExisting
+        self.bReplaceExisting = bReplaceExisting
+
+g_urlInfoGroups = weakref.WeakValueDictionary()
+g_urlInfoGroupsLock = Lock()
+
+# Return the UrlInfoGroup with the given fields, which is shared by every UrlInfo that
+# has them. Groups are freed along with the last UrlInfo that uses them.
+def GetUrlInfoGroup(plugin, category, saveDir, bFile, bKeepExisting, bReplaceExisting):
+    key = (plugin, category, saveDir, bFile, bKeepExisting, bReplaceExisting)
+    try:
+        with g_urlInfoGroupsLock:
+            group = g_urlInfoGroups.get(key)
+            if group is None:
+                group = g_urlInfoGroups[key] = UrlInfoGroup(plugin, category, saveDir, bFile, bKeepExisting, bReplaceExisting)
+        return group
+    except TypeError:   # A field that can't be hashed, so the group can't be shared.
+        return UrlInfoGroup(plugin, category, saveDir, bFile, bKeepExisting, bReplaceExisting)
+
+# A URL for a plugin to process or download. Fields that URL items from the same page
+# have in common are kept in a shared UrlInfoGroup, and fileSavePath is split into the
+# group's saveDir and the item's own fileName; they can all still be read and set as
+# before. UrlInfo objects are equal if their URLs are.
+class UrlInfo(object):
+    __slots__ = ['group', 'displayName', 'url', 'fileName']
+
+    # Normally it's an error for something to already be saved at the save path. With
+    # bKeepExisting, what's there is kept, and the item is done without downloading
+    # anything, e.g. for the files of a page we're downloading again, which we take not
+    # to have changed. With bReplaceExisting, what's there is replaced, e.g. when
+    # downloading again a page that has changed since we last saved it.
+    def __init__(self, plugin, category, displayName, url, fileSavePath, bFile, bKeepExisting=False, bReplaceExisting=False):
+        saveDir, self.fileName = SplitSavePath(fileSavePath)
+        self.group = GetUrlInfoGroup(plugin, category, saveDir, bFile, bKeepExisting, bReplaceExisting)
+        # The display name is usually the file name, in which case we only keep one copy.
+        self.displayName = self.fileName if displayName == self.fileName else displayName
+        self.url = url
+
+    # This makes the groups of unpickled objects shared too.
+    def __reduce__(self):
+        return (UrlInfo, (self.plugin, self.category, self.displayName, self.url, self.fileSavePath, self.bFile, self.bKeepExisting,
+                          self.bReplaceExisting))
+
+    def __eq__(self, other):
+        return isinstance(other, UrlInfo) and self.url == other.url
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.url)
+
+    # Replace the group with one that has a field changed.
+    def SetGroupField(self, name, value):
+        fieldNames = ['plugin', 'category', 'saveDir', 'bFile', 'bKeepExisting', 'bReplaceExisting']
+        fields = dict((fieldName, getattr(self.group, fieldName)) for fieldName in fieldNames)
+        fields[name] = value
+        self.group = GetUrlInfoGroup(**fields)
+
+    @property
+    def plugin(self):
+        return self.group.plugin
+
+    @plugin.setter
+    def plugin(self, plugin):
+        self.SetGroupField('plugin', plugin)
+
+    @property
+    def category(self):
+        return self.group.category
+
+    @category.setter
+    def category(self, category):
+        self.SetGroupField('category', category)
+
+    @property
+    def bFile(self):
+        return self.group.bFile
+
+    @bFile.setter
+    def bFile(self, bFile):
+        self.SetGroupField('bFile', bFile)
+
+    @property
+    def bKeepExisting(self):
+        return self.group.bKeepExisting
+
+    @bKeepExisting.setter
+    def bKeepExisting(self, bKeepExisting):
+        self.SetGroupField('bKeepExisting', bKeepExisting)
+
+    @property
+    def bReplaceExisting(self):
+        return self.group.bReplaceExisting
+
+    @bReplaceExisting.setter
+    def bReplaceExisting(self, bReplaceExisting):
+        self.SetGroupField('bReplaceExisting', bReplaceExisting)
+
+    @property
+    def fileSavePath(self):
+        if self.fileName is None:
+            return None
+        return self.group.saveDir + self.fileName
+
+    @fileSavePath.setter
+    def fileSavePath(self, fileSavePath):
+        group = self.group
+        displayName = self.displayName
+        UrlInfo.__init__(self, group.plugin, group.category, displayName, self.url, fileSavePath, group.bFile, group.bKeepExisting,
+                         group.bReplaceExisting)
 
 def ToStr(obj):
     try:
@@ -143,184 +411,2268 @@ def GetDomain(url, bReturnEndPos=False):
     else:
         return domain
 
+# Return a canonical form of a URL, for telling whether two URLs refer to the same
+# thing. This ignores the scheme, any "www." prefix (as GetDomain() does), the case of
+# the domain, HTML-escaped ampersands, the fragment, and the order of query parameters.
+def CanonicalUrl(url):
+    url = url.replace('&amp;', '&')
+
+    hashPos = url.find('#')
+    if hashPos != -1:
+        url = url[:hashPos]
+
+    domain, domainEndPos = GetDomain(url, bReturnEndPos=True)
+    path = url[domainEndPos:]
+
+    # GetDomain() only looks for a slash after the domain.
+    questionMarkPos = domain.find('?')
+    if questionMarkPos != -1:
+        path = domain[questionMarkPos:] + path
+        domain = domain[:questionMarkPos]
+
+    questionMarkPos = path.find('?')
+    if questionMarkPos != -1:
+        params = [param for param in path[questionMarkPos + 1:].split('&') if len(param) > 0]
+        path = path[:questionMarkPos]
+        if len(params) > 0:
+            path += '?' + '&'.join(sorted(params))
+
+    if len(path) == 0 or path[0] == '?':
+        path = '/' + path
+
+    return domain.lower() + path
+
+# Directories that MakeDirs() has made or found, so that it doesn't have to ask the
+# filesystem about them again. This assumes that nothing else removes them while we
+# run.
+g_madeDirs = set()
+g_madeDirsLock = Lock()
+
+# Create a directory, along with any missing parent directories, unless it already
+# exists. Other threads may be creating the same directory at the same time.
+def MakeDirs(dirPath):
+    if dirPath in g_madeDirs:
+        return
+
+    try:
+        os.makedirs(dirPath)
+    except OSError:
+        if not os.path.isdir(dirPath):
+            raise
+
+    with g_madeDirsLock:
+        g_madeDirs.add(dirPath)
+
+# Allocate the space for a file of the given size on disk up front, if the OS lets us,
+# so that the file isn't written in fragments. Note that this sets the file's size.
+# Returns whether it worked.
+def PreallocateFile(outFile, size):
+    try:
+        os.posix_fallocate(outFile.fileno(), 0, size)
+        return True
+    except (AttributeError, OSError):
+        return False
+
+# Make the file at dstPath a copy of the one at srcPath. We hardlink it if possible, or
+# else use a relative symlink, and only actually copy it if neither works (e.g. on
+# filesystems which support neither, or for files with too many hardlinks already).
+def LinkFile(srcPath, dstPath):
+    MakeDirs(os.path.dirname(dstPath))
+
+    try:
+        os.link(srcPath, dstPath)
+        return
+    except (OSError, AttributeError):   # Python 2 on Windows lacks os.link
+        if os.path.exists(dstPath):
+            raise
+
+    try:
+        os.symlink(os.path.relpath(os.path.realpath(srcPath), os.path.realpath(os.path.dirname(dstPath))), dstPath)
+        return
+    except (OSError, AttributeError, NotImplementedError):
+        if os.path.lexists(dstPath):
+            raise
+
+    shutil.copyfile(srcPath, dstPath)
+
 # Note that this fails to diagnose images that are, say, followed by an expiration tag
 # in the URL.
 def IsImageURL(url):
     fileExt = os.path.splitext(url)[1]
     return fileExt in ['.png', '.jpg', '.jpeg', '.jpe', '.jiff', '.gif', '.svg', '.bmp', '.tif', '.tiff']
 
+# Queue of URL items (raw URLs or UrlInfo objects) waiting to be processed. Subclasses
+# decide what order items come out in; all of them push and pop in O(1) time (or
+# O(log n), for the heap-based ones).
+class CrawlFrontier(object):
+    def __len__(self):
+        return 0
+
+    # Add URL items that the user asked for.
+    def AddUserItems(self, urlItems):
+        pass
+
+    # Add URL items that we got from processing another URL item.
+    def AddFoundItems(self, urlItems):
+        pass
+
+    def Pop(self):
+        raise IndexError('Frontier is empty')
+
+# Items found while processing a page are processed before anything else, in the order
+# they were found. This means we finish with a page's files (and a thread's pages)
+# before moving on to the next thread.
+class DepthFirstFrontier(CrawlFrontier):
+    def __init__(self):
+        self.urlItems = collections.deque()
+
+    def __len__(self):
+        return len(self.urlItems)
+
+    def AddUserItems(self, urlItems):
+        self.urlItems.extend(urlItems)
+
+    def AddFoundItems(self, urlItems):
+        self.urlItems.extendleft(reversed(urlItems))
+
+    def Pop(self):
+        return self.urlItems.popleft()
+
+# Items are processed in the order they were added.
+class BreadthFirstFrontier(CrawlFrontier):
+    def __init__(self):
+        self.urlItems = collections.deque()
+
+    def __len__(self):
+        return len(self.urlItems)
+
+    def AddUserItems(self, urlItems):
+        self.urlItems.extend(urlItems)
+
+    def AddFoundItems(self, urlItems):
+        self.urlItems.extend(urlItems)
+
+    def Pop(self):
+        return self.urlItems.popleft()
+
+# Base class for frontiers which pop items by priority. Items with equal priority are
+# processed in the order they were added.
+class PriorityFrontier(CrawlFrontier):
+    def __init__(self):
+        self.heap = []
+        self.itemNum = 0
+
+    def __len__(self):
+        return len(self.heap)
+
+    # Lower values are processed first.
+    def GetPriority(self, urlItem):
+        return 0
+
+    def AddUserItems(self, urlItems):
+        self.AddFoundItems(urlItems)
+
+    def AddFoundItems(self, urlItems):
+        for urlItem in urlItems:
+            # The item count keeps the heap from ever having to compare URL items.
+            heapq.heappush(self.heap, (self.GetPriority(urlItem), self.itemNum, urlItem))
+            self.itemNum += 1
+
+    def Pop(self):
+        return heapq.heappop(self.heap)[2]
+
+# Pages (including user-added URLs) are processed before any files. This gets us the
+# full list of files we need as soon as possible.
+class PagesFirstFrontier(PriorityFrontier):
+    def GetPriority(self, urlItem):
+        return 1 if not IsStr(urlItem) and urlItem.bFile else 0
+
+FRONTIER_TYPES = {
+    'depth_first': DepthFirstFrontier,
+    'breadth_first': BreadthFirstFrontier,
+    'pages_first': PagesFirstFrontier,
+}
+
+def CreateFrontier(crawlOrder):
+    try:
+        return FRONTIER_TYPES[crawlOrder]()
+    except KeyError:
+        raise SetupError('Unknown crawl order: ' + ToStr(crawlOrder))
+
+# Token bucket for limiting how often we do something, e.g. make requests to a host. It
+# holds up to burstSize tokens, which are added at a steady rate, and each request
+# takes one.
+class TokenBucket(object):
+    def __init__(self, rate, burstSize=1):
+        self.rate = float(rate)
+        self.burstSize = burstSize
+        self.tokens = float(burstSize)
+        self.lastTime = time.time()
+
+    def Refill(self, now):
+        self.tokens = min(self.burstSize, self.tokens + (now - self.lastTime) * self.rate)
+        self.lastTime = now
+
+    # Return how many seconds until a token is available.
+    def GetWaitTime(self, now):
+        self.Refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def Take(self, now):
+        self.Refill(now)
+        self.tokens -= 1
+
+# Per-host state for HostScheduler.
+class ScheduledHost(object):
+    def __init__(self, maxConnections, requestsPerSecond):
+        self.maxConnections = maxConnections
+        self.bucket = TokenBucket(requestsPerSecond, max(1, int(requestsPerSecond))) if requestsPerSecond else None
+        self.activeNum = 0
+
+        # Items that we couldn't hand out yet.
+        self.waitingItems = collections.deque()
+
+    def IsReady(self, now):
+        if self.maxConnections and self.activeNum >= self.maxConnections:
+            return False
+        return self.bucket is None or self.bucket.GetWaitTime(now) == 0
+
+    def Start(self, now):
+        self.activeNum += 1
+        if self.bucket is not None:
+            self.bucket.Take(now)
+
+# Decides which queued URL item to hand out next, so that no host ever has more than
+# its maximum number of items in progress at once, or gets requests faster than its
+# request rate allows. Hosts are as returned by GetDomain(). Items for a host that has to
+# wait are set aside (in the order we got them), without holding up items for other
+# hosts. If a HostHealthMonitor is given, items for hosts that it says are unavailable
+# are set aside to be failed without making any requests (see PopUnavailable()), and
+# once such a host can be tried again, only one item for it is handed out until that
+# item is done. This is only used from the main thread.
+class HostScheduler(object):
+    # Stop taking items from the frontier if this many have been set aside, rather than
+    # draining the whole frontier while a busy host catches up.
+    MAX_WAITING_ITEMS = 10000
+
+    def __init__(self, frontier, maxConnections=None, requestsPerSecond=None, hostHealth=None):
+        self.frontier = frontier
+        self.maxConnections = maxConnections
+        self.requestsPerSecond = requestsPerSecond
+        self.hostHealth = hostHealth
+        self.hostLimits = {}
+        self.hosts = {}
+
+        # Hosts which have items set aside, in the order they started waiting.
+        self.waitingHosts = collections.OrderedDict()
+        self.waitingItemNum = 0
+
+        # Items for hosts that are unavailable.
+        self.unavailableItems = collections.deque()
+
+    # Number of items left to hand out.
+    def __len__(self):
+        return len(self.frontier) + self.waitingItemNum + len(self.unavailableItems)
+
+    # Set the default limits for all hosts. None means no limit. Note that limits only
+    # affect hosts that we haven't handed out items for yet.
+    def SetLimits(self, maxConnections=None, requestsPerSecond=None):
+        self.maxConnections = maxConnections
+        self.requestsPerSecond = requestsPerSecond
+
+    def SetHostLimits(self, domain, maxConnections=None, requestsPerSecond=None):
+        self.hostLimits[domain] = (maxConnections, requestsPerSecond)
+
+    def GetHost(self, domain):
+        host = self.hosts.get(domain)
+        if host is None:
+            maxConnections, requestsPerSecond = self.hostLimits.get(domain, (None, None))
+            if maxConnections is None:
+                maxConnections = self.maxConnections
+            if requestsPerSecond is None:
+                requestsPerSecond = self.requestsPerSecond
+
+            host = ScheduledHost(maxConnections, requestsPerSecond)
+            self.hosts[domain] = host
+        return host
+
+    def GetCircuitState(self, domain):
+        if self.hostHealth is None:
+            return HostHealthMonitor.CIRCUIT_CLOSED
+        return self.hostHealth.GetCircuitState(domain)
+
+    def StartItem(self, urlItem, domain, host, circuitState, now):
+        host.Start(now)
+        if circuitState == HostHealthMonitor.CIRCUIT_HALF_OPEN:
+            self.hostHealth.StartTrial(domain, urlItem if IsStr(urlItem) else urlItem.url)
+
+    # Return the next item that can be handed out now, or None if there isn't one.
+    def Pop(self):
+        now = time.time()
+
+        # Items that were set aside come first.
+        for domain in list(self.waitingHosts):
+            host = self.hosts[domain]
+            circuitState = self.GetCircuitState(domain)
+
+            if circuitState == HostHealthMonitor.CIRCUIT_OPEN:
+                self.unavailableItems.extend(host.waitingItems)
+                self.waitingItemNum -= len(host.waitingItems)
+                host.waitingItems.clear()
+                del self.waitingHosts[domain]
+            elif circuitState != HostHealthMonitor.CIRCUIT_TRIAL and host.IsReady(now):
+                urlItem = host.waitingItems.popleft()
+                self.waitingItemNum -= 1
+                if len(host.waitingItems) == 0:
+                    del self.waitingHosts[domain]
+
+                self.StartItem(urlItem, domain, host, circuitState, now)
+                return urlItem
+
+        while len(self.frontier) > 0 and self.waitingItemNum + len(self.unavailableItems) < self.MAX_WAITING_ITEMS:
+            urlItem = self.frontier.Pop()
+            domain = GetDomain(urlItem if IsStr(urlItem) else urlItem.url)
+            host = self.GetHost(domain)
+            circuitState = self.GetCircuitState(domain)
+
+            if circuitState == HostHealthMonitor.CIRCUIT_OPEN:
+                self.unavailableItems.append(urlItem)
+                continue
+
+            if domain not in self.waitingHosts and circuitState != HostHealthMonitor.CIRCUIT_TRIAL and host.IsReady(now):
+                self.StartItem(urlItem, domain, host, circuitState, now)
+                return urlItem
+
+            host.waitingItems.append(urlItem)
+            self.waitingItemNum += 1
+            self.waitingHosts[domain] = True
+
+        return None
+
+    # Return the next item whose host is unavailable, or None if there isn't one. These
+    # items don't count as handed out.
+    def PopUnavailable(self):
+        if len(self.unavailableItems) == 0:
+            return None
+        return self.unavailableItems.popleft()
+
+    # Record that an item we handed out is done.
+    def Done(self, urlItem):
+        url = urlItem if IsStr(urlItem) else urlItem.url
+        domain = GetDomain(url)
+        self.GetHost(domain).activeNum -= 1
+        if self.hostHealth is not None:
+            self.hostHealth.EndTrial(domain, url)
+
+    # Return how many seconds until an item that's been set aside because of its host's
+    # request rate can be handed out, or None if there are no such items.
+    def GetWaitTime(self):
+        now = time.time()
+        waitTime = None
+        for domain in self.waitingHosts:
+            host = self.hosts[domain]
+            if host.bucket is None or (host.maxConnections and host.activeNum >= host.maxConnections):
+                continue
+
+            hostWaitTime = host.bucket.GetWaitTime(now)
+            if waitTime is None or hostWaitTime < waitTime:
+                waitTime = hostWaitTime
+        return waitTime
+
+# What we know about a UrlInfo URL that we've queued.
+class UrlIndexEntry(object):
+    __slots__ = ['saveDir', 'fileName', 'bDone', 'bFailed', 'aliasPaths']
+
+    # The file's save path, if any, is given split as SplitSavePath() does, so that the
+    # entry for a UrlInfo can share its strings.
+    def __init__(self, saveDir, fileName):
+        self.saveDir = saveDir
+        self.fileName = fileName
+        self.bDone = False
+        self.bFailed = False
+
+        # Other paths (relative to the root dir) that the file is also wanted at, since
+        # more than one page links to it. We fill these in from the downloaded file,
+        # rather than downloading it again. Most files don't have any, so this is only
+        # made a list once they do.
+        self.aliasPaths = ()
+
+    @property
+    def fileSavePath(self):
+        if self.fileName is None:
+            return None
+        return self.saveDir + self.fileName
+
+# Set of canonical URLs that we've seen, with a short string value for each. Backends
+# differ in how much memory they need per URL; see CreateSeenUrlSet(). These are only
+# used from SiteDownloader's main thread, so they aren't thread-safe.
+class SeenUrlSet(object):
+    def __len__(self):
+        raise NotImplementedError()
+
+    def __contains__(self, url):
+        return self.Get(url) is not None
+
+    # Return the URL's value, or None if we haven't seen the URL.
+    def Get(self, url):
+        raise NotImplementedError()
+
+    # Add the URL, or replace its value if it's already there.
+    def Add(self, url, value=''):
+        raise NotImplementedError()
+
+    def Close(self):
+        pass
+
+# Keeps the URLs in a dict. This is the fastest backend, but needs a few hundred bytes
+# per URL.
+class MemorySeenUrlSet(SeenUrlSet):
+    def __init__(self):
+        self.urls = {}
+
+    def __len__(self):
+        return len(self.urls)
+
+    def Get(self, url):
+        return self.urls.get(url)
+
+    def Add(self, url, value=''):
+        self.urls[url] = value
+
+# Keeps the URLs in an SQLite file, indexed by a hash of each URL, so that memory use
+# doesn't grow with the number of URLs. The file is only for a single run (a resumed
+# crawl fills it in again from the journal), so it's replaced if it exists, and we
+# don't make SQLite keep it safe from crashes.
+class DiskSeenUrlSet(SeenUrlSet):
+    # Number of URLs we add between commits. Uncommitted URLs are still found by Get().
+    COMMIT_ADD_NUM = 10000
+
+    def __init__(self, path):
+        self.path = path
+        self.urlNum = 0
+        self.uncommittedNum = 0
+
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            self.connection = sqlite3.connect(path)
+            self.connection.execute('PRAGMA journal_mode = OFF')
+            self.connection.execute('PRAGMA synchronous = OFF')
+            self.connection.execute('CREATE TABLE seen (hash INTEGER, url TEXT, value TEXT, PRIMARY KEY (hash, url)) WITHOUT ROWID')
+        except (OSError, sqlite3.Error) as error:
+            raise SetupError('Unable to create seen URL set ' + path + ': ' + ToStr(error))
+
+    def __len__(self):
+        return self.urlNum
+
+    # Return a 64-bit hash of the URL, which stays the same between runs (unlike hash()).
+    def HashUrl(self, url):
+        digest = hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest()
+        return int.from_bytes(digest, 'little', signed=True)
+
+    def Get(self, url):
+        row = self.connection.execute('SELECT value FROM seen WHERE hash = ? AND url = ?', (self.HashUrl(url), url)).fetchone()
+        return row[0] if row is not None else None
+
+    def Add(self, url, value=''):
+        urlHash = self.HashUrl(url)
+        try:
+            if self.connection.execute('INSERT OR IGNORE INTO seen VALUES (?, ?, ?)', (urlHash, url, value)).rowcount == 1:
+                self.urlNum += 1
+            else:
+                self.connection.execute('UPDATE seen SET value = ? WHERE hash = ? AND url = ?', (value, urlHash, url))
+
+            self.uncommittedNum += 1
+            if self.uncommittedNum >= self.COMMIT_ADD_NUM:
+                self.connection.commit()
+                self.uncommittedNum = 0
+        except sqlite3.Error as error:
+            raise WriteError('Unable to write to seen URL set ' + self.path + ': ' + ToStr(error))
+
+    # The file is removed, since it's only for a single run.
+    def Close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+# A DiskSeenUrlSet with a Bloom filter in memory in front of it. The filter tells us
+# for certain about most URLs we haven't seen, so we only look in the file for URLs
+# that we probably have seen. The filter is sized to give the false positive rate for
+# expectedUrlNum URLs; it only gets slower, not wrong, if there are more.
+class BloomSeenUrlSet(DiskSeenUrlSet):
+    def __init__(self, path, expectedUrlNum=10000000, falsePositiveRate=0.01):
+        DiskSeenUrlSet.__init__(self, path)
+
+        self.bitNum = max(int(-expectedUrlNum * math.log(falsePositiveRate) / (math.log(2) ** 2)), 64)
+        self.hashNum = max(int(round(self.bitNum / float(expectedUrlNum) * math.log(2))), 1)
+        self.bits = bytearray((self.bitNum + 7) // 8)
+
+    # Return the positions of the URL's bits in the filter, using double hashing.
+    def GetBitPositions(self, url):
+        digest = hashlib.blake2b(url.encode('utf-8'), digest_size=16).digest()
+        hash1 = int.from_bytes(digest[:8], 'little')
+        hash2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(hash1 + i * hash2) % self.bitNum for i in range(self.hashNum)]
+
+    def Get(self, url):
+        for position in self.GetBitPositions(url):
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return None
+        return DiskSeenUrlSet.Get(self, url)
+
+    def Add(self, url, value=''):
+        DiskSeenUrlSet.Add(self, url, value)
+        for position in self.GetBitPositions(url):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+# Return a new SeenUrlSet with the named backend. Disk-based backends keep their file
+# at path.
+def CreateSeenUrlSet(backend, path, expectedUrlNum=None):
+    if backend == 'memory':
+        return MemorySeenUrlSet()
+    elif backend == 'bloom':
+        if expectedUrlNum is not None:
+            if expectedUrlNum <= 1:
+                raise SetupError('Invalid expected URL count for the seen set: ' + ToStr(expectedUrlNum))
+            return BloomSeenUrlSet(path, expectedUrlNum)
+        return BloomSeenUrlSet(path)
+    elif backend == 'disk':
+        return DiskSeenUrlSet(path)
+    else:
+        raise SetupError('Unknown seen set backend: ' + ToStr(backend))
+
+# Return the name we use to identify a plugin in places like the crawl journal.
+def GetPluginId(plugin):
+    name = plugin.ProcessorName()
+    if len(name) == 0:
+        name = plugin.__class__.__name__
+    return name
+
+# On-disk record of a crawl, which lets an interrupted crawl pick up where it stopped.
+# It holds every URL item we've queued, along with its save path and whether it's
+# still queued, done, or failed (and why), plus the extra paths queued files are wanted
+# at. Writes are buffered and made in batches, in a single transaction each.
+#
+# The order in which items were added is kept, along with the frontier call that added
+# them, so that replaying the still-queued items into a new frontier puts them back in
+# the same order they were in.
+class CrawlJournal(object):
+    QUEUED = 0
+    DONE = 1
+    FAILED = 2
+
+    FLUSH_INTERVAL = 2.0   # seconds
+    FLUSH_OP_NUM = 5000
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            self.connection = sqlite3.connect(path)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+
+            with self.connection:
+                self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+                self.connection.execute('CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, bUserItem INTEGER, canonicalUrl TEXT, '
+                                        'pluginId TEXT, category TEXT, displayName TEXT, url TEXT, fileSavePath TEXT, bFile INTEGER, '
+                                        'bKeepExisting INTEGER, bReplaceExisting INTEGER, batchNum INTEGER, status INTEGER, reason TEXT, UNIQUE (bUserItem, canonicalUrl))')
+                self.connection.execute('CREATE TABLE IF NOT EXISTS aliases (canonicalUrl TEXT, fileSavePath TEXT, '
+                                        'UNIQUE (canonicalUrl, fileSavePath))')
+
+            row = self.connection.execute('SELECT MAX(batchNum) FROM items').fetchone()
+        except sqlite3.Error as error:
+            raise SetupError('Unable to open crawl journal ' + path + ': ' + ToStr(error))
+
+        self.batchNum = row[0] if row[0] is not None else 0
+        self.ops = []
+        self.lastFlushTime = time.time()
+        # Functions to call before each flush.
+        self.flushHooks = []
+
+    # Whether the journal holds a crawl which was started but never finished.
+    def IsUnfinished(self):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'state'").fetchone()
+        return row is not None and row[0] == 'running'
+
+    # Throw away any previous crawl, and start recording a new one.
+    def Reset(self):
+        self.ops = []
+        self.batchNum = 0
+        with self.connection:
+            self.connection.execute('DELETE FROM items')
+            self.connection.execute('DELETE FROM aliases')
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('state', 'running')")
+
+    def MarkFinished(self):
+        self.ops.append(("INSERT OR REPLACE INTO meta VALUES ('state', 'finished')", ()))
+        self.Flush()
+
+    # Record a list of newly queued URL items, all of which were added to the frontier
+    # in one call. Each item is given as (canonicalUrl, urlItem).
+    def AddItems(self, urlItems, bUserItems):
+        self.batchNum += 1
+        for canonicalUrl, urlItem in urlItems:
+            if IsStr(urlItem):
+                values = (True, canonicalUrl, None, None, None, urlItem, None, False, False, False)
+            else:
+                values = (False, canonicalUrl, GetPluginId(urlItem.plugin), urlItem.category, urlItem.displayName,
+                          urlItem.url, urlItem.fileSavePath, urlItem.bFile, urlItem.bKeepExisting, urlItem.bReplaceExisting)
+            self.ops.append(('INSERT OR IGNORE INTO items VALUES (NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)',
+                             values + (self.batchNum, self.QUEUED)))
+
+    def SetItemStatus(self, bUserItem, canonicalUrl, status, reason=None):
+        self.ops.append(('UPDATE items SET status = ?, reason = ? WHERE bUserItem = ? AND canonicalUrl = ?',
+                         (status, reason, bUserItem, canonicalUrl)))
+
+    def AddAlias(self, canonicalUrl, fileSavePath):
+        self.ops.append(('INSERT OR IGNORE INTO aliases VALUES (?, ?)', (canonicalUrl, fileSavePath)))
+
+    # Yields (bUserItem, canonicalUrl, pluginId, category, displayName, url,
+    # fileSavePath, bFile, bKeepExisting, bReplaceExisting, batchNum, status), in the
+    # order the items were added.
+    def GetItems(self):
+        return self.connection.execute('SELECT bUserItem, canonicalUrl, pluginId, category, displayName, url, fileSavePath, bFile, '
+                                       'bKeepExisting, bReplaceExisting, batchNum, status FROM items ORDER BY id')
+
+    # Yields (canonicalUrl, fileSavePath).
+    def GetAliases(self):
+        return self.connection.execute('SELECT canonicalUrl, fileSavePath FROM aliases')
+
+    # Note that this should only be called at points where everything recorded so far
+    # is consistent, e.g. not between marking a page as done and recording the items
+    # found on it.
+    def MaybeFlush(self):
+        if len(self.ops) >= self.FLUSH_OP_NUM or time.time() - self.lastFlushTime >= self.FLUSH_INTERVAL:
+            self.Flush()
+
+    # Call a function before each flush, to make sure that what the journal is about to
+    # record is already on disk.
+    def AddFlushHook(self, hook):
+        self.flushHooks.append(hook)
+
+    def Flush(self):
+        if len(self.ops) > 0:
+            for hook in self.flushHooks:
+                hook()
+            try:
+                with self.connection:
+                    for sql, params in self.ops:
+                        self.connection.execute(sql, params)
+            except sqlite3.Error as error:
+                raise WriteError('Unable to write to crawl journal ' + self.path + ': ' + ToStr(error))
+            self.ops = []
+        self.lastFlushTime = time.time()
+
+    def Close(self):
+        try:
+            self.Flush()
+        finally:
+            self.connection.close()
+
+# Small persistent key-value store that plugins use to remember things between runs,
+# e.g. how far they got with a forum thread. Values are stored as JSON. This is safe to
+# use from any thread.
+class PluginStateStore(object):
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.lock = Lock()
+
+    def GetConnection(self):
+        # Don't create the file until someone actually uses it.
+        if self.connection is None:
+            try:
+                self.connection = sqlite3.connect(self.path, check_same_thread=False)
+                with self.connection:
+                    self.connection.execute('CREATE TABLE IF NOT EXISTS state (pluginId TEXT, key TEXT, value TEXT, PRIMARY KEY (pluginId, key))')
+            except sqlite3.Error as error:
+                raise SetupError('Unable to open plugin state store ' + self.path + ': ' + ToStr(error))
+        return self.connection
+
+    def Get(self, pluginId, key, default=None):
+        with self.lock:
+            row = self.GetConnection().execute('SELECT value FROM state WHERE pluginId = ? AND key = ?', (pluginId, key)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def Set(self, pluginId, key, value):
+        with self.lock:
+            try:
+                with self.GetConnection() as connection:
+                    connection.execute('INSERT OR REPLACE INTO state VALUES (?, ?, ?)', (pluginId, key, json.dumps(value)))
+            except sqlite3.Error as error:
+                raise WriteError('Unable to write to plugin state store ' + self.path + ': ' + ToStr(error))
+
+    def Close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+# Content-addressed store for downloaded files, kept under the root dir. Each distinct
+# file is stored once, as a blob named after the SHA-256 hash of its contents, and each
+# path the file is saved at is linked to that blob (see LinkFile()). Files are hashed
+# while they're downloaded, and only become blobs if no blob with the same contents
+# exists yet. This is safe to use from any thread.
+class AssetStore(object):
+    DIR_NAME = 'asset_store'
+
+    def __init__(self, rootDir):
+        self.storeDir = os.path.join(rootDir, self.DIR_NAME)
+        self.lock = Lock()
+
+        try:
+            MakeDirs(self.storeDir)
+        except (OSError, IOError):
+            raise SetupError('Unable to create asset store: ' + self.storeDir)
+
+    def GetBlobPath(self, digest):
+        return os.path.join(self.storeDir, digest[:2], digest)
+
+    # Turn a downloaded file into the blob for its contents, unless that blob already
+    # exists, in which case the downloaded file is thrown away. The file should be on
+    # the same filesystem as the store (e.g. anywhere under the root dir). Returns the
+    # path of the blob.
+    def AddBlob(self, filePath, digest):
+        blobPath = self.GetBlobPath(digest)
+
+        with self.lock:
+            if os.path.exists(blobPath):
+                os.remove(filePath)
+            else:
+                MakeDirs(os.path.dirname(blobPath))
+                os.rename(filePath, blobPath)
+
+        return blobPath
+
+# Where pages and downloaded files end up. Everything is identified by its save path,
+# relative to the root dir, whether it's a file there (DirectoryOutput, the default) or
+# a record in an archive (WarcOutput and TarOutput). Backends are safe to use from any
+# thread.
+class OutputBackend(object):
+    # Whether files with the same contents are only stored once. If so, files are hashed
+    # while they're downloaded, and the hash is passed to AddFile().
+    bDeduplicate = False
+
+    def EnableDeduplication(self):
+        self.bDeduplicate = True
+
+    def Exists(self, savePath):
+        raise NotImplementedError()
+
+    # Return the path on disk that a file is downloaded to before it's added with
+    # AddFile(). DownloadThread adds its partial file suffix to this.
+    def GetDownloadPath(self, savePath):
+        raise NotImplementedError()
+
+    # Save a page, given as an iterable of strings. bSerialized is set if the strings
+    # are HTML that's already been serialized (and timed), rather than generated as
+    # they're written.
+    def WritePage(self, savePath, pieces, url, bSerialized=False):
+        raise NotImplementedError()
+
+    # Save a downloaded file, taking it from downloadPath, which it's removed from.
+    # digest is the hex SHA-256 hash of the file, if bDeduplicate is set. Anything
+    # already saved at the save path is replaced.
+    def AddFile(self, savePath, downloadPath, url, contentType=None, digest=None):
+        raise NotImplementedError()
+
+    # Make something we've saved available at another save path too.
+    def Link(self, srcSavePath, dstSavePath):
+        raise NotImplementedError()
+
+    # Return the backend that parse processes should save pages with, or None if they
+    # should hand the pages back to be saved here (see CollectedOutput).
+    def GetParseOutput(self):
+        return None
+
+    # Make sure that everything saved so far is on disk. This is called before the
+    # crawl journal records that it's done.
+    def Flush(self):
+        pass
+
+    def Close(self):
+        pass
+
+# Number of characters of a page that WritePagePieces() writes at a time.
+SAVE_PAGE_CHUNK_SIZE = 64 * 1024
+
+# Write a page, given as an iterable of strings, with the write function, a batch of
+# SAVE_PAGE_CHUNK_SIZE characters at a time, so that the whole of it never needs to be
+# in memory at once. Serializing the page (which is what generating the pieces usually
+# does) and writing it are timed separately, unless bSerialized is set (see
+# OutputBackend.WritePage()), in which case only writing it is timed.
+def WritePagePieces(write, pieces, bSerialized=False):
+    startTime = time.perf_counter()
+    writeTime = 0
+
+    batch = []
+    batchSize = 0
+    for piece in pieces:
+        batch.append(piece)
+        batchSize += len(piece)
+        if batchSize >= SAVE_PAGE_CHUNK_SIZE:
+            writeStartTime = time.perf_counter()
+            write(''.join(batch))
+            writeTime += time.perf_counter() - writeStartTime
+            batch = []
+            batchSize = 0
+
+    writeStartTime = time.perf_counter()
+    write(''.join(batch))
+    writeTime += time.perf_counter() - writeStartTime
+
+    if not bSerialized:
+        g_metrics.Observe('serialize', time.perf_counter() - startTime - writeTime)
+    g_metrics.Observe('write', writeTime)
+
+# Saves everything as files under the root dir, at their save paths. Optionally, files
+# are kept in an AssetStore, and linked into place.
+class DirectoryOutput(OutputBackend):
+    def __init__(self, rootDir):
+        self.rootDir = rootDir
+        self.assetStore = None
+
+    def EnableDeduplication(self):
+        OutputBackend.EnableDeduplication(self)
+        self.assetStore = AssetStore(self.rootDir)
+
+    def GetPath(self, savePath):
+        return os.path.join(self.rootDir, savePath)
+
+    def Exists(self, savePath):
+        return os.path.exists(self.GetPath(savePath))
+
+    def GetDownloadPath(self, savePath):
+        return self.GetPath(savePath)
+
+    def WritePage(self, savePath, pieces, url, bSerialized=False):
+        path = self.GetPath(savePath)
+        try:
+            MakeDirs(os.path.dirname(path))
+            with io.open(path, 'w', encoding='utf-8') as outFile:
+                WritePagePieces(outFile.write, pieces, bSerialized)
+        except (OSError, IOError):
+            raise WriteError('Unable to create file: ' + path)
+
+    def AddFile(self, savePath, downloadPath, url, contentType=None, digest=None):
+        path = self.GetPath(savePath)
+        if digest is not None and self.assetStore is not None:
+            blobPath = self.assetStore.AddBlob(downloadPath, digest)
+            if os.path.lexists(path):
+                os.remove(path)
+            LinkFile(blobPath, path)
+        else:
+            os.replace(downloadPath, path)
+
+    def Link(self, srcSavePath, dstSavePath):
+        dstPath = self.GetPath(dstSavePath)
+        if not os.path.exists(dstPath):
+            LinkFile(self.GetPath(srcSavePath), dstPath)
+
+    # Parse processes can write pages straight to their files.
+    def GetParseOutput(self):
+        return DirectoryOutput(self.rootDir)
+
+# Used by parse processes when the pages need to be saved by the main process: keeps
+# the pages it's given, for ParsePageInProcess() to send back.
+class CollectedOutput(OutputBackend):
+    def __init__(self):
+        self.pages = []
+
+    # The main process checks this when it saves the page.
+    def Exists(self, savePath):
+        return False
+
+    # Only serializing the page is timed here; the main process times writing it.
+    def WritePage(self, savePath, pieces, url, bSerialized=False):
+        startTime = time.perf_counter()
+        html = ''.join(pieces)
+        if not bSerialized:
+            g_metrics.Observe('serialize', time.perf_counter() - startTime)
+        self.pages.append((savePath, html))
+
+    # Return [(savePath, html)] for the pages we've been given since the last call.
+    def TakePages(self):
+        pages = self.pages
+        self.pages = []
+        return pages
+
+# Base class for backends that append everything to archive files in the archives
+# directory under the root dir, instead of making a file for each page and file, which
+# for large crawls takes far more filesystem overhead than data. An index (a SQLite
+# database in the root dir) maps each save path to its archive, and the offset and size
+# of its record there, so that anything can be read back without going through the
+# archives.
+#
+# Each record is put together on its own (pages in a spooled temporary file, and
+# downloaded files where they were downloaded to), and then appended to its archive
+# while holding the backend's lock, so any number of threads can save things at once.
+# The index, and how much of each archive is complete, are written in batches, like
+# CrawlJournal's. If the crawl is interrupted, anything written to an archive after
+# the last batch is cut off the next time the archive is opened.
+class ArchiveOutput(OutputBackend):
+    DIR_NAME = 'archives'
+    # Files being downloaded go here, named after a hash of their save paths.
+    DOWNLOAD_DIR_NAME = 'archive_downloads'
+    INDEX_FILENAME = 'archive_index.sqlite'
+
+    FLUSH_INTERVAL = 2.0   # seconds
+    FLUSH_OP_NUM = 5000
+    MAX_OPEN_ARCHIVES = 64
+    # Pages bigger than this are spooled to disk rather than memory.
+    SPOOL_SIZE = 1024 * 1024
+    COPY_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, rootDir):
+        self.rootDir = rootDir
+        self.archiveDir = os.path.join(rootDir, self.DIR_NAME)
+        self.downloadDir = os.path.join(rootDir, self.DOWNLOAD_DIR_NAME)
+        self.indexPath = os.path.join(rootDir, self.INDEX_FILENAME)
+        self.lock = Lock()
+
+        self.connection = None
+        # Index entries that haven't been written to the index yet, by save path, and
+        # the save paths of entries by digest.
+        self.pendingRecords = {}
+        self.pendingDigests = {}
+        self.lastFlushTime = time.time()
+
+        # Archive files we have open, in the order they were last used, and the size of
+        # the complete part of each archive (of those that have changed since the last
+        # flush, in dirtyArchiveNames).
+        self.openArchives = collections.OrderedDict()
+        self.archiveSizes = {}
+        self.dirtyArchiveNames = set()
+
+        try:
+            MakeDirs(self.archiveDir)
+            MakeDirs(self.downloadDir)
+        except (OSError, IOError):
+            raise SetupError('Unable to create archive directory: ' + self.archiveDir)
+
+        for archiveName, size in self.GetConnection().execute('SELECT name, size FROM archives'):
+            self.archiveSizes[archiveName] = size
+
+    def GetConnection(self):
+        if self.connection is None:
+            try:
+                self.connection = sqlite3.connect(self.indexPath, check_same_thread=False)
+                self.connection.execute('PRAGMA journal_mode=WAL')
+                self.connection.execute('PRAGMA synchronous=NORMAL')
+                with self.connection:
+                    self.connection.execute('CREATE TABLE IF NOT EXISTS records (savePath TEXT PRIMARY KEY, url TEXT, archive TEXT, '
+                                            'offset INTEGER, size INTEGER, contentType TEXT, digest TEXT)')
+                    self.connection.execute('CREATE INDEX IF NOT EXISTS records_digest ON records (digest)')
+                    self.connection.execute('CREATE TABLE IF NOT EXISTS archives (name TEXT PRIMARY KEY, size INTEGER)')
+            except sqlite3.Error as error:
+                raise SetupError('Unable to open archive index ' + self.indexPath + ': ' + ToStr(error))
+        return self.connection
+
+    # Return the name of the archive that the record for a save path should go in.
+    def GetArchiveName(self, savePath):
+        raise NotImplementedError()
+
+    # Write a record for a save path to an archive file, taking size bytes of data from
+    # dataFile. Returns the (offset, size) that the index should have for the record.
+    def WriteRecord(self, archiveFile, savePath, url, contentType, dataFile, size):
+        raise NotImplementedError()
+
+    # Write a record that makes the data of the record that the index has for
+    # srcSavePath available at dstSavePath too, to an archive file which has that record
+    # in it. Not all archive formats need one.
+    def WriteLinkRecord(self, archiveFile, srcSavePath, dstSavePath):
+        pass
+
+    # Return the data in a record that WriteRecord() wrote, given the offset and size
+    # it returned.
+    def ReadRecordData(self, archiveFile, offset, size):
+        raise NotImplementedError()
+
+    # Called before an archive file is closed.
+    def FinishArchiveFile(self, archiveFile):
+        pass
+
+    def GetArchivePath(self, archiveName):
+        return os.path.join(self.archiveDir, archiveName)
+
+    # Return the open archive file with the given name, opening it to append to it if
+    # need be. Files that we've used least recently are closed if too many are open.
+    def GetArchiveFile(self, archiveName):
+        archiveFile = self.openArchives.get(archiveName)
+        if archiveFile is not None:
+            self.openArchives.move_to_end(archiveName)
+            return archiveFile
+
+        while len(self.openArchives) >= self.MAX_OPEN_ARCHIVES:
+            self.CloseArchiveFile(next(iter(self.openArchives)))
+
+        archivePath = self.GetArchivePath(archiveName)
+        size = self.archiveSizes.get(archiveName)
+        if size is None or not os.path.exists(archivePath):
+            archiveFile = open(archivePath, 'wb')
+            self.archiveSizes[archiveName] = 0
+            self.dirtyArchiveNames.add(archiveName)
+            self.StartArchiveFile(archiveFile)
+        else:
+            # Anything past what we know to be complete is from a record that we were
+            # interrupted while writing, or is the end of the archive, which we write
+            # again when we're done with it.
+            archiveFile = open(archivePath, 'r+b')
+            archiveFile.truncate(size)
+            archiveFile.seek(size)
+
+        self.openArchives[archiveName] = archiveFile
+        return archiveFile
+
+    # Called when a new archive file is created.
+    def StartArchiveFile(self, archiveFile):
+        pass
+
+    def CloseArchiveFile(self, archiveName):
+        archiveFile = self.openArchives.pop(archiveName)
+        self.FinishArchiveFile(archiveFile)
+        archiveFile.close()
+
+    # Return (url, archiveName, offset, size, contentType, digest) for the record of a
+    # save path, or None if there isn't one.
+    def GetRecord(self, savePath):
+        record = self.pendingRecords.get(savePath)
+        if record is not None:
+            return record
+        return self.GetConnection().execute('SELECT url, archive, offset, size, contentType, digest FROM records WHERE savePath = ?',
+                                            (savePath,)).fetchone()
+
+    # Return the save path of a record with the given digest, or None if there isn't one.
+    def FindDigest(self, digest):
+        savePath = self.pendingDigests.get(digest)
+        if savePath is not None:
+            return savePath
+        row = self.GetConnection().execute('SELECT savePath FROM records WHERE digest = ? LIMIT 1', (digest,)).fetchone()
+        return row[0] if row is not None else None
+
+    def AddIndexEntry(self, savePath, url, archiveName, offset, size, contentType, digest):
+        self.pendingRecords[savePath] = (url, archiveName, offset, size, contentType, digest)
+        if digest is not None:
+            self.pendingDigests[digest] = savePath
+
+    def Exists(self, savePath):
+        with self.lock:
+            return self.GetRecord(savePath) is not None
+
+    # Return the data saved at a save path, or None if there isn't any.
+    def Read(self, savePath):
+        with self.lock:
+            record = self.GetRecord(savePath)
+            if record is None:
+                return None
+
+            url, archiveName, offset, size, contentType, digest = record
+            archiveFile = self.openArchives.get(archiveName)
+            if archiveFile is not None:
+                archiveFile.flush()
+        with open(self.GetArchivePath(archiveName), 'rb') as archiveFile:
+            return self.ReadRecordData(archiveFile, offset, size)
+
+    def GetDownloadPath(self, savePath):
+        return os.path.join(self.downloadDir, hashlib.sha1(savePath.encode('utf-8')).hexdigest())
+
+    def WritePage(self, savePath, pieces, url, bSerialized=False):
+        with tempfile.SpooledTemporaryFile(max_size=self.SPOOL_SIZE) as spoolFile:
+            WritePagePieces(lambda text: spoolFile.write(text.encode('utf-8')), pieces, bSerialized)
+            size = spoolFile.tell()
+            spoolFile.seek(0)
+            self.AddRecord(savePath, url, 'text/html; charset=utf-8', spoolFile, size)
+
+    def AddFile(self, savePath, downloadPath, url, contentType=None, digest=None):
+        if digest is not None:
+            with self.lock:
+                srcSavePath = self.FindDigest(digest)
+                # Link() keeps what's already saved at the save path.
+                if srcSavePath != savePath and self.GetRecord(savePath) is not None:
+                    srcSavePath = None
+            if srcSavePath is not None:
+                self.Link(srcSavePath, savePath)
+                os.remove(downloadPath)
+                return
+
+        with open(downloadPath, 'rb') as dataFile:
+            self.AddRecord(savePath, url, contentType or 'application/octet-stream', dataFile, os.path.getsize(downloadPath), digest)
+        os.remove(downloadPath)
+
+    def AddRecord(self, savePath, url, contentType, dataFile, size, digest=None):
+        try:
+            with self.lock:
+                startTime = time.perf_counter()
+                archiveName = self.GetArchiveName(savePath)
+                archiveFile = self.GetArchiveFile(archiveName)
+                offset, recordSize = self.WriteRecord(archiveFile, savePath, url, contentType, dataFile, size)
+                self.archiveSizes[archiveName] = archiveFile.tell()
+                self.dirtyArchiveNames.add(archiveName)
+                self.AddIndexEntry(savePath, url, archiveName, offset, recordSize, contentType, digest)
+                g_metrics.Observe('archive', time.perf_counter() - startTime)
+
+                self.MaybeFlush()
+        except (OSError, IOError):
+            raise WriteError('Unable to write to archive: ' + savePath)
+
+    def Link(self, srcSavePath, dstSavePath):
+        with self.lock:
+            if self.GetRecord(dstSavePath) is not None:
+                return
+            record = self.GetRecord(srcSavePath)
+            if record is None:
+                raise WriteError('Nothing in archive to link to: ' + srcSavePath)
+
+            url, archiveName, offset, size, contentType, digest = record
+            if self.GetArchiveName(dstSavePath) == archiveName:
+                self.WriteLinkRecord(self.GetArchiveFile(archiveName), srcSavePath, dstSavePath)
+                self.archiveSizes[archiveName] = self.openArchives[archiveName].tell()
+                self.dirtyArchiveNames.add(archiveName)
+                # The index points straight at the original record's data.
+                self.AddIndexEntry(dstSavePath, url, archiveName, offset, size, contentType, None)
+                self.MaybeFlush()
+                return
+
+        # The link has to go in a different archive, so it gets its own copy.
+        data = self.Read(srcSavePath)
+        self.AddRecord(dstSavePath, url, contentType, io.BytesIO(data), len(data))
+
+    def MaybeFlush(self):
+        if len(self.pendingRecords) >= self.FLUSH_OP_NUM or time.time() - self.lastFlushTime >= self.FLUSH_INTERVAL:
+            self.FlushIndex()
+
+    # Note that this should be called while holding the lock.
+    def FlushIndex(self):
+        if len(self.pendingRecords) > 0 or len(self.dirtyArchiveNames) > 0:
+            # The index mustn't get ahead of the archives.
+            for archiveFile in self.openArchives.values():
+                archiveFile.flush()
+
+            try:
+                with self.GetConnection() as connection:
+                    connection.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                           [(savePath,) + record for savePath, record in self.pendingRecords.items()])
+                    connection.executemany('INSERT OR REPLACE INTO archives VALUES (?, ?)',
+                                           [(archiveName, self.archiveSizes[archiveName]) for archiveName in self.dirtyArchiveNames])
+            except sqlite3.Error as error:
+                raise WriteError('Unable to write to archive index ' + self.indexPath + ': ' + ToStr(error))
+            self.pendingRecords = {}
+            self.pendingDigests = {}
+            self.dirtyArchiveNames = set()
+        self.lastFlushTime = time.time()
+
+    def Flush(self):
+        with self.lock:
+            self.FlushIndex()
+
+    # Finish and close the archive files and the index. They're opened again if
+    # anything else is saved.
+    def Close(self):
+        with self.lock:
+            self.FlushIndex()
+            for archiveName in list(self.openArchives):
+                self.CloseArchiveFile(archiveName)
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    # Write size bytes from dataFile to outFile.
+    def CopyData(self, dataFile, outFile, size):
+        while size > 0:
+            chunk = dataFile.read(min(size, self.COPY_CHUNK_SIZE))
+            if not chunk:
+                raise IOError('Data ended early')
+            outFile.write(chunk)
+            size -= len(chunk)
+
+# Saves everything as WARC (ISO 28500) resource records, in WARC files which are rolled
+# over to a new one once they reach maxArchiveSize. Each file starts with a warcinfo
+# record. If bCompress is set, each record is a separate gzip member, as in the usual
+# .warc.gz files, so that records can still be read on their own. Index entries give
+# the offset and size of the whole record.
+class WarcOutput(ArchiveOutput):
+    MAX_OPEN_ARCHIVES = 1
+    DEFAULT_MAX_ARCHIVE_SIZE = 1024 * 1024 * 1024
+    # WARC header that we keep the save path of each record in.
+    SAVE_PATH_HEADER = 'SiteDownloader-Save-Path'
+
+    def __init__(self, rootDir, maxArchiveSize=None, bCompress=False):
+        ArchiveOutput.__init__(self, rootDir)
+        self.maxArchiveSize = maxArchiveSize if maxArchiveSize is not None else self.DEFAULT_MAX_ARCHIVE_SIZE
+        self.bCompress = bCompress
+
+        # New files are numbered on from the ones we already have.
+        self.archiveName = None
+        self.archiveNum = len(self.archiveSizes)
+        self.archivePrefix = 'crawl-' + datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S')
+
+    def GetArchiveName(self, savePath):
+        if self.archiveName is None or self.archiveSizes.get(self.archiveName, 0) >= self.maxArchiveSize:
+            if self.archiveName in self.openArchives:
+                self.CloseArchiveFile(self.archiveName)
+            self.archiveNum += 1
+            self.archiveName = '{}-{:05d}.warc{}'.format(self.archivePrefix, self.archiveNum, '.gz' if self.bCompress else '')
+        return self.archiveName
+
+    def MakeHeader(self, recordType, contentType, size, extraHeaders=()):
+        headers = [
+            ('WARC-Type', recordType),
+            ('WARC-Record-ID', '<urn:uuid:{}>'.format(uuid.uuid4())),
+            ('WARC-Date', datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')),
+        ]
+        headers.extend(extraHeaders)
+        headers.extend([('Content-Type', contentType), ('Content-Length', str(size))])
+        return ('WARC/1.1\r\n' + ''.join('{}: {}\r\n'.format(name, value) for name, value in headers) + '\r\n').encode('utf-8')
+
+    def WriteRecord(self, archiveFile, savePath, url, contentType, dataFile, size):
+        header = self.MakeHeader('resource', contentType, size, [('WARC-Target-URI', url), (self.SAVE_PATH_HEADER, savePath)])
+
+        offset = archiveFile.tell()
+        outFile = GzipMemberWriter(archiveFile) if self.bCompress else archiveFile
+        outFile.write(header)
+        self.CopyData(dataFile, outFile, size)
+        outFile.write(b'\r\n\r\n')
+        if self.bCompress:
+            outFile.close()
+        return offset, archiveFile.tell() - offset
+
+    def StartArchiveFile(self, archiveFile):
+        info = 'software: {}\r\nformat: WARC File Format 1.1\r\n'.format(PROGRAM_NAME).encode('utf-8')
+        outFile = GzipMemberWriter(archiveFile) if self.bCompress else archiveFile
+        outFile.write(self.MakeHeader('warcinfo', 'application/warc-fields', len(info)))
+        outFile.write(info + b'\r\n\r\n')
+        if self.bCompress:
+            outFile.close()
+
+    def ReadRecordData(self, archiveFile, offset, size):
+        archiveFile.seek(offset)
+        record = archiveFile.read(size)
+        if self.bCompress:
+            record = zlib.decompress(record, 31)
+
+        headerEnd = record.index(b'\r\n\r\n')
+        match = re.search(rb'\r\nContent-Length: (\d+)\r\n', record[:headerEnd + 2])
+        return record[headerEnd + 4:headerEnd + 4 + int(match.group(1))]
+
+# File-like object that writes a gzip member to a file, for WarcOutput. The member is
+# finished by close(), which leaves the file open.
+class GzipMemberWriter(object):
+    def __init__(self, outFile):
+        self.outFile = outFile
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def write(self, data):
+        self.outFile.write(self.compressor.compress(data))
+
+    def close(self):
+        self.outFile.write(self.compressor.flush())
+
+# Saves everything in tar archives, one for each group of save paths that belong
+# together, e.g. everything in a forum thread. Plugins can say which group a save path
+# belongs to (see SiteDownloaderPlugin.GetArchiveName()); by default, each directory
+# directly under the root dir, and each file there along with its "_files" directory,
+# is a group. Files that are wanted at several save paths in the same archive are
+# stored once, with hard links for the other paths. Index entries give the offset and
+# size of each member's data.
+class TarOutput(ArchiveOutput):
+    FILES_DIR_SUFFIX = '_files'
+
+    def __init__(self, rootDir, plugins=()):
+        ArchiveOutput.__init__(self, rootDir)
+        self.plugins = plugins
+
+    def GetArchiveName(self, savePath):
+        for plugin in self.plugins:
+            archiveName = plugin.GetArchiveName(savePath)
+            if archiveName is not None:
+                return archiveName + '.tar'
+
+        groupName = savePath.replace('\\', '/').split('/', 1)[0]
+        if groupName.endswith(self.FILES_DIR_SUFFIX):
+            groupName = groupName[:-len(self.FILES_DIR_SUFFIX)]
+        else:
+            groupName = os.path.splitext(groupName)[0]
+        return groupName + '.tar'
+
+    def MakeTarInfo(self, savePath):
+        tarInfo = tarfile.TarInfo(savePath.replace('\\', '/'))
+        tarInfo.mtime = time.time()
+        tarInfo.mode = 0o644
+        return tarInfo
+
+    def WriteRecord(self, archiveFile, savePath, url, contentType, dataFile, size):
+        tarInfo = self.MakeTarInfo(savePath)
+        tarInfo.size = size
+        archiveFile.write(tarInfo.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+
+        offset = archiveFile.tell()
+        self.CopyData(dataFile, archiveFile, size)
+        if size % tarfile.BLOCKSIZE != 0:
+            archiveFile.write(tarfile.NUL * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE))
+        return offset, size
+
+    def WriteLinkRecord(self, archiveFile, srcSavePath, dstSavePath):
+        tarInfo = self.MakeTarInfo(dstSavePath)
+        tarInfo.type = tarfile.LNKTYPE
+        tarInfo.linkname = srcSavePath.replace('\\', '/')
+        archiveFile.write(tarInfo.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'surrogateescape'))
+
+    def ReadRecordData(self, archiveFile, offset, size):
+        archiveFile.seek(offset)
+        return archiveFile.read(size)
+
+    # Write the end of the archive, which isn't counted in its size, so that it's
+    # overwritten if we add to the archive later.
+    def FinishArchiveFile(self, archiveFile):
+        archiveFile.write(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+
+def CreateOutputBackend(backend, rootDir, plugins=(), maxArchiveSize=None, bCompress=False):
+    if backend == 'directory':
+        return DirectoryOutput(rootDir)
+    elif backend == 'warc':
+        return WarcOutput(rootDir, maxArchiveSize=maxArchiveSize, bCompress=bCompress)
+    elif backend == 'tar':
+        return TarOutput(rootDir, plugins=plugins)
+    else:
+        raise SetupError('Unknown output backend: ' + ToStr(backend))
+
 class SiteDownloader(object):
     MAX_WORKER_THREADS = 10
+    JOURNAL_FILENAME = 'crawl_journal.sqlite'
+    PLUGIN_STATE_FILENAME = 'plugin_state.sqlite'
+    SEEN_URLS_FILENAME = 'seen_urls.sqlite'
+    SEEN_ITEMS_FILENAME = 'seen_items.sqlite'
+    # Number of fetched pages per parse process that can wait to be parsed before we stop
+    # handing out items.
+    MAX_PARSING_PAGES_PER_PROCESS = 2
+    # Number of URLs we take from the URL sources at a time, whenever the scheduler has
+    # fewer than this many items left.
+    URL_SOURCE_BATCH_SIZE = 100
+
+    def __init__(self, rootDir=None, urlList=None, bSingleThread=False, frontier=None, workerThreadNum=MAX_WORKER_THREADS):
+        if g_soupParser != 'lxml':
+            LogInfo('lxml parser not available, using default html parser')
 
-    def __init__(self, rootDir=None, urlList=None, bSingleThread=False):
         self.bRunning = True
         self.plugins = []
-
-        # Threads used to download items. In single-thread mode, we only create one
-        # worker thread at a time, and it never actually runs; we use it as a wrapper to
-        # contain data and code for a URL to be processed.
-        self.threads = []
-
-        self.urlItemSet = set()
+        # Built from the plugins when it's first needed; see GetPluginIndex().
+        self.pluginIndex = None
+
+        # A fixed pool of long-lived worker threads pulls DownloadThread objects (each a
+        # wrapper containing data and code for a URL to be processed) off workQueue, and
+        # hands them back through doneQueue once processed. In single-thread mode, no
+        # workers are started; we run each DownloadThread in the main thread instead,
+        # and hand it back through doneQueue the same way.
+        self.workers = []
+        self.workQueue = queue.Queue()
+        self.doneQueue = queue.Queue()
+
+        # DownloadThread objects which have been handed out but not yet checked.
+        self.threads = set()
+        # The ones among them whose pages are being parsed by parsePool.
+        self.parsingThreads = set()
+
+        # Optional pool of processes that parse pages, which is set up by
+        # EnableParseProcesses(). Pages go to it from the worker threads, for plugins
+        # that split fetching and parsing pages; see SiteDownloaderPlugin.
+        self.parseProcessNum = 0
+        self.parsePool = None
+        self.parseLogListener = None
+
+        # Canonical forms of the raw URLs we've queued.
+        self.urlItemSet = MemorySeenUrlSet()
+        # Iterators of raw URLs which we haven't taken all the URLs from yet; see
+        # AddUrlSource().
+        self.urlSources = collections.deque()
+        # Maps the canonical URL of each UrlInfo we've queued to its UrlIndexEntry. Note
+        # that a URL and a UrlInfo wrapping that URL do not cause a clash, nor should
+        # they; standard procedure after getting a URL is to wrap it in a UrlInfo.
+        # Entries are moved to finishedUrlSet once their items are done or have failed;
+        # GetUrlIndexEntry() looks in both.
+        self.urlIndex = {}
+        self.finishedUrlSet = MemorySeenUrlSet()
         # Contains either raw URLs, or UrlInfo objects.
-        self.urlItems = []
+        self.frontier = frontier if frontier is not None else DepthFirstFrontier()
+        # Hands out items from the frontier, subject to per-host limits.
+        self.scheduler = HostScheduler(self.frontier, hostHealth=g_hostHealth)
 
         self.rootDir = rootDir
         if SPEED_TEST:
             self.rootDir = os.path.join(self.rootDir, 'speedtest')
 
-        self.failedImages = []
-        self.failedUrls = []
+        self.failedImages = set()
+        self.failedUrls = set()
 
         self.bSingleThread = bSingleThread
+        self.workerThreadNum = workerThreadNum
+
+        # Optional CrawlJournal, which is set up by OpenJournal().
+        self.journal = None
+
+        self.pluginStateStore = None
+
+        # Where pages and files are saved; see SetOutputBackend().
+        self.output = DirectoryOutput(self.rootDir) if self.rootDir is not None else None
+
+        # Counters and stage timings for everything we do; see MetricsRegistry. If
+        # metricsPath is set by EnableMetricsDump(), they're saved there every
+        # metricsInterval seconds while we run, and once we're done.
+        self.metrics = g_metrics
+        self.metricsPath = None
+        self.metricsInterval = None
+        self.nextMetricsDumpTime = None
 
         if urlList is not None:
             self.AddUrls(urlList)
 
+    # Keep the URLs we've seen with the given backend: 'memory' (the default), 'bloom'
+    # or 'disk'. The last two keep them in files in the root dir, and need much less
+    # memory for large crawls; expectedUrlNum sizes the Bloom filter. This should be
+    # called before any URLs are added, or the journal is opened.
+    def SetSeenSetBackend(self, backend, expectedUrlNum=None):
+        if self.rootDir is None:
+            raise SetupError('No root dir set')
+
+        self.urlItemSet = CreateSeenUrlSet(backend, os.path.join(self.rootDir, self.SEEN_URLS_FILENAME), expectedUrlNum)
+        self.finishedUrlSet = CreateSeenUrlSet(backend, os.path.join(self.rootDir, self.SEEN_ITEMS_FILENAME), expectedUrlNum)
+
+    # Store downloaded files with the same contents only once. With directory output,
+    # files are kept in a content-addressed store, and linked into place.
+    def EnableAssetStore(self):
+        if self.rootDir is None:
+            raise SetupError('No root dir set')
+
+        self.output.EnableDeduplication()
+
+    # Save pages and files with the given backend: 'directory' (the default), where each
+    # is a file under the root dir, or 'warc' or 'tar', where they're records in archive
+    # files (see ArchiveOutput). maxArchiveSize and bCompress apply to WARC files. This
+    # should be called before the journal is opened.
+    def SetOutputBackend(self, backend, maxArchiveSize=None, bCompress=False):
+        if self.rootDir is None:
+            raise SetupError('No root dir set')
+
+        output = CreateOutputBackend(backend, self.rootDir, plugins=self.plugins, maxArchiveSize=maxArchiveSize, bCompress=bCompress)
+        if self.output.bDeduplicate:
+            output.EnableDeduplication()
+        self.output.Close()
+        self.output = output
+
+    # Parse pages in separate processes, so that parsing isn't limited to a single core
+    # by the GIL. This only affects the worker threads, not single-thread mode.
+    def EnableParseProcesses(self, processNum):
+        self.parseProcessNum = processNum
+
+    # Save the metrics to a file (as JSON if its name ends in .json, or in the Prometheus
+    # text format otherwise) every interval seconds, and when we're done.
+    def EnableMetricsDump(self, metricsPath, interval=60):
+        self.metricsPath = metricsPath
+        self.metricsInterval = interval
+        self.nextMetricsDumpTime = time.time() + interval
+
+    # Return a snapshot of the metrics, as from MetricsRegistry.GetSnapshot().
+    def GetMetrics(self):
+        return self.metrics.GetSnapshot()
+
+    def DumpMetrics(self):
+        self.metrics.Dump(self.metricsPath)
+        self.nextMetricsDumpTime = time.time() + self.metricsInterval
+
+    # Dump the metrics if they're due, and return how many seconds until the next dump
+    # (or None, if we're not dumping them).
+    def MaybeDumpMetrics(self):
+        if self.metricsPath is None:
+            return None
+
+        if time.time() >= self.nextMetricsDumpTime:
+            self.DumpMetrics()
+        return max(self.nextMetricsDumpTime - time.time(), 0)
+
+    def AddPlugin(self, plugin):
+        if self.rootDir is None:
+            raise SetupError('No root dir set')
+
+        if self.pluginStateStore is None:
+            self.pluginStateStore = PluginStateStore(os.path.join(self.rootDir, self.PLUGIN_STATE_FILENAME))
+
+        plugin.stateStore = self.pluginStateStore
+        self.plugins.append(plugin)
+        self.pluginIndex = None
+
+    # Return the PluginDispatchIndex for the plugins, which all DownloadThread objects
+    # share.
+    def GetPluginIndex(self):
+        if self.pluginIndex is None:
+            self.pluginIndex = PluginDispatchIndex(self.plugins)
+        return self.pluginIndex
+
     def AddUrls(self, urlList):
         if self.rootDir is None:
             raise SetupError('No root dir set')
 
-        for url in urlList:
-            if url in self.urlItemSet:
+        self.QueueUrlItems(urlList, bUserItems=True)
+        if self.journal is not None:
+            self.journal.MaybeFlush()
+
+    # Add the raw URLs from an iterable, such as a generator that reads them from a file.
+    # Rather than queueing them all at once, we take them a batch at a time as the crawl
+    # goes on, whenever we're running out of items to work on, so that only a batch of
+    # them needs to be in memory at once, and we can start on the first batch right
+    # away.
+    def AddUrlSource(self, urlSource):
+        if self.rootDir is None:
+            raise SetupError('No root dir set')
+
+        self.urlSources.append(iter(urlSource))
+
+    # Queue URLs from the URL sources, until the scheduler has enough items to work on
+    # or the sources run out.
+    def FeedUrlSources(self):
+        while len(self.urlSources) > 0 and len(self.scheduler) < self.URL_SOURCE_BATCH_SIZE:
+            urlList = list(itertools.islice(self.urlSources[0], self.URL_SOURCE_BATCH_SIZE))
+            if len(urlList) < self.URL_SOURCE_BATCH_SIZE:
+                self.urlSources.popleft()
+            self.AddUrls(urlList)
+
+    # Start recording the crawl in a journal, so that it can be resumed if it's
+    # interrupted. If the journal holds an unfinished crawl, we pick that crawl up where
+    # it stopped. This should be called after all plugins have been added, and before
+    # any URLs are. Returns whether we resumed a crawl.
+    def OpenJournal(self, journalPath=None):
+        if self.rootDir is None:
+            raise SetupError('No root dir set')
+
+        if journalPath is None:
+            journalPath = os.path.join(self.rootDir, self.JOURNAL_FILENAME)
+
+        self.journal = CrawlJournal(journalPath)
+        # Whatever the journal records as done has to be in the output by then.
+        self.journal.AddFlushHook(self.output.Flush)
+        if not self.journal.IsUnfinished():
+            self.journal.Reset()
+            return False
+
+        self.RestoreFromJournal()
+        return True
+
+    def RestoreFromJournal(self):
+        pluginsById = dict((GetPluginId(plugin), plugin) for plugin in self.plugins)
+
+        # Replay the frontier calls that added the items that are still queued.
+        batch = []
+        batchNum = None
+        bUserBatch = None
+
+        queuedNum = 0
+        for bUserItem, canonicalUrl, pluginId, category, displayName, url, fileSavePath, bFile, bKeepExisting, bReplaceExisting, itemBatchNum, status in self.journal.GetItems():
+            if bUserItem:
+                self.urlItemSet.Add(canonicalUrl)
+                urlItem = url
+            else:
+                entry = UrlIndexEntry(*SplitSavePath(fileSavePath if bFile else None))
+                if status != CrawlJournal.QUEUED:
+                    entry.bDone = (status == CrawlJournal.DONE)
+                    entry.bFailed = (status == CrawlJournal.FAILED)
+                    self.FinishUrlIndexEntry(canonicalUrl, entry)
+                    continue
+                self.urlIndex[canonicalUrl] = entry
+
+                plugin = pluginsById.get(pluginId)
+                if plugin is None:
+                    raise SetupError('Crawl journal refers to missing plugin: ' + pluginId)
+                urlItem = UrlInfo(plugin=plugin, category=category, displayName=displayName, url=url, fileSavePath=fileSavePath,
+                                  bFile=bool(bFile), bKeepExisting=bool(bKeepExisting), bReplaceExisting=bool(bReplaceExisting))
+
+            if status != CrawlJournal.QUEUED:
                 continue
 
-            self.urlItemSet.add(url)
-            self.urlItems.append(url)
+            if itemBatchNum != batchNum:
+                self.ReplayFrontierBatch(batch, bUserBatch)
+                batch = []
+                batchNum = itemBatchNum
+                bUserBatch = bool(bUserItem)
 
-    def CheckDeadThreads(self):
-        # Note that if we're running in single-thread mode, any fake threads we've
-        # created as data processing objects will not be alive.
-        deadThreads = [t for t in self.threads if not t.is_alive()]
-        self.threads = [t for t in self.threads if t not in deadThreads]
+            batch.append(urlItem)
+            queuedNum += 1
 
-        for t in deadThreads:
-            errorSuffix = '(' + t.GetUrl() + ')'
-
-            if isinstance(t.rval, Exception):
-                # Note that we can get a HTTPError or IOError as a result of a urlopen()
-                # failure, but we'll rely on other code to wrap such calls and won't check
-                # for them here.
-                if isinstance(t.rval, HTTPConnectError) or isinstance(t.rval, HTTPRequestError):
-                    if IsStr(t.urlItemObj):
-                        LogError('Error retrieving page', errorSuffix)
-                    else:
-                        if IsImageURL(t.urlItemObj.url):
-                            if not t.urlItemObj.url in self.failedImages:
-                                LogError('Error retrieving image', errorSuffix)
-                                self.failedImages.append(t.urlItemObj.url)
-                        else:
-                            if not t.urlItemObj.url in self.failedUrls:
-                                LogError('Error retrieving data', errorSuffix)
-                                self.failedUrls.append(t.urlItemObj.url)
-                elif isinstance(t.rval, WriteError):
-                    LogError('Error:', ToStr(t.rval), errorSuffix)
-                elif isinstance(t.rval, PageDetailsError):
-                    LogError('Problem when parsing page:', ToStr(t.rval), errorSuffix)
-                elif isinstance(t.rval, FileExistsError):
-                    LogError('File already exists:', ToStr(t.rval), errorSuffix)
-                elif isinstance(t.rval, WindowsDelayedWriteError):
-                    LogError('Failed to download file', errorSuffix)
-                elif isinstance(t.rval, LogicError):
-                    LogError('Error:', ToStr(t.rval), errorSuffix)
-                else:
-                    try:
-                        LogError('Raising exception from thread:', t.rval.traceback, errorSuffix)
-                    except AttributeError:
-                        LogError('Raising exception from thread:', errorSuffix)
-                    raise t.rval.__class__(ToStr(t.rval))
+        self.ReplayFrontierBatch(batch, bUserBatch)
+
+        for canonicalUrl, fileSavePath in self.journal.GetAliases():
+            entry = self.GetUrlIndexEntry(canonicalUrl)
+            if entry is not None:
+                self.AddFileAlias(canonicalUrl, entry, fileSavePath, bJournal=False)
+
+        LogInfo('Resuming crawl from journal with', queuedNum, 'queued items')
+
+    def ReplayFrontierBatch(self, urlItems, bUserItems):
+        if len(urlItems) == 0:
+            return
+        if bUserItems:
+            self.frontier.AddUserItems(urlItems)
+        else:
+            self.frontier.AddFoundItems(urlItems)
+
+    # Add the URL items which we haven't queued before to the frontier.
+    def QueueUrlItems(self, urlItems, bUserItems):
+        newUrlItems = self.FilterNewUrlItems(urlItems)
+
+        if self.journal is not None:
+            self.journal.AddItems(newUrlItems, bUserItems)
+
+        newUrlItems = [urlItem for canonicalUrl, urlItem in newUrlItems]
+        if bUserItems:
+            self.frontier.AddUserItems(newUrlItems)
+        else:
+            self.frontier.AddFoundItems(newUrlItems)
+
+    # Return (canonicalUrl, urlItem) for the URL items which we haven't queued before,
+    # and record them as queued. For files we've already queued, we instead arrange for
+    # the existing download to be copied to the new item's save path.
+    def FilterNewUrlItems(self, urlItems):
+        newUrlItems = []
+
+        for urlItem in urlItems:
+            if IsStr(urlItem):
+                canonicalUrl = CanonicalUrl(urlItem)
+                if canonicalUrl in self.urlItemSet:
+                    continue
+
+                self.urlItemSet.Add(canonicalUrl)
             else:
-                if t.rval is None:
-                    LogError('Error: Got nothing from parsing page', errorSuffix)
-                    return
+                canonicalUrl = CanonicalUrl(urlItem.url)
+                entry = self.GetUrlIndexEntry(canonicalUrl)
+                if entry is not None:
+                    if urlItem.bFile and entry.fileSavePath is not None and urlItem.fileSavePath != entry.fileSavePath:
+                        self.AddFileAlias(canonicalUrl, entry, urlItem.fileSavePath)
+                    continue
 
-                if not IsStr(t.urlItemObj) and not t.urlItemObj.bFile:
-                    itemNum = len(t.rval)
-                    if itemNum == 0:
-                        LogWarning("Warning: Didn't get any items from parsing page", errorSuffix)
-                    else:
-                        LogDebug('Got', len(t.rval), 'items from parsing page', errorSuffix)
+                self.urlIndex[canonicalUrl] = UrlIndexEntry(urlItem.group.saveDir, urlItem.fileName) if urlItem.bFile else UrlIndexEntry(None, None)
 
-                newUrlItems = t.rval
+            newUrlItems.append((canonicalUrl, urlItem))
 
-                # Note that a URL and a UrlItem wrapping that URL do not cause a clash,
-                # nor should they; standard procedure after getting a URL is to wrap it
-                # in a UrlItem.
+        return newUrlItems
 
-                newUrlItems = [urlItem for urlItem in newUrlItems if urlItem not in self.urlItemSet]
+    # Return the UrlIndexEntry for a canonical URL, or None if we haven't queued it. For
+    # finished items, this is a new entry made from what finishedUrlSet has on them.
+    def GetUrlIndexEntry(self, canonicalUrl):
+        entry = self.urlIndex.get(canonicalUrl)
+        if entry is not None:
+            return entry
 
-                newUrlItems = RemoveListDuplicates(newUrlItems)
+        value = self.finishedUrlSet.Get(canonicalUrl)
+        if value is None:
+            return None
 
-                self.urlItems = newUrlItems + self.urlItems
+        # The value is D (done) or F (failed), followed by the file's save path, if any.
+        entry = UrlIndexEntry(*SplitSavePath(value[1:] if len(value) > 1 else None))
+        entry.bDone = (value[0] == 'D')
+        entry.bFailed = (value[0] == 'F')
+        return entry
 
-                for urlItem in newUrlItems:
-                    if IsStr(urlItem):
-                        self.urlItemSet.add(urlItem)
-                    else:
-                        self.urlItemSet.add(urlItem.url)
+    # Move the entry of an item that's done or has failed from urlIndex to
+    # finishedUrlSet. Its aliases have all been linked by now.
+    def FinishUrlIndexEntry(self, canonicalUrl, entry):
+        self.urlIndex.pop(canonicalUrl, None)
+        self.finishedUrlSet.Add(canonicalUrl, ('D' if entry.bDone else 'F') + (entry.fileSavePath or ''))
+
+    def AddFileAlias(self, canonicalUrl, entry, fileSavePath, bJournal=True):
+        if entry.bFailed or fileSavePath in entry.aliasPaths:
+            return
 
-            g_timeoutHandler.UpdateDomainConnectFailCount(t.domainConnectFailCount)
+        if len(entry.aliasPaths) == 0:
+            entry.aliasPaths = []
+        entry.aliasPaths.append(fileSavePath)
+        if bJournal and self.journal is not None:
+            self.journal.AddAlias(canonicalUrl, fileSavePath)
 
-    def RunMainThread(self):
-        if self.bSingleThread:
-            while len(self.urlItems) > 0:
-                urlItem = self.urlItems[0]
-                self.urlItems = self.urlItems[1:]
-
-                fakeThread = DownloadThread(urlItem, copy.copy(self.plugins), copy.copy(self.rootDir))
-                self.threads.append(fakeThread)
-
-                # Run the code that the worker thread would normally run, but run
-                # that code in the main thread.
-                fakeThread.ProcessUrl()
-                self.CheckDeadThreads()
+        if entry.bDone:
+            self.LinkFileAlias(entry, fileSavePath)
+
+    def LinkFileAlias(self, entry, fileSavePath):
+        if SPEED_TEST and not SPEED_TEST_MAKES_FILES:
+            return
+
+        try:
+            self.output.Link(entry.fileSavePath, fileSavePath)
+            LogDebug('Linked', fileSavePath, 'to', entry.fileSavePath)
+        except (OSError, IOError, WriteError):
+            LogError('Error: Unable to copy', entry.fileSavePath, 'to', fileSavePath)
+
+    # Record how processing a URL item went, and for files, fill in any other paths the
+    # file is wanted at.
+    def RecordResult(self, t):
+        bUserItem = IsStr(t.urlItemObj)
+        canonicalUrl = CanonicalUrl(t.GetUrl())
+
+        # If a file already existed, it's still there to be used.
+        bFailed = t.rval is None or (isinstance(t.rval, Exception) and not isinstance(t.rval, FileExistsError))
+
+        if bFailed:
+            pluginId = GetPluginId(t.urlItemObj.plugin) if not bUserItem and t.urlItemObj.plugin is not None else ''
+            g_metrics.Count('failed_items', domain=GetDomain(t.GetUrl()), pluginId=pluginId)
+
+        if self.journal is not None:
+            if not bFailed:
+                self.journal.SetItemStatus(bUserItem, canonicalUrl, CrawlJournal.DONE)
+            elif t.rval is None:
+                self.journal.SetItemStatus(bUserItem, canonicalUrl, CrawlJournal.FAILED, 'Got nothing from parsing page')
+            else:
+                self.journal.SetItemStatus(bUserItem, canonicalUrl, CrawlJournal.FAILED, t.rval.__class__.__name__ + ': ' + ToStr(t.rval))
+
+        if bUserItem:
+            return
+
+        entry = self.urlIndex.get(canonicalUrl)
+        if entry is None:
+            return
+
+        if bFailed:
+            entry.bFailed = True
         else:
-            while self.bRunning:
-                # TODO in frontend, set bRunning to false when program is ready to exit.
-                self.CheckDeadThreads()
+            entry.bDone = True
+            for aliasPath in entry.aliasPaths:
+                self.LinkFileAlias(entry, aliasPath)
+        self.FinishUrlIndexEntry(canonicalUrl, entry)
+
+    # Check the DownloadThread objects that the workers have finished processing. If
+    # bBlock is set, wait until at least one of them is done (as long as any have been
+    # handed out), or until the timeout (in seconds) runs out.
+    def CheckDeadThreads(self, bBlock=False, timeout=None):
+        deadThreads = []
+        try:
+            if bBlock and (len(self.threads) > 0 or timeout is not None):
+                deadThreads.append(self.doneQueue.get(timeout=timeout))
+            while True:
+                deadThreads.append(self.doneQueue.get_nowait())
+        except queue.Empty:
+            pass
 
-                if len(self.urlItems) == 0 and len(self.threads) == 0:
-                    break
+        for t in deadThreads:
+            if t.fetchedPage is not None:
+                self.StartParse(t)
+                continue
 
-                while len(self.urlItems) > 0:
-                    if len(self.threads) < self.MAX_WORKER_THREADS:
-                        urlItem = self.urlItems[0]
-                        self.urlItems = self.urlItems[1:]
+            if t.parseFuture is not None:
+                self.FinishParse(t)
 
-                        thread = DownloadThread(copy.copy(urlItem), copy.copy(self.plugins), copy.copy(self.rootDir))
-                        self.threads.append(thread)
-                        thread.start()
+            self.threads.discard(t)
+            self.scheduler.Done(t.urlItemObj)
+            self.CheckDeadThread(t)
+
+        if self.journal is not None:
+            self.journal.MaybeFlush()
+
+    def CheckDeadThread(self, t):
+        errorSuffix = '(' + t.GetUrl() + ')'
+
+        self.RecordResult(t)
+
+        if isinstance(t.rval, Exception):
+            # Note that we can get a HTTPError or IOError as a result of a urlopen()
+            # failure, but we'll rely on other code to wrap such calls and won't check
+            # for them here.
+            if isinstance(t.rval, HTTPConnectError) or isinstance(t.rval, HTTPRequestError):
+                if IsStr(t.urlItemObj):
+                    LogError('Error retrieving page', errorSuffix)
+                else:
+                    if IsImageURL(t.urlItemObj.url):
+                        if not t.urlItemObj.url in self.failedImages:
+                            LogError('Error retrieving image', errorSuffix)
+                            self.failedImages.add(t.urlItemObj.url)
                     else:
-                        prevThreadNum = len(self.threads)
-                        self.CheckDeadThreads()
-                        if len(self.threads) >= prevThreadNum:
-                            break
+                        if not t.urlItemObj.url in self.failedUrls:
+                            LogError('Error retrieving data', errorSuffix)
+                            self.failedUrls.add(t.urlItemObj.url)
+            elif isinstance(t.rval, WriteError):
+                LogError('Error:', ToStr(t.rval), errorSuffix)
+            elif isinstance(t.rval, PageDetailsError):
+                LogError('Problem when parsing page:', ToStr(t.rval), errorSuffix)
+            elif isinstance(t.rval, FileExistsError):
+                LogError('File already exists:', ToStr(t.rval), errorSuffix)
+            elif isinstance(t.rval, WindowsDelayedWriteError):
+                LogError('Failed to download file', errorSuffix)
+            elif isinstance(t.rval, LogicError):
+                LogError('Error:', ToStr(t.rval), errorSuffix)
+            else:
+                try:
+                    LogError('Raising exception from thread:', t.rval.traceback, errorSuffix)
+                except AttributeError:
+                    LogError('Raising exception from thread:', errorSuffix)
+                raise t.rval.__class__(ToStr(t.rval))
+        else:
+            if t.rval is None:
+                LogError('Error: Got nothing from parsing page', errorSuffix)
+                return
+
+            if not IsStr(t.urlItemObj) and not t.urlItemObj.bFile:
+                itemNum = len(t.rval)
+                if itemNum == 0:
+                    LogWarning("Warning: Didn't get any items from parsing page", errorSuffix)
+                else:
+                    LogDebug('Got', len(t.rval), 'items from parsing page', errorSuffix)
+
+            self.QueueUrlItems(t.rval, bUserItems=False)
 
-                time.sleep(0.01)
+    # Hand the page that a worker thread fetched to parsePool. The thread comes back
+    # through doneQueue once the page has been parsed.
+    def StartParse(self, t):
+        urlInfo = copy.copy(t.urlItemObj)
+        urlInfo.plugin = GetPluginId(urlInfo.plugin)
+
+        fetchedPage = t.fetchedPage
+        t.fetchedPage = None
+        t.parseFuture = self.parsePool.submit(ParsePageInProcess, urlInfo, fetchedPage)
+        self.parsingThreads.add(t)
+        t.parseFuture.add_done_callback(lambda future: self.doneQueue.put(t))
+
+    def FinishParse(self, t):
+        self.parsingThreads.discard(t)
+
+        try:
+            newUrlItems, pages, metricsData = t.parseFuture.result()
+        except Exception as error:
+            t.rval = error
+            return
+        g_metrics.MergeData(metricsData)
+
+        # Pages that the parse process couldn't save itself. It's already timed
+        # serializing them.
+        for pageFilePath, html in pages:
+            try:
+                SavePageHtml(self.output, t.urlItemObj, [html], pageFilePath, True)
+            except WriteError as error:
+                t.rval = error
+                return
+
+        # Put back the plugins which ParsePageInProcess() took out of the new items.
+        pluginsById = dict((GetPluginId(plugin), plugin) for plugin in self.plugins)
+        for newUrlItem in newUrlItems:
+            if not IsStr(newUrlItem) and newUrlItem.plugin is not None:
+                newUrlItem.plugin = pluginsById[newUrlItem.plugin]
+        t.rval = newUrlItems
+
+    # Fail the items that the scheduler has set aside because their host is
+    # unavailable, without making any requests for them.
+    def FailUnavailableItems(self):
+        while True:
+            urlItem = self.scheduler.PopUnavailable()
+            if urlItem is None:
+                break
+
+            t = DownloadThread(urlItem, self.GetPluginIndex(), self.output)
+            t.rval = HostUnavailableError('Host is unavailable: ' + GetDomain(t.GetUrl()))
+            self.CheckDeadThread(t)
+
+    def StartWorkers(self):
+        # Note that we do this before starting the worker threads, and start the
+        # processes with spawn rather than fork, since forking a process while other
+        # threads are running isn't safe.
+        if self.parseProcessNum > 0:
+            # The parse processes log through a queue, which we pass on to g_logger.
+            context = multiprocessing.get_context('spawn')
+            logQueue = context.Queue()
+            self.parseLogListener = logging.handlers.QueueListener(logQueue, g_logger)
+            self.parseLogListener.start()
+
+            self.parsePool = concurrent.futures.ProcessPoolExecutor(max_workers=self.parseProcessNum, mp_context=context,
+                                                                    initializer=InitParseProcess,
+                                                                    initargs=(self.plugins, self.output.GetParseOutput(), logQueue, g_logger.getEffectiveLevel()))
+
+        for i in range(self.workerThreadNum):
+            worker = WorkerThread(self.workQueue, self.doneQueue)
+            self.workers.append(worker)
+            worker.start()
+
+    def StopWorkers(self):
+        # Take back anything the workers haven't started on yet; this only matters if
+        # we're stopping early.
+        try:
+            while True:
+                self.threads.discard(self.workQueue.get_nowait())
+        except queue.Empty:
+            pass
 
-            for thread in self.threads:
-                thread.join()
+        for worker in self.workers:
+            self.workQueue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+        if self.parsePool is not None:
+            self.parsePool.shutdown(wait=True)
+            self.parsePool = None
+
+            self.parseLogListener.stop()
+            self.parseLogListener = None
+
+    def RunMainThread(self):
+        try:
+            if self.bSingleThread:
+                while True:
+                    self.FeedUrlSources()
+                    if len(self.scheduler) == 0:
+                        break
+
+                    urlItem = self.scheduler.Pop()
+                    self.FailUnavailableItems()
+                    if urlItem is None:
+                        # Wait until the host's request rate lets us make the request.
+                        time.sleep(self.scheduler.GetWaitTime() or 0)
+                        continue
+
+                    fakeThread = DownloadThread(urlItem, self.GetPluginIndex(), self.output)
+                    self.threads.add(fakeThread)
+
+                    # Run the code that a worker thread would normally run, but run that
+                    # code in the main thread.
+                    fakeThread.ProcessUrl()
+                    self.doneQueue.put(fakeThread)
+                    self.CheckDeadThreads()
+                    self.MaybeDumpMetrics()
+            else:
+                self.StartWorkers()
+                try:
+                    # TODO in frontend, set bRunning to false when program is ready to exit.
+                    while self.bRunning:
+                        self.FeedUrlSources()
+
+                        # Don't hand out more items than there are workers to take them,
+                        # so that the items we get from parsing a page still go to the
+                        # front of the line. Pages being parsed in parsePool don't hold up
+                        # the workers, but we don't let too many of them pile up.
+                        while (len(self.threads) - len(self.parsingThreads) < len(self.workers)
+                               and (self.parsePool is None or len(self.parsingThreads) < self.MAX_PARSING_PAGES_PER_PROCESS * self.parseProcessNum)):
+                            urlItem = self.scheduler.Pop()
+                            self.FailUnavailableItems()
+                            if urlItem is None:
+                                break
+
+                            thread = DownloadThread(copy.copy(urlItem), self.GetPluginIndex(), self.output, self.parsePool is not None)
+                            self.threads.add(thread)
+                            self.workQueue.put(thread)
+
+                        if len(self.threads) == 0 and len(self.scheduler) == 0:
+                            break
+
+                        # Wait for a worker to finish, for a host that we're holding
+                        # back items for to be ready for another request, or for the
+                        # metrics to be due to be saved.
+                        timeout = self.scheduler.GetWaitTime()
+                        metricsDumpWaitTime = self.MaybeDumpMetrics()
+                        if metricsDumpWaitTime is not None and (timeout is None or metricsDumpWaitTime < timeout):
+                            timeout = metricsDumpWaitTime
+                        self.CheckDeadThreads(bBlock=True, timeout=timeout)
+                finally:
+                    self.StopWorkers()
+
+            if self.journal is not None and self.bRunning and len(self.scheduler) == 0 and len(self.threads) == 0 and len(self.urlSources) == 0:
+                self.journal.MarkFinished()
+        finally:
+            if self.journal is not None:
+                self.journal.Close()
+            self.output.Close()
+            self.urlItemSet.Close()
+            self.finishedUrlSet.Close()
+            if self.pluginStateStore is not None:
+                self.pluginStateStore.Close()
+            if self.metricsPath is not None:
+                self.DumpMetrics()
 
         LogInfo('Exiting main thread')
 
 
-class TimeoutHandler(object):
+# Thread-safe counters, and histograms of how long each stage of the work takes, so that
+# we can tell where the time in a crawl goes. Each is kept per domain and per plugin (by
+# ID); where these aren't given, those of the item that the current thread is working
+# on are used (see SetContext()). The stages are:
+#   connect: looking up and connecting to a host, including any TLS handshake
+#   ttfb: getting a response's headers, from when the request was started (so this
+#         includes connecting, if the request needed a new connection)
+#   body: reading a response's body, not counting time spent writing it to disk
+#   parse: parsing a page into a soup
+#   rewrite: going through a page's tags to find files and change their paths
+#   serialize: turning a page's soup back into HTML
+#   write: writing pages and files to disk
+#   archive: appending a page or file to an archive, with archive output (after it's
+#            been written to a temporary file, which counts as write)
+# Recording something takes a dict lookup and a short hold of a lock, so this is always
+# on.
+class MetricsRegistry(object):
+    # Upper bounds of the histogram buckets, in seconds. Each histogram also has a bucket
+    # for anything longer.
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    PROMETHEUS_PREFIX = 'sitedownloader_'
+
+    def __init__(self):
+        self.lock = Lock()
+        self.threadData = local()
+        # Maps (name, domain, pluginId) to a count.
+        self.counters = {}
+        # Maps (stage, domain, pluginId) to [bucketCounts, totalSeconds, count].
+        self.histograms = {}
+
+    # Set the domain and plugin ID that what the current thread records is put under.
+    def SetContext(self, domain, pluginId):
+        self.threadData.context = (domain, pluginId)
+
+    def GetKey(self, name, domain, pluginId):
+        if domain is None or pluginId is None:
+            contextDomain, contextPluginId = getattr(self.threadData, 'context', ('', ''))
+            if domain is None:
+                domain = contextDomain
+            if pluginId is None:
+                pluginId = contextPluginId
+        return (name, domain, pluginId)
+
+    def Count(self, name, value=1, domain=None, pluginId=None):
+        key = self.GetKey(name, domain, pluginId)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # Record that a stage took the given number of seconds.
+    def Observe(self, stage, seconds, domain=None, pluginId=None):
+        key = self.GetKey(stage, domain, pluginId)
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            histogram[0][bucket] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    # Return everything recorded since the last call, and forget it. This is how parse
+    # processes hand what they record back to SiteDownloader, which passes it to
+    # MergeData().
+    def TakeData(self):
+        with self.lock:
+            data = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+        return data
+
+    def MergeData(self, data):
+        counters, histograms = data
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+
+            for key, (bucketCounts, totalSeconds, count) in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+                histogram[0] = [a + b for a, b in zip(histogram[0], bucketCounts)]
+                histogram[1] += totalSeconds
+                histogram[2] += count
+
+    def Clear(self):
+        self.TakeData()
+
+    # Return everything recorded, in a form that can be saved as JSON. Bucket counts are
+    # cumulative, as in Prometheus, and keyed by the bucket's upper bound.
+    def GetSnapshot(self):
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (list(histogram[0]),) + tuple(histogram[1:])) for key, histogram in self.histograms.items())
+
+        snapshot = {'counters': [], 'stages': []}
+        for (name, domain, pluginId), value in counters:
+            snapshot['counters'].append({'name': name, 'domain': domain, 'plugin': pluginId, 'value': value})
+
+        for (stage, domain, pluginId), (bucketCounts, totalSeconds, count) in histograms:
+            buckets = collections.OrderedDict()
+            cumulativeCount = 0
+            for bound, bucketCount in zip(self.BUCKETS + ('+Inf',), bucketCounts):
+                cumulativeCount += bucketCount
+                buckets[str(bound)] = cumulativeCount
+            snapshot['stages'].append({'stage': stage, 'domain': domain, 'plugin': pluginId,
+                                       'count': count, 'seconds': totalSeconds, 'buckets': buckets})
+        return snapshot
+
+    # Return {stage: (count, totalSeconds)} over all domains and plugins.
+    def GetStageTotals(self):
+        totals = {}
+        with self.lock:
+            for (stage, domain, pluginId), histogram in self.histograms.items():
+                count, totalSeconds = totals.get(stage, (0, 0.0))
+                totals[stage] = (count + histogram[2], totalSeconds + histogram[1])
+        return totals
+
+    def FormatPrometheusLabels(self, labels):
+        return ','.join('{}="{}"'.format(name, ToStr(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                        for name, value in labels)
+
+    # Return everything recorded in the Prometheus text format.
+    def GetPrometheusText(self):
+        snapshot = self.GetSnapshot()
+        lines = []
+
+        counterNames = sorted(set(counter['name'] for counter in snapshot['counters']))
+        for name in counterNames:
+            metricName = self.PROMETHEUS_PREFIX + name + '_total'
+            lines.append('# TYPE {} counter'.format(metricName))
+            for counter in snapshot['counters']:
+                if counter['name'] == name:
+                    labels = self.FormatPrometheusLabels([('domain', counter['domain']), ('plugin', counter['plugin'])])
+                    lines.append('{}{{{}}} {}'.format(metricName, labels, counter['value']))
+
+        if len(snapshot['stages']) > 0:
+            metricName = self.PROMETHEUS_PREFIX + 'stage_seconds'
+            lines.append('# TYPE {} histogram'.format(metricName))
+            for stage in snapshot['stages']:
+                labels = [('stage', stage['stage']), ('domain', stage['domain']), ('plugin', stage['plugin'])]
+                for bound, cumulativeCount in stage['buckets'].items():
+                    lines.append('{}_bucket{{{}}} {}'.format(metricName, self.FormatPrometheusLabels(labels + [('le', bound)]), cumulativeCount))
+                lines.append('{}_sum{{{}}} {}'.format(metricName, self.FormatPrometheusLabels(labels), repr(stage['seconds'])))
+                lines.append('{}_count{{{}}} {}'.format(metricName, self.FormatPrometheusLabels(labels), stage['count']))
+
+        return '\n'.join(lines) + '\n'
+
+    # Save everything recorded to a file: as JSON if the file name ends in .json, and in
+    # the Prometheus text format otherwise. The file is replaced in one go, so that
+    # anything reading it never sees a partly written file.
+    def Dump(self, filePath):
+        if filePath.endswith('.json'):
+            text = json.dumps(self.GetSnapshot(), indent=2)
+        else:
+            text = self.GetPrometheusText()
+
+        tempPath = filePath + '.tmp'
+        try:
+            with io.open(tempPath, 'w', encoding='utf-8') as outFile:
+                outFile.write(ToStr(text))
+            os.replace(tempPath, filePath)
+        except (OSError, IOError):
+            raise WriteError('Unable to write metrics file: ' + filePath)
+
+
+g_metrics = MetricsRegistry()
+
+
+# Return the requests adapter class which g_sessionPool uses, whose urllib3 connections
+# record how long connecting takes in g_metrics. The classes are only defined the first
+# time this is called, since that needs requests and urllib3 imported.
+def GetTimedHTTPAdapterClass():
+    global g_timedHTTPAdapterClass
+    if g_timedHTTPAdapterClass is not None:
+        return g_timedHTTPAdapterClass
+
+    import requests.adapters
+    import urllib3.connection
+    import urllib3.connectionpool
+
+    class TimedHTTPConnection(urllib3.connection.HTTPConnection):
+        def connect(self):
+            startTime = time.perf_counter()
+            urllib3.connection.HTTPConnection.connect(self)
+            g_metrics.Observe('connect', time.perf_counter() - startTime, domain=GetDomain(self.host))
+
+    class TimedHTTPSConnection(urllib3.connection.HTTPSConnection):
+        def connect(self):
+            startTime = time.perf_counter()
+            urllib3.connection.HTTPSConnection.connect(self)
+            g_metrics.Observe('connect', time.perf_counter() - startTime, domain=GetDomain(self.host))
+
+    class TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+        ConnectionCls = TimedHTTPConnection
+
+    class TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+        ConnectionCls = TimedHTTPSConnection
+
+    class TimedHTTPAdapter(requests.adapters.HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            requests.adapters.HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {'http': TimedHTTPConnectionPool, 'https': TimedHTTPSConnectionPool}
+
+    g_timedHTTPAdapterClass = TimedHTTPAdapter
+    return g_timedHTTPAdapterClass
+
+g_timedHTTPAdapterClass = None
+
+
+# What HostHealthMonitor knows about a single host.
+class HostHealth(object):
+    def __init__(self, latencySampleNum):
+        # How long recent successful requests took to get a response, in seconds.
+        self.latencies = collections.deque(maxlen=latencySampleNum)
+        # Number of requests in a row that failed, and the number of those that failed
+        # because we couldn't connect in time.
+        self.failNum = 0
+        self.connectFailNum = 0
+        self.circuitState = HostHealthMonitor.CIRCUIT_CLOSED
+        self.openUntil = 0
+        self.openTime = 0
+        # URL of the item that was let through while the circuit was half open.
+        self.trialUrl = None
+
+
+# Keeps track of how each host (as returned by GetDomain) is doing, from the results
+# of the requests that all threads make to it, and uses that to decide how long to wait
+# for the host, when to retry a request, and when to stop making requests to the host
+# for a while.
+#
+# Timeouts are based on how long the host usually takes to respond, so that we don't
+# wait for the default timeouts on a host that normally responds in a fraction of a
+# second. If requests to a host keep failing, the host's circuit breaker opens: requests
+# for the host fail at once (with HostUnavailableError) for a while, and then a single
+# request is let through to see whether the host has recovered. Each time that request
+# fails, we wait longer before trying again.
+class HostHealthMonitor(object):
     PAGE_FILE_EXTENSIONS = ['.html', '.htm', '.php', '.asp']
     NON_IMAGE_DOWNLOAD_FILE_EXTENSIONS = ['.css', '.js']
 
-    def __init__(self, urlList=None, rootDir=None, defaultConnectTimeout=10, defaultReadTimeout=10, connectAttempts=3):
+    # Statuses which mean that the host might give us what we asked for if we try again
+    # later. Other statuses, like 404, are final.
+    RETRYABLE_STATUS_CODES = frozenset([429, 500, 502, 503, 504])
+
+    LATENCY_SAMPLE_NUM = 100
+    # Number of latency samples we need before we stop using the default timeouts.
+    MIN_LATENCY_SAMPLE_NUM = 10
+    LATENCY_PERCENTILE = 0.95
+    # Wait this many times the latency percentile before giving up on a response.
+    LATENCY_TIMEOUT_MULTIPLIER = 4
+
+    # Requests are let through as normal.
+    CIRCUIT_CLOSED = 0
+    # Requests fail at once.
+    CIRCUIT_OPEN = 1
+    # The host has been unavailable long enough that we can try a request again.
+    CIRCUIT_HALF_OPEN = 2
+    # A request to find out whether the host has recovered is in progress.
+    CIRCUIT_TRIAL = 3
+
+    def __init__(self, defaultConnectTimeout=10, defaultReadTimeout=10, connectAttempts=3, minTimeout=2,
+                 failureThreshold=5, openTime=30, maxOpenTime=600, backoffTime=1, maxBackoffTime=30):
         self.defaultConnectTimeout = defaultConnectTimeout
         self.defaultReadTimeout = defaultReadTimeout
         self.connectAttempts = connectAttempts
-        self.domainConnectFailCount = collections.defaultdict(int)
+        self.minTimeout = minTimeout
+        self.failureThreshold = failureThreshold
+        self.openTime = openTime
+        self.maxOpenTime = maxOpenTime
+        self.backoffTime = backoffTime
+        self.maxBackoffTime = maxBackoffTime
+        self.hosts = {}
+        self.lock = Lock()
+
+    # Note that this must be called with the lock held.
+    def GetHost(self, domain):
+        health = self.hosts.get(domain)
+        if health is None:
+            health = HostHealth(self.LATENCY_SAMPLE_NUM)
+            self.hosts[domain] = health
+        return health
 
     # Return the (connectTimeout, readTimeout) that we want to use when trying to get the
-    # file at the URL. Note that the URL timeout handler tracks the domain (or, actually,
-    # subdomain) associated with each URL we access. If URLs from a subdomain often fails
-    # connect timeout checks, the timeout handler decreases the connect timeout used for
-    # URLs from that subdomain. This will probably result in the connect timeout failure
-    # count getting ever higher -- since we now wait less long to find out whether a
-    # connection "failed".
+    # file at the URL. Once we've seen enough responses from the URL's host, the
+    # timeouts are a multiple of how long the host usually takes to respond, but never
+    # more than the defaults. If connections to the host keep timing out, we also wait
+    # less long to connect when getting images from it, since those matter less than
+    # pages.
     def GetUrlTimeouts(self, fileUrl):
         domain, domainEndPos = GetDomain(fileUrl, bReturnEndPos=True)
 
@@ -338,35 +2690,489 @@ class TimeoutHandler(object):
                 if questionMarkPos != -1:
                     fileExt = fileExt[:questionMarkPos]
 
-        if fileExt is None or fileExt in self.PAGE_FILE_EXTENSIONS:
-            return (self.defaultConnectTimeout, self.defaultReadTimeout)
-        elif fileExt in self.NON_IMAGE_DOWNLOAD_FILE_EXTENSIONS:
-            return (self.defaultConnectTimeout, self.defaultReadTimeout)
-        else:
-            return self.GetImageUrlTimeouts(fileUrl, domain, fileExt, self.domainConnectFailCount[domain])
+        connectTimeout = self.defaultConnectTimeout
+        readTimeout = self.defaultReadTimeout
+
+        with self.lock:
+            health = self.GetHost(domain)
+            if len(health.latencies) >= self.MIN_LATENCY_SAMPLE_NUM:
+                latencies = sorted(health.latencies)
+                latency = latencies[int(self.LATENCY_PERCENTILE * (len(latencies) - 1))]
+                timeout = max(self.minTimeout, latency * self.LATENCY_TIMEOUT_MULTIPLIER)
+                connectTimeout = min(connectTimeout, timeout)
+                readTimeout = min(readTimeout, timeout)
+            connectFailNum = health.connectFailNum
+
+        if fileExt is not None and fileExt not in self.PAGE_FILE_EXTENSIONS and fileExt not in self.NON_IMAGE_DOWNLOAD_FILE_EXTENSIONS:
+            if connectFailNum > 20:
+                connectTimeout /= 4.0
+            elif connectFailNum > 5:
+                connectTimeout /= 2.0
+
+        return (connectTimeout, readTimeout)
+
+    # Return how many seconds to wait before making another attempt at a request, given
+    # the number of the attempt and the response to the last attempt (None if we didn't
+    # get one). The wait doubles with each attempt, with some randomness so that the
+    # threads that are retrying requests to a host don't all retry at once.
+    def GetBackoffTime(self, attempt, r=None):
+        backoffTime = min(self.maxBackoffTime, self.backoffTime * 2 ** (attempt - 1))
+        backoffTime = random.uniform(backoffTime / 2.0, backoffTime)
+
+        # Respect the host's wishes, within reason. Note that we don't handle Retry-After
+        # dates, only numbers of seconds.
+        if r is not None and r.status_code in (429, 503):
+            try:
+                backoffTime = max(backoffTime, min(self.maxBackoffTime, float(r.headers.get('Retry-After'))))
+            except (TypeError, ValueError):
+                pass
+        return backoffTime
+
+    # Note that this must be called with the lock held.
+    def UpdateCircuitState(self, health):
+        if health.circuitState == self.CIRCUIT_OPEN and time.time() >= health.openUntil:
+            health.circuitState = self.CIRCUIT_HALF_OPEN
+
+    def GetCircuitState(self, domain):
+        with self.lock:
+            health = self.GetHost(domain)
+            self.UpdateCircuitState(health)
+            return health.circuitState
+
+    def IsCircuitOpen(self, domain):
+        return self.GetCircuitState(domain) == self.CIRCUIT_OPEN
+
+    # Record that we're about to let the item for a URL through to a host whose circuit
+    # is half open, to find out whether the host has recovered.
+    def StartTrial(self, domain, url):
+        with self.lock:
+            health = self.GetHost(domain)
+            self.UpdateCircuitState(health)
+            if health.circuitState == self.CIRCUIT_HALF_OPEN:
+                health.circuitState = self.CIRCUIT_TRIAL
+                health.trialUrl = url
+
+    # Record that the item for a URL is done. If it's the one we let through to the host
+    # and it ended without making a request, another request can be let through. Other
+    # items for the host, which were handed out before its circuit opened, don't count.
+    def EndTrial(self, domain, url):
+        with self.lock:
+            health = self.GetHost(domain)
+            if health.trialUrl != url:
+                return
+            health.trialUrl = None
+            if health.circuitState == self.CIRCUIT_TRIAL:
+                health.circuitState = self.CIRCUIT_HALF_OPEN
+
+    # Record a response from a host. Returns whether it's worth trying the request again.
+    def RecordResponse(self, domain, r):
+        if r.status_code in self.RETRYABLE_STATUS_CODES:
+            self.RecordFailure(domain)
+            return True
+
+        with self.lock:
+            health = self.GetHost(domain)
+            health.latencies.append(r.elapsed.total_seconds())
+            health.failNum = 0
+            health.connectFailNum = 0
+            if health.circuitState != self.CIRCUIT_CLOSED:
+                LogInfo('Host is available again:', domain)
+                health.circuitState = self.CIRCUIT_CLOSED
+                health.openTime = 0
+        return False
+
+    # Record a request to a host that failed, either because we didn't get a response,
+    # or because the response said to try again later.
+    def RecordFailure(self, domain, bConnectTimeout=False):
+        with self.lock:
+            health = self.GetHost(domain)
+            health.failNum += 1
+            if bConnectTimeout:
+                health.connectFailNum += 1
+
+            self.UpdateCircuitState(health)
+            if health.circuitState == self.CIRCUIT_CLOSED:
+                if health.failNum < self.failureThreshold:
+                    return
+                health.openTime = self.openTime
+            elif health.circuitState == self.CIRCUIT_OPEN:
+                return
+            else:
+                health.openTime = min(self.maxOpenTime, health.openTime * 2)
 
-    def GetImageUrlTimeouts(self, fileUrl, domain, fileExt, domainConnectFailCount):
-        if domainConnectFailCount > 5:
-            return (self.defaultConnectTimeout // 2, self.defaultReadTimeout)
-        if domainConnectFailCount > 20:
-            return (self.defaultConnectTimeout // 4, self.defaultReadTimeout)
-        else:
-            return (self.defaultConnectTimeout, self.defaultReadTimeout)
+            health.circuitState = self.CIRCUIT_OPEN
+            health.openUntil = time.time() + health.openTime
+            LogWarning('Too many failed requests; not making requests for', health.openTime, 'seconds to host:', domain)
+
+
+g_hostHealth = HostHealthMonitor()
+
+
+# Make a request with requestFunc (e.g. the get method of a session from
+# g_sessionPool), keeping g_hostHealth up to date. If we can't get a response, or the
+# response says to try again later, the request is retried after a backoff, up to
+# attemptNum attempts in all. Returns the last response we got, whatever its status.
+def MakeRequest(requestFunc, url, attemptNum=None, **kwargs):
+    if attemptNum is None:
+        attemptNum = g_hostHealth.connectAttempts
+
+    domain = GetDomain(url)
+    r = None
+    for attempt in range(attemptNum):
+        if attempt > 0:
+            if r is not None:
+                r.close()
+            time.sleep(g_hostHealth.GetBackoffTime(attempt, r))
+            g_metrics.Count('retries', domain=domain)
+
+        if g_hostHealth.IsCircuitOpen(domain):
+            raise HostUnavailableError('Host is unavailable: ' + domain)
 
-    # Note that this function is not thread-safe. However, it is currently called only
-    # from the main thread.
-    def UpdateDomainConnectFailCount(self, domainConnectFailCount):
-        for domain, connectFailCount in domainConnectFailCount.items():
-            self.domainConnectFailCount[domain] += connectFailCount
+        startTime = time.perf_counter()
+        try:
+            r = requestFunc(url, timeout=g_hostHealth.GetUrlTimeouts(url), **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.ChunkedEncodingError) as error:
+            g_metrics.Count('request_failures', domain=domain)
+            g_hostHealth.RecordFailure(domain, bConnectTimeout=isinstance(error, requests.exceptions.ConnectTimeout))
+            if attempt == attemptNum - 1:
+                raise HTTPConnectError('Request failed')
+            r = None
+            continue
+
+        # Unless the request is streamed, requests has read the body by now, after
+        # timing how long the headers took.
+        ttfbTime = r.elapsed.total_seconds()
+        g_metrics.Count('requests', domain=domain)
+        g_metrics.Observe('ttfb', ttfbTime, domain=domain)
+        if not kwargs.get('stream'):
+            g_metrics.Observe('body', max(time.perf_counter() - startTime - ttfbTime, 0), domain=domain)
+            g_metrics.Count('bytes_downloaded', len(r.content), domain=domain)
+
+        if not g_hostHealth.RecordResponse(domain, r):
+            break
+    return r
+
+
+# Keeps the HTTP connections that all worker threads use, so that page and file
+# requests to a host reuse the same keep-alive connections (and TLS sessions) instead
+# of each opening a new one. Each host (as returned by GetDomain) gets its own
+# connection pool, held by a requests HTTPAdapter. Sessions aren't guaranteed to be
+# thread-safe, so each thread gets its own session per host, but all of a host's
+# sessions share the host's adapter, and its connection pool is thread-safe.
+class HTTPSessionPool(object):
+    DEFAULT_POOL_SIZE = 10
+
+    def __init__(self, defaultPoolSize=DEFAULT_POOL_SIZE):
+        self.defaultPoolSize = defaultPoolSize
+        self.hostPoolSizes = {}
+        self.adapters = {}
+        self.lock = Lock()
+        self.threadData = local()
+
+    # Note that this only affects hosts that we haven't connected to yet.
+    def SetDefaultPoolSize(self, poolSize):
+        with self.lock:
+            self.defaultPoolSize = poolSize
+
+    # Set the maximum number of connections we keep open to a host. Note that this only
+    # affects hosts that we haven't connected to yet.
+    def SetHostPoolSize(self, domain, poolSize):
+        with self.lock:
+            self.hostPoolSizes[domain] = poolSize
+
+    def GetAdapter(self, domain):
+        with self.lock:
+            adapter = self.adapters.get(domain)
+            if adapter is None:
+                poolSize = self.hostPoolSizes.get(domain, self.defaultPoolSize)
+
+                # Note that a single domain can still need several connection pools,
+                # e.g. for http and https, or for a www. prefix.
+                adapter = GetTimedHTTPAdapterClass()(pool_connections=4, pool_maxsize=poolSize)
+                self.adapters[domain] = adapter
+            return adapter
+
+    # Returns a requests session, for use by the current thread only, which makes its
+    # requests using the shared connection pool for the URL's host.
+    def GetSession(self, url):
+        try:
+            sessions = self.threadData.sessions
+        except AttributeError:
+            sessions = self.threadData.sessions = {}
+
+        domain = GetDomain(url)
+        session = sessions.get(domain)
+        if session is None:
+            session = requests.session()
+            session.headers = requests.utils.default_headers()
+            session.headers.update({'User-Agent': GetUserAgent()})
+
+            adapter = self.GetAdapter(domain)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            sessions[domain] = session
+        return session
+
+    def Close(self):
+        with self.lock:
+            for adapter in self.adapters.values():
+                adapter.close()
+            self.adapters = {}
+
+
+g_sessionPool = HTTPSessionPool()
+
+
+# Decides which files we download over several connections at once, and limits the
+# total number of those connections we make to each host.
+class ParallelDownloadHandler(object):
+    def __init__(self, sizeThreshold=16 * 1024 * 1024, connectionsPerFile=4, connectionsPerHost=8):
+        # Files of at least this size are downloaded in parallel. Zero or None turns
+        # parallel downloads off.
+        self.sizeThreshold = sizeThreshold
+        self.connectionsPerFile = connectionsPerFile
+        self.connectionsPerHost = connectionsPerHost
+        self.hostConnectionLimits = {}
+        self.hostSemaphores = {}
+        self.lock = Lock()
+
+    # Note that limits only affect hosts that we haven't connected to yet.
+    def SetLimits(self, sizeThreshold=None, connectionsPerFile=None, connectionsPerHost=None):
+        with self.lock:
+            if sizeThreshold is not None:
+                self.sizeThreshold = sizeThreshold
+            if connectionsPerFile is not None:
+                self.connectionsPerFile = connectionsPerFile
+            if connectionsPerHost is not None:
+                self.connectionsPerHost = connectionsPerHost
+
+    def SetHostConnectionLimit(self, domain, connectionsPerHost):
+        with self.lock:
+            self.hostConnectionLimits[domain] = connectionsPerHost
+
+    # Byte ranges count the bytes that are sent, so compressed responses can't be split
+    # up, since we write what they decompress to.
+    def ShouldDownloadInParallel(self, r, fileSize):
+        return (self.sizeThreshold and self.connectionsPerFile > 1 and fileSize is not None and fileSize >= self.sizeThreshold
+                and r.headers.get('Accept-Ranges', '').lower() == 'bytes' and 'Content-Encoding' not in r.headers
+                and len(self.GetRanges(fileSize)) >= 2)
+
+    # Return a list of (start, end) byte ranges, with inclusive ends, to split a file
+    # into.
+    def GetRanges(self, fileSize):
+        rangeSize = -(-fileSize // self.connectionsPerFile)
+        return [(start, min(start + rangeSize, fileSize) - 1) for start in range(0, fileSize, rangeSize)]
+
+    # Return the semaphore that limits the number of extra connections we make to a host
+    # to download parts of files.
+    def GetHostSemaphore(self, domain):
+        with self.lock:
+            semaphore = self.hostSemaphores.get(domain)
+            if semaphore is None:
+                semaphore = BoundedSemaphore(self.hostConnectionLimits.get(domain, self.connectionsPerHost))
+                self.hostSemaphores[domain] = semaphore
+            return semaphore
+
+
+g_parallelDownloadHandler = ParallelDownloadHandler()
+
+
+# An entry in ResponseCache.
+class CachedResponse(object):
+    def __init__(self, r, expiryTime):
+        self.r = r
+        self.soup = None
+        self.expiryTime = expiryTime
+        # Approximate number of bytes the entry uses.
+        self.size = len(r.content)
+
+
+# Keeps recent responses to GetPage() requests for plugins, so that they don't request
+# the same page twice. For example, VBulletinForumProcessor gets the first page of each
+# thread to find out how many pages the thread has, and then gets the page again when it
+# processes it. Responses are keyed by canonical URL and expire maxAge seconds after we
+# get them, and the least recently used ones are thrown away to keep the total size of
+# the cache under maxBytes. If bCacheSoups is set, the cache can also keep the soups of
+# pages; see SiteDownloaderPlugin.GetPageSoup().
+class ResponseCache(object):
+    # Rough size of a soup, as a multiple of the size of its page.
+    SOUP_SIZE_FACTOR = 20
+
+    def __init__(self, maxBytes=32 * 1024 * 1024, maxAge=600, bCacheSoups=False):
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.bCacheSoups = bCacheSoups
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hitNum = 0
+        self.missNum = 0
+        self.lock = Lock()
+
+    # Zero or None for maxBytes turns the cache off.
+    def SetLimits(self, maxBytes=None, maxAge=None, bCacheSoups=None):
+        with self.lock:
+            if maxBytes is not None:
+                self.maxBytes = maxBytes
+            if maxAge is not None:
+                self.maxAge = maxAge
+            if bCacheSoups is not None:
+                self.bCacheSoups = bCacheSoups
+            self.Evict()
+
+    # Return the unexpired entry for the URL, or None. Note that this must be called with
+    # the lock held.
+    def GetEntry(self, url):
+        canonicalUrl = CanonicalUrl(url)
+        entry = self.entries.get(canonicalUrl)
+        if entry is None:
+            return None
+
+        if time.time() >= entry.expiryTime:
+            self.RemoveEntry(canonicalUrl)
+            return None
+
+        # Move the entry to the end, as the most recently used.
+        self.entries[canonicalUrl] = self.entries.pop(canonicalUrl)
+        return entry
+
+    # Note that this must be called with the lock held.
+    def RemoveEntry(self, canonicalUrl):
+        self.size -= self.entries.pop(canonicalUrl).size
+
+    # Throw away the least recently used entries until the cache is small enough. Note
+    # that this must be called with the lock held.
+    def Evict(self):
+        while len(self.entries) > 0 and (not self.maxBytes or self.size > self.maxBytes):
+            self.RemoveEntry(next(iter(self.entries)))
+
+    def GetResponse(self, url):
+        with self.lock:
+            entry = self.GetEntry(url)
+            if entry is None:
+                self.missNum += 1
+                return None
+
+            self.hitNum += 1
+            return entry.r
+
+    def AddResponse(self, url, r):
+        with self.lock:
+            if not self.maxBytes:
+                return
+
+            canonicalUrl = CanonicalUrl(url)
+            if canonicalUrl in self.entries:
+                self.RemoveEntry(canonicalUrl)
+
+            entry = CachedResponse(r, time.time() + self.maxAge)
+            self.entries[canonicalUrl] = entry
+            self.size += entry.size
+            self.Evict()
+
+    # Return the cached soup of the page at the URL, or None. If bTake is set, the soup
+    # is removed from the cache, so that nobody else gets it.
+    def GetSoup(self, url, bTake=False):
+        with self.lock:
+            entry = self.GetEntry(url)
+            if entry is None or entry.soup is None:
+                return None
+
+            soup = entry.soup
+            if bTake:
+                entry.soup = None
+                entry.size -= len(entry.r.content) * self.SOUP_SIZE_FACTOR
+                self.size -= len(entry.r.content) * self.SOUP_SIZE_FACTOR
+            return soup
+
+    # Keep the soup of a page whose response is in the cache.
+    def AddSoup(self, url, soup):
+        with self.lock:
+            entry = self.GetEntry(url)
+            if entry is None or entry.soup is not None:
+                return
+
+            entry.soup = soup
+            entry.size += len(entry.r.content) * self.SOUP_SIZE_FACTOR
+            self.size += len(entry.r.content) * self.SOUP_SIZE_FACTOR
+            self.Evict()
+
+    def Clear(self):
+        with self.lock:
+            self.entries = collections.OrderedDict()
+            self.size = 0
 
 
-g_timeoutHandler = TimeoutHandler()
+g_responseCache = ResponseCache()
 
 
+# A page that a plugin has fetched, for its ParseUrlInfo(). This can be pickled to send
+# it to a parse process, in which case the response and the soup (if any) aren't sent
+# along.
+class FetchedPage(object):
+    def __init__(self, url, text, soup=None, r=None):
+        self.url = url
+        self.text = text
+        self.soup = soup
+        self.r = r
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['soup'] = None
+        state['r'] = None
+        return state
+
+
+# Plugins can process pages in one go, by overriding ProcessUrlInfo(), or split the work
+# in two by setting bSplitProcessing and overriding FetchUrlInfo() and ParseUrlInfo()
+# instead. FetchUrlInfo() runs in a worker thread, and does everything that needs the
+# network or the plugin's state. ParseUrlInfo() only parses and changes the page, and if
+# SiteDownloader is using parse processes, it runs in one of those, on a copy of the
+# plugin. Plugins that do this must therefore be picklable.
 class SiteDownloaderPlugin(object):
+    # PluginStateStore for remembering things between runs. This is set when the plugin
+    # is added to a SiteDownloader.
+    stateStore = None
+
+    bSplitProcessing = False
+
+    # Which user-added URLs the plugin handles, as a list of (host, pathRegex,
+    # relevance), where host is a domain in the form GetDomain() returns, or '*' for any
+    # host, and pathRegex matches the start of the rest of the URL (from the slash after
+    # the domain on). These are looked up in a PluginDispatchIndex, instead of calling
+    # GetPageRelevance(). Plugins that don't have any, or that set bDynamicRelevance,
+    # have GetPageRelevance() called for every user-added URL. Both are kept in the
+    # PluginManifest, so they shouldn't depend on the plugin's settings.
+    urlPatterns = None
+    bDynamicRelevance = False
+
+    # The state store is left out when the plugin is pickled for a parse process, so
+    # plugin state isn't available in ParseUrlInfo().
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('stateStore', None)
+        return state
+
     def ProcessorName(self):
         return ''
 
+    # Apply the plugin's section of the settings file, if it has one. This is a
+    # mapping of setting names to string values.
+    def ApplySettings(self, settings):
+        pass
+
+    def GetState(self, key, default=None):
+        if self.stateStore is None:
+            return default
+        return self.stateStore.Get(GetPluginId(self), key, default)
+
+    def SetState(self, key, value):
+        if self.stateStore is not None:
+            self.stateStore.Set(GetPluginId(self), key, value)
+
+    # How well the plugin handles a user-added URL, or 0 if it doesn't handle it at all.
+    # This is only called for plugins without urlPatterns, or with bDynamicRelevance
+    # set; see PluginDispatchIndex.
     def GetPageRelevance(self, url):
         return 0
 
@@ -376,27 +3182,50 @@ class SiteDownloaderPlugin(object):
     def GetPageCategory(self, url, soup):
         return None
 
+    # Return the name of the archive that a save path belongs in, when saving to tar
+    # archives (see TarOutput), or None to leave it to the default grouping.
+    def GetArchiveName(self, savePath):
+        return None
+
     # Returns newUrlItems
     def ProcessUserAddedUrl(self, url):
         return []
 
     # Returns (newUrlItems, pageSoupToWrite, pageSoupToWriteFilePath)
     def ProcessUrlInfo(self, urlInfo):
+        if self.bSplitProcessing:
+            return self.ParseUrlInfo(urlInfo, self.FetchUrlInfo(urlInfo))
         return [], None, None
 
-    # Returns a requests.Response object which contains the result of a POST or GET
-    # request to a URL.
-    def GetPage(self, url, data=None, headers=None, cookies=None, loginCredentials=None):
-        client = requests.session()
-        client.headers = requests.utils.default_headers()
+    # Returns a FetchedPage. By default, this includes the page's soup, if it was kept in
+    # g_responseCache.
+    def FetchUrlInfo(self, urlInfo):
+        r = self.GetPage(urlInfo.url)
+        return FetchedPage(urlInfo.url, r.text, g_responseCache.GetSoup(urlInfo.url, bTake=True), r)
 
-        client.headers.update({'User-Agent': GetUserAgent()})
+    # Returns (newUrlItems, pageSoupToWrite, pageSoupToWriteFilePath)
+    def ParseUrlInfo(self, urlInfo, fetchedPage):
+        return [], None, None
 
-        if headers is not None:
-            client.headers.update(headers)
+    # Returns a requests.Response object which contains the result of a POST or GET
+    # request to a URL. If bConditional is set, the headers should make the request
+    # conditional (e.g. with If-None-Match), and a 304 Not Modified response is returned
+    # rather than treated as an error. Plain GET requests go through g_responseCache, so
+    # the response may be one that we got earlier for the same URL.
+    def GetPage(self, url, data=None, headers=None, cookies=None, loginCredentials=None, bConditional=False):
+        bCacheable = data is None and headers is None and cookies is None and not bConditional
+        if bCacheable:
+            r = g_responseCache.GetResponse(url)
+            if r is not None:
+                return r
+
+        client = g_sessionPool.GetSession(url)
 
         assembledKwargs = {}
 
+        if headers is not None:
+            assembledKwargs['headers'] = headers
+
         if data is not None:
             assembledKwargs['data'] = data
 
@@ -406,39 +3235,56 @@ class SiteDownloaderPlugin(object):
         if loginCredentials is not None:
             assembledKwargs.update(loginCredentials)
 
-        r = None
-        for attempt in range(g_timeoutHandler.connectAttempts):
-            try:
-                if data is not None:
-                    r = client.post(url, timeout=g_timeoutHandler.GetUrlTimeouts(url), **assembledKwargs)
-                else:
-                    r = client.get(url, timeout=g_timeoutHandler.GetUrlTimeouts(url), **assembledKwargs)
+        r = MakeRequest(client.post if data is not None else client.get, url, **assembledKwargs)
 
-                if r.status_code != 200:
-                    continue
+        if r.status_code == 304 and bConditional:
+            return r
 
-                break
-            except (requests.exceptions.ProxyError, requests.exceptions.ConnectionError):
-                if attempt == g_timeoutHandler.connectAttempts - 1:
-                    raise HTTPConnectError('Request failed')
-
-        if r is None or r.status_code != 200:
+        if r.status_code != 200:
             raise HTTPRequestError('Request failed')
+
+        if bCacheable:
+            g_responseCache.AddResponse(url, r)
         return r
 
-    def GetSoup(self, html, soupStrainer=None):
-        # Limit the type of tags we parse, to speed up BeautifulSoup's parsing.
-        try:
-            if soupStrainer is not None:
-                return BeautifulSoup(html, features='lxml', parse_only=strainer)
-            else:
-                return BeautifulSoup(html, features='lxml')
-        except bs4.FeatureNotFound:
-            LogInfo('lxml parser not available, using default html parser')
-            if soupStrainer is not None:
-                return BeautifulSoup(html, features='html.parser', parse_only=strainer)
+    # Returns (r, soup) for the page at the URL, as from GetPage() and GetSoup(). If
+    # bWillChange isn't set, the caller promises not to change the soup, so that it can
+    # be kept in g_responseCache (if the cache keeps soups) for the next caller; in that
+    # case, the soup may be a full one even if a SoupStrainer is given. Otherwise, a soup
+    # kept in the cache is taken out of it and returned.
+    def GetPageSoup(self, url, soupStrainer=None, bWillChange=True):
+        r = self.GetPage(url)
+
+        soup = g_responseCache.GetSoup(url, bTake=bWillChange)
+        if soup is None:
+            if not bWillChange and g_responseCache.bCacheSoups:
+                soup = self.GetSoup(r.text)
+                g_responseCache.AddSoup(url, soup)
             else:
-                return BeautifulSoup(html, features='html.parser')
+                soup = self.GetSoup(r.text, soupStrainer)
+        return r, soup
+
+    # Returns a BeautifulSoup tree of the page. If a SoupStrainer is given, only the tags
+    # that it matches are parsed, which is a lot faster when we only need a few tags.
+    # Note that strainers see the raw value of multi-valued attributes like class, so
+    # e.g. {'class': 'popupctrl'} doesn't match class="popupctrl menu".
+    def GetSoup(self, html, soupStrainer=None):
+        startTime = time.perf_counter()
+        soup = bs4.BeautifulSoup(html, features=g_soupParser, parse_only=soupStrainer)
+        g_metrics.Observe('parse', time.perf_counter() - startTime)
+        return soup
+
+    # Yields (tagName, attrs, text) for the tags in the page, in document order, without
+    # building a tree; this is the fastest way to read a page if we don't need to change
+    # it. attrs is a dict of the tag's attributes, with string values (so class="a b"
+    # gives 'a b'), and text is the text that comes directly after the start tag, before
+    # any other tag, or None if there isn't any. If tagNames is given, only tags with
+    # those names are yielded.
+    def IterTags(self, html, tagNames=None):
+        if lxml is not None:
+            return IterLxmlTags(html, tagNames)
+        else:
+            return IterTokenizerTags(html, tagNames)
 
     # Note that we don't allow ampersands, which can form valid filenames but can confuse
     # browsers since they expect ampersands to appear in HTML as "&amp;".
@@ -452,18 +3298,501 @@ class SiteDownloaderPlugin(object):
         return ''.join(ch for ch in filename if self.FilenameChar(ch))
 
 
-class DownloadThread(Thread):
-    def __init__(self, urlItemObj, plugins, rootDir):
-        self.urlItemObj = urlItemObj
-        self.plugins = plugins
-        self.rootDir = rootDir
-        self.rval = None
-        self.domainConnectFailCount = collections.defaultdict(int)
-        super(DownloadThread, self).__init__()
+# Finds the plugin that handles a user-added URL: the one with the highest relevance,
+# or the first of them if more than one has it. The plugins' urlPatterns are compiled
+# once into regexes for each host that some plugin names, plus ones for the rest, with
+# the patterns in order of relevance, so that the first pattern that matches is the one
+# we want. Patterns are combined into one regex, as alternatives, where that doesn't
+# change what they match (see CompilePatterns()). Only plugins that need it have
+# GetPageRelevance() called. Once built, this is only read, so it can be shared by all
+# threads.
+class PluginDispatchIndex(object):
+    ANY_HOST = '*'
+
+    def __init__(self, plugins):
+        self.plugins = list(plugins)
+
+        # Each is (relevance, pluginNum, pathRegex).
+        hostPatterns = collections.defaultdict(list)
+        anyHostPatterns = []
+        # Each is (pluginNum, plugin).
+        self.dynamicPlugins = []
+
+        for pluginNum, plugin in enumerate(self.plugins):
+            if plugin.urlPatterns is None or plugin.bDynamicRelevance:
+                self.dynamicPlugins.append((pluginNum, plugin))
+
+            for host, pathRegex, relevance in plugin.urlPatterns or ():
+                if relevance <= 0:
+                    continue
+                if host == self.ANY_HOST:
+                    anyHostPatterns.append((relevance, pluginNum, pathRegex))
+                else:
+                    hostPatterns[host.lower()].append((relevance, pluginNum, pathRegex))
+
+        # Each is a list of (regex, [(relevance, pluginNum)]), where the list is indexed
+        # by the number of the alternative that matched.
+        self.hostRegexes = dict((host, self.CompilePatterns(patterns + anyHostPatterns)) for host, patterns in hostPatterns.items())
+        self.anyHostRegexes = self.CompilePatterns(anyHostPatterns)
+
+    # Return the regexes to try the patterns with, in order. A pattern with groups of its
+    # own can't be combined with others, since its groups would be renumbered (and its
+    # backreferences would then refer to the wrong groups), and neither can one with
+    # inline flags, which would apply to the whole regex; these get a regex each.
+    def CompilePatterns(self, patterns):
+        regexes = []
+        combinedPatterns = []
+        for relevance, pluginNum, pathRegex in sorted(patterns, key=lambda pattern: (-pattern[0], pattern[1])):
+            try:
+                regex = re.compile(pathRegex)
+            except re.error as error:
+                raise SetupError('Invalid plugin URL pattern: ' + ToStr(pathRegex) + ': ' + ToStr(error))
+
+            if regex.groups == 0 and regex.flags == re.compile('').flags:
+                combinedPatterns.append((relevance, pluginNum, pathRegex))
+                continue
+
+            if len(combinedPatterns) > 0:
+                regexes.append(self.CombinePatterns(combinedPatterns))
+                combinedPatterns = []
+            regexes.append((regex, [(relevance, pluginNum)]))
+
+        if len(combinedPatterns) > 0:
+            regexes.append(self.CombinePatterns(combinedPatterns))
+        return regexes
+
+    def CombinePatterns(self, patterns):
+        regex = re.compile('|'.join('(?P<p{}>{})'.format(i, pathRegex) for i, (relevance, pluginNum, pathRegex) in enumerate(patterns)))
+        return regex, [(relevance, pluginNum) for relevance, pluginNum, pathRegex in patterns]
+
+    # Return the plugin that handles a URL, or None if no plugin does.
+    def FindPlugin(self, url):
+        bestRelevance = 0
+        bestPluginNum = None
+
+        domain, domainEndPos = GetDomain(url, bReturnEndPos=True)
+        for regex, matches in self.hostRegexes.get(domain.lower(), self.anyHostRegexes):
+            match = regex.match(url, domainEndPos)
+            if match:
+                bestRelevance, bestPluginNum = matches[int(match.lastgroup[1:]) if len(matches) > 1 else 0]
+                break
+
+        for pluginNum, plugin in self.dynamicPlugins:
+            relevance = plugin.GetPageRelevance(url)
+            if relevance > bestRelevance or (relevance == bestRelevance and relevance > 0 and pluginNum < bestPluginNum):
+                bestRelevance = relevance
+                bestPluginNum = pluginNum
+
+        return self.plugins[bestPluginNum] if bestPluginNum is not None else None
+
+
+# Stands in for a plugin from a plugin module that we haven't imported yet, going by
+# what the PluginManifest says about it: its ID, urlPatterns and bDynamicRelevance, and
+# whether it has its own GetArchiveName(). The module is imported, and the plugin
+# created, the first time anything else is needed from it, e.g. when a user-added URL
+# matches one of its urlPatterns, so a run only imports the plugins it uses. Settings
+# and the state store are passed on to the plugin once it's created.
+class LazyPlugin(object):
+    def __init__(self, moduleName, details, plugin=None):
+        self.moduleName = moduleName
+        self.pluginId = details['id']
+        self.urlPatterns = [tuple(pattern) for pattern in details['urlPatterns']] if details['urlPatterns'] is not None else None
+        self.bDynamicRelevance = details['bDynamicRelevance']
+        self.bArchiveNames = details['bArchiveNames']
+        self.stateStore = None
+        self.settings = None
+        # The plugin, if it was already created when the manifest entry was made.
+        self.createdPlugin = plugin
+        self.plugin = None
+        self.lock = Lock()
+
+    # Like a plugin, this leaves out the state store when it's pickled for a parse
+    # process, which imports the module itself if it needs the plugin.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['stateStore'] = None
+        state['createdPlugin'] = None
+        state['plugin'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+
+    def __getattr__(self, name):
+        if 'lock' not in self.__dict__:
+            raise AttributeError(name)
+        return getattr(self.GetPlugin(), name)
+
+    def GetPlugin(self):
+        if self.plugin is not None:
+            return self.plugin
+
+        with self.lock:
+            if self.plugin is None:
+                plugin = self.createdPlugin
+                if plugin is None:
+                    LogDebug('Loading plugin module', self.moduleName)
+                    try:
+                        plugin = importlib.import_module(self.moduleName).PluginClass()
+                    except (ImportError, AttributeError):
+                        raise SetupError('Unable to import plugin module: ' + self.moduleName)
+
+                plugin.stateStore = self.stateStore
+                if self.settings is not None:
+                    plugin.ApplySettings(self.settings)
+                self.createdPlugin = None
+                self.plugin = plugin
+        return self.plugin
+
+    def ProcessorName(self):
+        return self.pluginId
+
+    def ApplySettings(self, settings):
+        self.settings = dict(settings)
+        if self.plugin is not None:
+            self.plugin.ApplySettings(self.settings)
+
+    def GetArchiveName(self, savePath):
+        if not self.bArchiveNames:
+            return None
+        return self.GetPlugin().GetArchiveName(savePath)
+
+# What we need to know about the plugins in a plugin directory to set up a LazyPlugin
+# for each, without importing their modules. This is cached in a manifest file in the
+# directory, with an entry for each module, which is made by importing the module and
+# looking at its plugin. Entries are remade whenever their module's size or
+# modification time changes, so the manifest never needs to be edited by hand.
+class PluginManifest(object):
+    FILENAME = 'plugin_manifest.json'
+    VERSION = 1
+
+    # packageName is the name that the directory's modules are imported under, e.g.
+    # 'plugins' for plugins.vbulletin_forum.
+    def __init__(self, pluginDir, packageName):
+        self.pluginDir = pluginDir
+        self.packageName = packageName
+        self.path = os.path.join(pluginDir, self.FILENAME)
+
+    def ReadEntries(self):
+        try:
+            with io.open(self.path, 'r', encoding='utf-8') as inFile:
+                manifest = json.load(inFile)
+            if manifest.get('version') == self.VERSION:
+                return manifest['modules']
+        except (OSError, IOError, ValueError, KeyError, AttributeError):
+            pass
+        return {}
+
+    def WriteEntries(self, entries):
+        tempPath = self.path + '.tmp'
+        try:
+            with io.open(tempPath, 'w', encoding='utf-8') as outFile:
+                outFile.write(ToStr(json.dumps({'version': self.VERSION, 'modules': entries}, indent=2, sort_keys=True)))
+            os.replace(tempPath, self.path)
+        except (OSError, IOError):
+            LogDebug('Unable to write plugin manifest', self.path)
+
+    # Import a plugin module, and return (entry, plugin) for it.
+    def MakeEntry(self, moduleName, fileStat):
+        LogDebug('Loading plugin module', moduleName, 'for the plugin manifest')
+        try:
+            plugin = importlib.import_module(self.packageName + '.' + moduleName).PluginClass()
+        except (ImportError, AttributeError):
+            raise SetupError('Unable to import plugin module: ' + moduleName)
+
+        entry = {
+            'mtime': fileStat.st_mtime,
+            'size': fileStat.st_size,
+            'id': GetPluginId(plugin),
+            'urlPatterns': plugin.urlPatterns,
+            'bDynamicRelevance': plugin.bDynamicRelevance,
+            'bArchiveNames': type(plugin).GetArchiveName is not SiteDownloaderPlugin.GetArchiveName,
+        }
+        return entry, plugin
+
+    # Return a LazyPlugin for each plugin module in the directory, in order of module
+    # name, and update the manifest file if any of its entries were out of date.
+    def LoadPlugins(self):
+        try:
+            fileNames = sorted(os.listdir(self.pluginDir))
+        except OSError:
+            raise SetupError("Couldn't read plugin directory: " + self.pluginDir)
+
+        oldEntries = self.ReadEntries()
+        entries = {}
+        lazyPlugins = []
+        for fileName in fileNames:
+            moduleName, fileExt = os.path.splitext(fileName)
+            if fileExt != '.py' or moduleName == '__init__':
+                continue
+
+            fileStat = os.stat(os.path.join(self.pluginDir, fileName))
+            entry = oldEntries.get(moduleName)
+            plugin = None
+            if entry is None or entry.get('mtime') != fileStat.st_mtime or entry.get('size') != fileStat.st_size:
+                entry, plugin = self.MakeEntry(moduleName, fileStat)
+
+            entries[moduleName] = entry
+            lazyPlugins.append(LazyPlugin(self.packageName + '.' + moduleName, entry, plugin))
+
+        if entries != oldEntries:
+            self.WriteEntries(entries)
+        return lazyPlugins
+
+
+# Amount of HTML that we parse at a time when reading tags without building a tree.
+TAG_PARSE_CHUNK_SIZE = 64 * 1024
+
+# Implementation of SiteDownloaderPlugin.IterTags() using lxml's pull parser. lxml does
+# build a tree as it goes, but we throw away each part of it once we're done with it.
+def IterLxmlTags(html, tagNames=None):
+    parser = lxml.etree.HTMLPullParser(events=('start', 'end'))
+
+    # We only know a tag's text once we get the event after its start event.
+    pendingElement = None
+
+    chunkStart = 0
+    while True:
+        if chunkStart < len(html):
+            parser.feed(html[chunkStart:chunkStart + TAG_PARSE_CHUNK_SIZE])
+            chunkStart += TAG_PARSE_CHUNK_SIZE
+        else:
+            try:
+                parser.close()
+            except lxml.etree.XMLSyntaxError:
+                # This happens if there aren't any tags at all.
+                pass
+
+        for event, element in parser.read_events():
+            if pendingElement is not None:
+                yield pendingElement.tag, dict(pendingElement.attrib), pendingElement.text
+                pendingElement = None
+
+            if event == 'start':
+                if tagNames is None or element.tag in tagNames:
+                    pendingElement = element
+            else:
+                element.clear()
+                parent = element.getparent()
+                if parent is not None:
+                    while element.getprevious() is not None:
+                        del parent[0]
+
+        if chunkStart >= len(html):
+            break
+
+    if pendingElement is not None:
+        yield pendingElement.tag, dict(pendingElement.attrib), pendingElement.text
+
+# Reads (tagName, attrs, text) for tags as HTMLParser finds them. See
+# SiteDownloaderPlugin.IterTags().
+class TagTokenizer(HTMLParser):
+    def __init__(self, tagNames=None):
+        HTMLParser.__init__(self)
+        self.tagNames = tagNames
+        self.tags = []
+        self.pendingTag = None
+
+    def FinishTag(self):
+        if self.pendingTag is not None:
+            tagName, attrs, textParts = self.pendingTag
+            self.tags.append((tagName, attrs, ''.join(textParts) if len(textParts) > 0 else None))
+            self.pendingTag = None
+
+    def handle_starttag(self, tag, attrs):
+        self.FinishTag()
+        if self.tagNames is None or tag in self.tagNames:
+            self.pendingTag = (tag, dict((name, value if value is not None else '') for name, value in attrs), [])
+
+    def handle_endtag(self, tag):
+        self.FinishTag()
+
+    def handle_data(self, data):
+        if self.pendingTag is not None:
+            self.pendingTag[2].append(data)
+
+    def close(self):
+        HTMLParser.close(self)
+        self.FinishTag()
+
+# Implementation of SiteDownloaderPlugin.IterTags() for when lxml isn't installed.
+def IterTokenizerTags(html, tagNames=None):
+    tokenizer = TagTokenizer(tagNames)
+    for chunkStart in range(0, len(html), TAG_PARSE_CHUNK_SIZE):
+        tokenizer.feed(html[chunkStart:chunkStart + TAG_PARSE_CHUNK_SIZE])
+        for tag in tokenizer.tags:
+            yield tag
+        tokenizer.tags = []
+
+    tokenizer.close()
+    for tag in tokenizer.tags:
+        yield tag
+
+
+# Whether IterSoupHtml() can stream soups with this version of BeautifulSoup, or None
+# if we haven't checked yet.
+g_bSoupStreamingWorks = None
+
+# HTML that CheckSoupStreaming() compares the output of the two ways of serializing on.
+SOUP_STREAMING_CHECK_HTML = ('<!DOCTYPE html><html><head><title>A &amp; B</title><script>if (a < b) {}</script></head>'
+                             '<body class="a b"><!-- comment --><p id="x">One<br/>two &lt; &quot;three&quot;</p>'
+                             '<img src="a.png" alt=\'"\'/><div style="background-image:url(b.png)"></div></body></html>')
+
+# Check whether streaming a soup gives the same HTML as str(soup). Streaming uses
+# BeautifulSoup's private element events and tag formatting, which it's had since 4.13
+# (and which this was last checked with in 4.15), so a later version could change them.
+def CheckSoupStreaming():
+    global g_bSoupStreamingWorks
+    if g_bSoupStreamingWorks is None:
+        soup = bs4.BeautifulSoup(SOUP_STREAMING_CHECK_HTML, features=g_soupParser)
+        try:
+            g_bSoupStreamingWorks = ''.join(StreamSoupHtml(soup)) == ToStr(soup)
+        except (AttributeError, TypeError):
+            g_bSoupStreamingWorks = False
+        if not g_bSoupStreamingWorks:
+            LogDebug('Saving pages without streaming, which this version of BeautifulSoup does not support')
+    return g_bSoupStreamingWorks
+
+def StreamSoupHtml(soup):
+    Tag = bs4.element.Tag
+    encoding = bs4.element.DEFAULT_OUTPUT_ENCODING
+    formatter = soup.formatter_for_name('minimal')
+    for event, element in soup._event_stream():
+        if event is Tag.START_ELEMENT_EVENT or event is Tag.EMPTY_ELEMENT_EVENT:
+            yield element._format_tag(encoding, formatter, opening=True)
+        elif event is Tag.END_ELEMENT_EVENT:
+            yield element._format_tag(encoding, formatter, opening=False)
+        else:
+            yield element.output_ready(formatter)
+
+# Yield the HTML of a soup in pieces, which add up to what str(soup) gives all at once.
+# Where streaming isn't supported (see CheckSoupStreaming()), or fails before yielding
+# anything, this yields the whole page at once instead.
+def IterSoupHtml(soup):
+    if soup.is_xml or not CheckSoupStreaming():
+        yield ToStr(soup)
+        return
+
+    bYielded = False
+    try:
+        for piece in StreamSoupHtml(soup):
+            bYielded = True
+            yield piece
+    except (AttributeError, TypeError):
+        # What's been yielded can't be taken back.
+        if bYielded:
+            raise
+        yield ToStr(soup)
+
+# Save a page that a plugin has processed, from the soup (or text) and file path that
+# the plugin returned; a plugin may also return None for both, to not save the page.
+def SavePage(output, urlInfo, soup, pageFilePath):
+    if (soup is not None or pageFilePath is not None) and (soup is None or pageFilePath is None):
+        raise LogicError('Failed to get proper info to save page')
+
+    if soup is not None and pageFilePath is not None:
+        SavePageHtml(output, urlInfo, IterSoupHtml(soup), pageFilePath)
+
+# Save a page's HTML, given as an iterable of strings, unless something is already saved
+# at its path and we're not to overwrite it. See OutputBackend.WritePage() for
+# bSerialized.
+def SavePageHtml(output, urlInfo, pieces, pageFilePath, bSerialized=False):
+    if not SPEED_TEST or SPEED_TEST_MAKES_FILES:
+        if output.Exists(pageFilePath) and not urlInfo.bReplaceExisting:
+            # Note that we don't throw an exception here, so that we instead return the
+            # list of new URL items we got.
+            LogError('Error: For URL:', urlInfo.url, '\nPage file already exists:', pageFilePath)
+        else:
+            output.WritePage(pageFilePath, pieces, urlInfo.url, bSerialized)
+            # Pages that a parse process hands back are counted when the main process
+            # saves them.
+            if not isinstance(output, CollectedOutput):
+                g_metrics.Count('pages_saved')
+
+
+# The plugins, by ID, in a parse process, and the OutputBackend it saves pages with.
+g_parsePlugins = None
+g_parseOutput = None
+
+# Set up a process in SiteDownloader.parsePool. What the process logs goes to logQueue,
+# for the main process to log. If output is None, pages are sent back to the main
+# process to be saved.
+def InitParseProcess(plugins, output, logQueue, logLevel):
+    global g_parsePlugins, g_parseOutput
+    g_parsePlugins = dict((GetPluginId(plugin), plugin) for plugin in plugins)
+    g_parseOutput = output if output is not None else CollectedOutput()
+
+    g_logger.addHandler(logging.handlers.QueueHandler(logQueue))
+    g_logger.setLevel(logLevel)
+    g_logger.propagate = False
+
+# Parse and save a page that a worker thread fetched, in a parse process, and return
+# (newUrlItems, pages, metricsData), where pages is [(pageFilePath, html)] for pages
+# that the main process has to save (see CollectedOutput), and metricsData is from
+# g_metrics.TakeData(). UrlInfo objects refer to their plugins by ID here, since each
+# process has its own copies of the plugins.
+def ParsePageInProcess(urlInfo, fetchedPage):
+    g_metrics.SetContext(GetDomain(urlInfo.url), urlInfo.plugin)
+    try:
+        urlInfo.plugin = g_parsePlugins[urlInfo.plugin]
+        newUrlItems, soup, pageFilePath = urlInfo.plugin.ParseUrlInfo(urlInfo, fetchedPage)
+        SavePage(g_parseOutput, urlInfo, soup, pageFilePath)
+    except Exception as error:
+        error.traceback = traceback.format_exc()
+        raise
+
+    for newUrlItem in newUrlItems:
+        if not IsStr(newUrlItem) and newUrlItem.plugin is not None:
+            newUrlItem.plugin = GetPluginId(newUrlItem.plugin)
+
+    # What we recorded while parsing goes back along with the new items. If parsing
+    # fails, it goes back with the next page instead.
+    pages = g_parseOutput.TakePages() if isinstance(g_parseOutput, CollectedOutput) else []
+    return newUrlItems, pages, g_metrics.TakeData()
+
+
+# Worker thread which processes DownloadThread objects from workQueue until it gets
+# None, passing each one on to doneQueue when it's done with it.
+class WorkerThread(Thread):
+    def __init__(self, workQueue, doneQueue):
+        self.workQueue = workQueue
+        self.doneQueue = doneQueue
+        super(WorkerThread, self).__init__()
+        self.daemon = True
 
     def run(self):
-        self.ProcessUrl()
-        LogDebug('Thread ending for URL', self.GetUrl())
+        while True:
+            thread = self.workQueue.get()
+            if thread is None:
+                break
+
+            try:
+                thread.ProcessUrl()
+            except Exception as error:
+                # Make sure the main thread hears about this, rather than waiting on
+                # this item forever.
+                error.traceback = traceback.format_exc()
+                thread.rval = error
+
+            LogDebug('Thread ending for URL', thread.GetUrl())
+            self.doneQueue.put(thread)
+
+
+# Contains the data and code for a single URL to be processed. This is run by one of
+# the worker threads, or directly by the main thread in single-thread mode.
+class DownloadThread(object):
+    # If bParseStage is set, pages for plugins that split fetching and parsing pages are
+    # only fetched here, and left in fetchedPage for the parse processes.
+    def __init__(self, urlItemObj, pluginIndex, output, bParseStage=False):
+        self.urlItemObj = urlItemObj
+        self.pluginIndex = pluginIndex
+        self.output = output
+        self.bParseStage = bParseStage
+        self.rval = None
+        self.fetchedPage = None
+        self.parseFuture = None
 
     def GetUrl(self):
         if IsStr(self.urlItemObj):
@@ -478,13 +3807,7 @@ class DownloadThread(Thread):
 
         if bStrObj:
             url = self.urlItemObj
-
-            highestRelevance = 0
-            for plugin in self.plugins:
-                relevance = plugin.GetPageRelevance(url)
-                if relevance > highestRelevance:
-                    highestRelevance = relevance
-                    usePlugin = plugin
+            usePlugin = self.pluginIndex.FindPlugin(url)
         else:
             url = self.urlItemObj.url
 
@@ -496,6 +3819,8 @@ class DownloadThread(Thread):
             self.rval = PageDetailsError('No plugin to process URL')
             return
 
+        g_metrics.SetContext(GetDomain(url), GetPluginId(usePlugin))
+
         newUrlItems = None
 
         if bStrObj:
@@ -517,39 +3842,27 @@ class DownloadThread(Thread):
 
             if urlInfo.bFile:
                 try:
-                    self.DownloadFile(urlInfo.url, os.path.join(self.rootDir, urlInfo.fileSavePath), urlInfo.plugin.GetLoginCredentials(urlInfo.url))
+                    if urlInfo.bKeepExisting and self.output.Exists(urlInfo.fileSavePath):
+                        LogDebug('Already have', urlInfo.fileSavePath)
+                    else:
+                        self.DownloadFile(urlInfo.url, urlInfo.fileSavePath, urlInfo.plugin.GetLoginCredentials(urlInfo.url),
+                                          urlInfo.bReplaceExisting)
                     newUrlItems = []
                 except Exception as error:
                     error.traceback = traceback.format_exc()
                     self.rval = error
                     return
+            elif self.bParseStage and usePlugin.bSplitProcessing:
+                try:
+                    self.fetchedPage = usePlugin.FetchUrlInfo(urlInfo)
+                except Exception as error:
+                    error.traceback = traceback.format_exc()
+                    self.rval = error
+                    return
             else:
                 try:
                     newUrlItems, soup, pageFilePath = usePlugin.ProcessUrlInfo(urlInfo)
-
-                    if (soup is not None or pageFilePath is not None) and (soup is None or pageFilePath is None):
-                        raise LogicError('Failed to get proper info to save page')
-
-                    if soup is not None and pageFilePath is not None:
-                        if not SPEED_TEST or SPEED_TEST_MAKES_FILES:
-                            # Save page as file.
-
-                            pageSavePath = os.path.join(self.rootDir, pageFilePath)
-
-                            if os.path.exists(pageSavePath):
-                                # Note that we don't throw an exception here, so that
-                                # we instead return the list of new URL items we got.
-                                LogError('Error: For URL:', urlInfo.url, '\nPage file already exists:', pageSavePath)
-                            else:
-                                saveDirPath = os.path.dirname(pageSavePath)
-                                try:
-                                    if not os.path.exists(saveDirPath):
-                                        os.makedirs(saveDirPath)
-
-                                    with io.open(pageSavePath, 'w', encoding='utf-8') as outFile:
-                                        outFile.write(ToStr(soup))
-                                except (OSError, IOError):
-                                    raise WriteError('Unable to create file: ' + pageSavePath)
+                    SavePage(self.output, urlInfo, soup, pageFilePath)
                 except Exception as error:
                     error.traceback = traceback.format_exc()
                     self.rval = error
@@ -558,33 +3871,127 @@ class DownloadThread(Thread):
         if self.rval is None:
             self.rval = newUrlItems
 
-    def DownloadFile(self, fileUrl, savePath, loginCredentials=None):
+    # Files are downloaded to a partial file at the output's download path (for
+    # DirectoryOutput, next to the save path), which is only added to the output once
+    # the whole file has been downloaded and its size checked. If a
+    # download is interrupted, the partial file is kept, and the next attempt at the
+    # download asks the server for just the rest of the file, as long as the file hasn't
+    # changed on the server since.
+    PARTIAL_FILE_SUFFIX = '.part'
+
+    # Files smaller than this aren't worth resuming, so we don't write the information
+    # needed to resume them.
+    RESUMABLE_SIZE_THRESHOLD = 256 * 1024
+    # Space on disk is allocated up front for files of at least this size.
+    PREALLOCATE_SIZE_THRESHOLD = 1024 * 1024
+
+    # Size of the chunks that responses are read and written in. Small files are read
+    # in one or a few chunks, and large ones in chunks big enough that the per-chunk
+    # overhead doesn't matter.
+    MIN_CHUNK_SIZE = 16 * 1024
+    MAX_CHUNK_SIZE = 1024 * 1024
+    DEFAULT_CHUNK_SIZE = 64 * 1024
+
+    # If bReplaceExisting is set, whatever is saved at the save path is replaced once the
+    # file has been downloaded.
+    def DownloadFile(self, fileUrl, savePath, loginCredentials=None, bReplaceExisting=False):
         LogInfo('Downloading', fileUrl, 'to', savePath)
 
         if SPEED_TEST and not SPEED_TEST_MAKES_FILES:
             return
 
-        if os.path.exists(savePath):
+        if self.output.Exists(savePath) and not bReplaceExisting:
             raise FileExistsError(savePath)
 
+        partPath = self.output.GetDownloadPath(savePath) + self.PARTIAL_FILE_SUFFIX
+        resumeFrom, validator = self.GetPartialDownload(fileUrl, partPath)
+
         startTime = datetime.datetime.now()
+        if resumeFrom > 0:
+            r = self.RequestFile(fileUrl, loginCredentials, {'Range': 'bytes={}-'.format(resumeFrom), 'If-Range': validator})
+            if r.status_code == 416:
+                # The partial file is no use with the file that's on the server now.
+                r.close()
+                self.RemovePartialDownload(partPath)
+                resumeFrom = 0
+                r = self.RequestFile(fileUrl, loginCredentials)
+        else:
+            r = self.RequestFile(fileUrl, loginCredentials)
+        endTime = datetime.datetime.now()
+
+        # Make sure the connection always goes back to the pool, even if we bail out
+        # without reading the whole response.
         try:
-            client = requests.session()
-            client.headers = requests.utils.default_headers()
+            self.SaveResponse(r, fileUrl, savePath, partPath, resumeFrom, loginCredentials)
+        finally:
+            r.close()
 
-            client.headers.update({'User-Agent': GetUserAgent()})
+        LogDebug('Done writing file for URL', fileUrl)
 
-            if loginCredentials is not None:
-                r = requests.get(fileUrl, stream=True, timeout=g_timeoutHandler.GetUrlTimeouts(fileUrl), **loginCredentials)
-            else:
-                r = client.get(fileUrl, stream=True, timeout=g_timeoutHandler.GetUrlTimeouts(fileUrl))
-        except requests.exceptions.ConnectTimeout:
-            self.domainConnectFailCount[GetDomain(fileUrl)] += 1
-            raise HTTPConnectError()
+    # Make a streaming request for a file.
+    def RequestFile(self, fileUrl, loginCredentials, headers=None):
+        kwargs = {}
+        if loginCredentials is not None:
+            kwargs.update(loginCredentials)
+
+        if headers is not None:
+            kwargs['headers'] = headers
+
+        try:
+            client = g_sessionPool.GetSession(fileUrl)
+            return MakeRequest(client.get, fileUrl, stream=True, **kwargs)
         except requests.exceptions.RequestException:
             raise HTTPConnectError()
-        endTime = datetime.datetime.now()
 
+    # Return the path of the file that holds what we need to know to resume a partial
+    # download.
+    def GetPartialInfoPath(self, partPath):
+        return partPath + '.json'
+
+    # Returns (resumeFrom, validator) for a partial download of the URL that we can pick
+    # up, or (0, None) if there's nothing usable.
+    def GetPartialDownload(self, fileUrl, partPath):
+        try:
+            with io.open(self.GetPartialInfoPath(partPath), 'r', encoding='utf-8') as infoFile:
+                partInfo = json.load(infoFile)
+            resumeFrom = os.path.getsize(partPath)
+        except (OSError, IOError, ValueError):
+            return 0, None
+
+        if partInfo.get('url') != fileUrl or partInfo.get('validator') is None:
+            return 0, None
+        return resumeFrom, partInfo['validator']
+
+    # Return the value we can use in If-Range headers to make sure we only get parts of
+    # the same version of a file as this response, or None if there isn't one.
+    def GetValidator(self, r):
+        # Weak ETags can't be used with If-Range.
+        validator = r.headers.get('ETag')
+        if validator is None or validator.startswith('W/'):
+            validator = r.headers.get('Last-Modified')
+        return validator
+
+    def SavePartialDownloadInfo(self, fileUrl, partPath, r):
+        validator = self.GetValidator(r)
+
+        infoPath = self.GetPartialInfoPath(partPath)
+        if validator is None:
+            # We won't be able to tell if the file changes, so we can't resume it.
+            if os.path.exists(infoPath):
+                os.remove(infoPath)
+            return
+
+        with io.open(infoPath, 'w', encoding='utf-8') as infoFile:
+            infoFile.write(ToStr(json.dumps({'url': fileUrl, 'validator': validator})))
+
+    def RemovePartialDownload(self, partPath):
+        for path in [partPath, self.GetPartialInfoPath(partPath)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def SaveResponse(self, r, fileUrl, savePath, partPath, resumeFrom, loginCredentials=None):
         try:
             fileType = r.headers['Content-Type']
             if fileType == 'text/html':
@@ -595,42 +4002,198 @@ class DownloadThread(Thread):
             fileSize = None
             LogWarning('Warning: For URL:', fileUrl, '\nNo way of verifying file size')
 
-        if r.status_code == 200:
-            try:
-                saveDirPath = os.path.dirname(savePath)
-                if not os.path.exists(saveDirPath):
-                    os.makedirs(saveDirPath)
-
-                startTime = datetime.datetime.now()
-                with open(savePath, 'wb') as outFile:
-                    for chunk in r.iter_content(chunk_size=1024):
-                        if chunk:   # Don't write keep-alive chunks
-                            outFile.write(chunk)
-
-                LogDebug('Finished writing', fileUrl)
-
-                if fileSize is not None:
-                    gotFileSize = os.path.getsize(savePath)
-                    if gotFileSize != fileSize:
-                        raise HTTPRequestError('File size mismatch: expected ' + str(fileSize) + ', got' + str(gotFileSize))
-                endTime = datetime.datetime.now()
-            except FileNotFoundError:
-                # It's possible to get this error (yes, when writing to a new file) as a
-                # result of calling open() on Windows. This can happen if there is a
-                # "Delayed Write Error", where "Windows was unable to save all the data
-                # for the file". This is very rare, but I have observed it happening with
-                # this program on Windows 7. When it did, Windows announced it via a popup
-                # on the system tray.
-
-                # We will also get this error for filenames that exceed the maximum
-                # allowed file path length. We could deal with this, but we would also
-                # then need to modify every reference to this file in all CSS and
-                # JavaScript files. So... a possible TODO.
-
-                raise WindowsDelayedWriteError('Unable to create file: ' + savePath)
-            except (OSError, IOError):
-                raise WriteError('Unable to create file: ' + savePath)
+        bHadPartialDownload = resumeFrom > 0
+
+        if r.status_code == 206 and resumeFrom > 0:
+            # Check that we got the rest of the file, and get the size of the whole file.
+            match = re.match(r'bytes (\d+)-\d+/(\d+|\*)', r.headers.get('Content-Range', ''))
+            if not match or int(match.group(1)) != resumeFrom:
+                self.RemovePartialDownload(partPath)
+                raise HTTPRequestError('Got wrong part of file when resuming download')
+
+            fileSize = int(match.group(2)) if match.group(2) != '*' else None
+            LogDebug('Resuming download of', fileUrl, 'from', resumeFrom, 'bytes')
+        elif r.status_code == 200:
+            # Either this is a new download, or the server ignored our range request
+            # (or the file has changed since), and we need to start over.
+            resumeFrom = 0
         else:
             raise HTTPRequestError('Request failed')
 
-        LogDebug('Done writing file for URL', fileUrl)
+        try:
+            MakeDirs(os.path.dirname(partPath))
+
+            # If the output stores each distinct file only once, we hash the file as we
+            # go, so that it can tell whether it already has it.
+            fileHash = None
+            if self.output.bDeduplicate:
+                fileHash = hashlib.sha256()
+
+            bResumable = True
+            if resumeFrom == 0 and g_parallelDownloadHandler.ShouldDownloadInParallel(r, fileSize) and self.GetValidator(r) is not None:
+                self.SaveResponseInParallel(r, fileUrl, partPath, fileSize, loginCredentials)
+                if fileHash is not None:
+                    self.HashFile(partPath, fileHash)
+                gotFileSize = fileSize
+            else:
+                bResumable = fileSize is None or fileSize >= self.RESUMABLE_SIZE_THRESHOLD
+                if resumeFrom == 0:
+                    if bResumable or bHadPartialDownload:
+                        self.SavePartialDownloadInfo(fileUrl, partPath, r)
+                elif fileHash is not None:
+                    self.HashFile(partPath, fileHash)
+
+                # Compressed responses don't tell us the size of the file on disk.
+                bPreallocate = (resumeFrom == 0 and fileSize is not None and fileSize >= self.PREALLOCATE_SIZE_THRESHOLD and
+                                'Content-Encoding' not in r.headers)
+
+                with open(partPath, 'ab' if resumeFrom > 0 else 'wb') as outFile:
+                    if bPreallocate:
+                        bPreallocate = PreallocateFile(outFile, fileSize)
+                    try:
+                        gotFileSize = resumeFrom + self.WriteResponse(r, outFile, fileHash, fileSize)
+                    finally:
+                        if bPreallocate:
+                            # Don't leave the unwritten part of the file there, or we'd
+                            # resume from the wrong place.
+                            outFile.truncate(outFile.tell())
+
+            LogDebug('Finished writing', fileUrl)
+
+            if fileSize is not None:
+                if gotFileSize != fileSize:
+                    if gotFileSize > fileSize:
+                        self.RemovePartialDownload(partPath)
+                    raise HTTPRequestError('File size mismatch: expected ' + str(fileSize) + ', got' + str(gotFileSize))
+
+            self.output.AddFile(savePath, partPath, fileUrl, r.headers.get('Content-Type'),
+                                fileHash.hexdigest() if fileHash is not None else None)
+            if bResumable or bHadPartialDownload:
+                self.RemovePartialDownload(partPath)
+            g_metrics.Count('files_saved')
+        except FileNotFoundError:
+            # It's possible to get this error (yes, when writing to a new file) as a
+            # result of calling open() on Windows. This can happen if there is a
+            # "Delayed Write Error", where "Windows was unable to save all the data
+            # for the file". This is very rare, but I have observed it happening with
+            # this program on Windows 7. When it did, Windows announced it via a popup
+            # on the system tray.
+
+            # We will also get this error for filenames that exceed the maximum
+            # allowed file path length. We could deal with this, but we would also
+            # then need to modify every reference to this file in all CSS and
+            # JavaScript files. So... a possible TODO.
+
+            raise WindowsDelayedWriteError('Unable to create file: ' + savePath)
+        except (OSError, IOError):
+            raise WriteError('Unable to create file: ' + savePath)
+
+    # Return the size of the chunks to read a file of the given size (or None, if we
+    # don't know it) in.
+    def GetChunkSize(self, fileSize):
+        if fileSize is None:
+            return self.DEFAULT_CHUNK_SIZE
+        return max(self.MIN_CHUNK_SIZE, min(self.MAX_CHUNK_SIZE, fileSize // 8))
+
+    # Write the body of a response to a file, hashing it too if fileHash is given, and
+    # return the number of bytes written. Reading the body and writing it are timed
+    # separately.
+    def WriteResponse(self, r, outFile, fileHash=None, fileSize=None):
+        startTime = time.perf_counter()
+        writeTime = 0
+        byteNum = 0
+        try:
+            for chunk in r.iter_content(chunk_size=self.GetChunkSize(fileSize)):
+                if chunk:   # Don't write keep-alive chunks
+                    writeStartTime = time.perf_counter()
+                    outFile.write(chunk)
+                    writeTime += time.perf_counter() - writeStartTime
+                    byteNum += len(chunk)
+                    if fileHash is not None:
+                        fileHash.update(chunk)
+        except requests.exceptions.RequestException:
+            # Keep what we got, to resume from next time.
+            raise HTTPConnectError('Download interrupted')
+        finally:
+            g_metrics.Observe('body', time.perf_counter() - startTime - writeTime)
+            g_metrics.Observe('write', writeTime)
+            g_metrics.Count('bytes_downloaded', byteNum)
+        return byteNum
+
+    def HashFile(self, filePath, fileHash):
+        with open(filePath, 'rb') as inFile:
+            for chunk in iter(lambda: inFile.read(65536), b''):
+                fileHash.update(chunk)
+
+    # Download a large file over several connections at once, each getting a different
+    # byte range of the file and writing it at its offset in the partial file. We keep
+    # reading the first range from the response we already have, and get the others
+    # with new requests. Note that we don't keep track of which ranges we finished, so
+    # unlike other partial downloads, these can't be resumed.
+    def SaveResponseInParallel(self, r, fileUrl, partPath, fileSize, loginCredentials):
+        ranges = g_parallelDownloadHandler.GetRanges(fileSize)
+        validator = self.GetValidator(r)
+        LogDebug('Downloading', fileUrl, 'in', len(ranges), 'parts')
+
+        self.RemovePartialDownload(partPath)
+        try:
+            with open(partPath, 'wb') as outFile:
+                outFile.truncate(fileSize)
+
+            executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges) - 1)
+            try:
+                futures = [executor.submit(self.DownloadRange, fileUrl, partPath, start, end, validator, loginCredentials)
+                           for start, end in ranges[1:]]
+
+                start, end = ranges[0]
+                self.WriteRange(r, partPath, start, end)
+                r.close()
+
+                for future in futures:
+                    future.result()
+            finally:
+                executor.shutdown(wait=True)
+        except Exception:
+            self.RemovePartialDownload(partPath)
+            raise
+
+    # Get bytes start to end (inclusive) of a file, and write them at the same offset in
+    # the partial file.
+    def DownloadRange(self, fileUrl, partPath, start, end, validator, loginCredentials):
+        with g_parallelDownloadHandler.GetHostSemaphore(GetDomain(fileUrl)):
+            r = self.RequestFile(fileUrl, loginCredentials, {'Range': 'bytes={}-{}'.format(start, end), 'If-Range': validator})
+            try:
+                # If the file has changed since we started, the server sends us all of it.
+                match = re.match(r'bytes (\d+)-', r.headers.get('Content-Range', ''))
+                if r.status_code != 206 or not match or int(match.group(1)) != start or 'Content-Encoding' in r.headers:
+                    raise HTTPRequestError('Failed to get part of file')
+
+                self.WriteRange(r, partPath, start, end)
+            finally:
+                r.close()
+
+    def WriteRange(self, r, partPath, start, end):
+        remainingSize = end - start + 1
+        startTime = time.perf_counter()
+        writeTime = 0
+        with open(partPath, 'r+b') as outFile:
+            outFile.seek(start)
+            try:
+                for chunk in r.iter_content(chunk_size=self.GetChunkSize(end - start + 1)):
+                    if remainingSize <= 0:
+                        break
+                    chunk = chunk[:remainingSize]
+                    writeStartTime = time.perf_counter()
+                    outFile.write(chunk)
+                    writeTime += time.perf_counter() - writeStartTime
+                    remainingSize -= len(chunk)
+            except requests.exceptions.RequestException:
+                raise HTTPConnectError('Download interrupted')
+            finally:
+                domain = GetDomain(r.url)
+                g_metrics.Observe('body', time.perf_counter() - startTime - writeTime, domain=domain)
+                g_metrics.Observe('write', writeTime, domain=domain)
+                g_metrics.Count('bytes_downloaded', end - start + 1 - remainingSize, domain=domain)
+
+        if remainingSize > 0:
+            raise HTTPRequestError('Got incomplete part of file')